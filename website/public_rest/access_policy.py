@@ -18,6 +18,10 @@ class UserSubscriptionPolicy(IsOwnerOrModeratorPermission):
     pass
 
 
+class UserExportPolicy(IsAdminUser):
+    pass
+
+
 # Email
 class EmailViewPolicy(IsOwnerOrReadOnlyPermission):
     pass
@@ -57,6 +61,19 @@ class ListSettingsPolicy(IsOwnerOrModeratorPermission):
     pass
 
 
+class ListBulkMembershipPolicy(IsSuperuserOrOwnerOrModeratorPermission):
+    pass
+
+
+class ListExportPolicy(IsSuperuserOrOwnerOrModeratorPermission):
+    pass
+
+
 # Domain
 class DomainViewPolicy(IsAdminOrReadOnly):
     pass
+
+
+# Sync
+class SyncStatusPolicy(IsAdminUser):
+    pass
@@ -7,6 +7,7 @@ from public_rest.signals import sig_email, sig_user
 from public_rest.interface import *
 from public_rest.models import *
 from public_rest.adaptors import *
+from public_rest import authz
 
 #   ####################
 #     The save actions
@@ -32,6 +33,11 @@ def on_Domain_save(sender, **kwargs):
 def on_Membership_save(sender, **kwargs):
     kwargs['instance'].process_on_save_signal(sender, **kwargs)
 
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def invalidate_Membership_authz(sender, instance, **kwargs):
+    authz.invalidate_memberships([instance])
+
 @receiver(post_save, sender=MembershipPrefs)
 def on_MembershipPrefs_save(sender, **kwargs):
     kwargs['instance'].process_on_save_signal(sender, **kwargs)
@@ -13,6 +13,99 @@ from urlparse import urljoin, urlsplit
 from django.conf import settings
 from django.db import models
 
+from public_rest import fanout
+from public_rest.instrumentation import record_lazy_load
+
+
+def page_size():
+    return getattr(settings, 'MAILMAN_CORE_PAGE_SIZE', 100)
+
+
+def paged_path(path, count, page):
+    """`path` with the `count` and `page` parameters of one of its pages."""
+    separator = '&' if '?' in path else '?'
+    return '{0}{1}count={2}&page={3}'.format(path, separator, count, page)
+
+
+def is_last_page(content, count, page):
+    entries = content.get('entries', [])
+    # More entries than asked for: the whole collection was returned.
+    if len(entries) != count:
+        return True
+    total_size = content.get('total_size')
+    return total_size is not None and count * page >= total_size
+
+
+def iterate_entries(connection, path, count=None, prefetch=True):
+    """
+    Yield the entries of a Core collection, fetched one page of `count`
+    at a time, so that large collections are never held whole. While the
+    entries of a page are consumed, the next page is fetched in the
+    background.
+    """
+    count = count or page_size()
+    fetch = lambda page: connection.call(paged_path(path, count, page))[1]
+    page = 1
+    content = fetch(page)
+    while True:
+        if not isinstance(content, dict):
+            return
+        last = is_last_page(content, count, page)
+        if not last and prefetch:
+            upcoming = fanout.Prefetch(lambda page=page + 1: fetch(page))
+        for entry in content.get('entries', []):
+            yield entry
+        if last:
+            return
+        page += 1
+        content = upcoming.result() if prefetch else fetch(page)
+
+
+def iterate_collection(connection, path, adaptor, count=None, prefetch=True):
+    """Yield an `adaptor` of each entry of a Core collection, see `iterate_entries`."""
+    for entry in iterate_entries(connection, path, count, prefetch):
+        yield adaptor(connection, entry['self_link'], data=entry)
+
+
+def find_subscriptions(connection, addresses):
+    """
+    The memberships of every address of `addresses`. The lookups are
+    made concurrently, and are answered from the response cache until a
+    membership changes here, or their TTL expires.
+    """
+    calls = [lambda address=address: connection.call('members/find',
+                                                     data={'subscriber': address},
+                                                     cache_post=True)
+             for address in addresses]
+    subscriptions = []
+    for response, content in fanout.run_parallel(calls):
+        if isinstance(content, dict):
+            subscriptions.extend(MembershipAdaptor(connection, entry['self_link'], data=entry)
+                                 for entry in content.get('entries', []))
+    return subscriptions
+
+
+# Stands for a field missing from a representation.
+_MISSING = object()
+
+
+class AdaptorType(type):
+    """
+    Lays adaptors out in `__slots__`, without a per-instance `__dict__`.
+
+    The fields of the Core representation an adaptor type uses are
+    declared once, in its `fields`. An instance keeps their values in a
+    tuple, in that order, instead of the whole decoded response: a list
+    of a thousand members holds a thousand small tuples, not a thousand
+    dicts.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        attrs.setdefault('__slots__', ())
+        if 'fields' in attrs:
+            attrs['_index'] = dict((field, i) for i, field in enumerate(attrs['fields']))
+        return super(AdaptorType, mcs).__new__(mcs, name, bases, attrs)
+
 
 class BaseAdaptor(object):
     """
@@ -29,12 +122,51 @@ class BaseAdaptor(object):
 
     """
     #XXX: Save everything or delegate everything or handle per-object?
+    __metaclass__ = AdaptorType
+    __slots__ = ('_connection', '_url', '_values')
     layer = 'adaptor'
+    fields = ()
+    # Iterated fields that take a Core call of their own to read, left
+    # out of bulk imports.
+    lazy_fields = ()
+
+    def __init__(self, connection, url, data=None):
+        self._connection = connection
+        self._url = url
+        self._set_info(data)
 
     def __iter__(self):
         for item in self.iter_fields:
             yield item
 
+    def _set_info(self, data):
+        """Keep the `fields` of the representation `data`, or forget them."""
+        if data:
+            get = data.get
+            self._values = tuple([get(name, _MISSING) for name in self.fields])
+        else:
+            self._values = None
+
+    def _get_info(self):
+        if self._values is None:
+            record_lazy_load(self)
+            response, content = self._connection.call(self._url)
+            self._set_info(content)
+
+    def _get(self, name, default=_MISSING):
+        """
+        The value of the field `name`, fetched from the Core on first
+        use. A field the Core did not send raises `KeyError`, unless a
+        `default` is given.
+        """
+        self._get_info()
+        value = self._values[self._index[name]]
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(name)
+            return default
+        return value
+
 class SplitAdaptor(BaseAdaptor):
     """
     An Adaptor layer that splits the data into different locations.
@@ -56,52 +188,38 @@ class DomainAdaptor(BaseAdaptor):
     An Adaptor, which does the job of wrapping and unwrapping
     of data b/w the `rest` and `core` layers.
     """
-    def __init__(self, connection, url):
-        self._connection = connection
-        self._url = url
-        self._info = None
-        self.iter_fields = ['base_url', 'mail_host', 'contact_address', 'description']
-
+    fields = ('self_link', 'base_url', 'contact_address', 'description',
+              'mail_host', 'url_host')
+    iter_fields = ('base_url', 'mail_host', 'contact_address', 'description')
 
     def __repr__(self):
         return '<DomainAdaptor "{0}">'.format(self.mail_host)
 
-    def _get_info(self):
-        if self._info is None:
-            response, content = self._connection.call(self._url)
-            self._info = content
-
     @property
     def url(self):
-        self._get_info()
-        return self._info['self_link']
+        return self._get('self_link')
 
     # note: `base_url` property will be renamed to `web_host`
     # in Mailman3Alpha8
     @property
     def base_url(self):
-        self._get_info()
-        return self._info['base_url']
+        return self._get('base_url')
 
     @property
     def contact_address(self):
-        self._get_info()
-        return self._info['contact_address']
+        return self._get('contact_address')
 
     @property
     def description(self):
-        self._get_info()
-        return self._info['description']
+        return self._get('description')
 
     @property
     def mail_host(self):
-        self._get_info()
-        return self._info['mail_host']
+        return self._get('mail_host')
 
     @property
     def url_host(self):
-        self._get_info()
-        return self._info['url_host']
+        return self._get('url_host')
 
     @property
     def lists(self):
@@ -109,7 +227,7 @@ class DomainAdaptor(BaseAdaptor):
             'domains/{0}/lists'.format(self.mail_host))
         if 'entries' not in content:
             return []
-        return [ListAdaptor(self._connection, entry['self_link'])
+        return [ListAdaptor(self._connection, entry['self_link'], data=entry)
                 for entry in sorted(content['entries'],
                                     key=itemgetter('fqdn_listname'))]
 
@@ -128,27 +246,18 @@ class DomainAdaptor(BaseAdaptor):
         else:
             for entry in content['entries']:
                 if entry['list_name'] == listname:
-                    return ListAdaptor(self._connection, entry['self_link'])
+                    return ListAdaptor(self._connection, entry['self_link'], data=entry)
 
 
 class AddressAdaptor(BaseAdaptor):
-    def __init__(self, connection, url):
-        self._connection = connection
-        self._url = url
-        self._info = {}
+    fields = ('self_link', 'display_name', 'registered_on', 'verified_on', 'email')
 
     def __repr__(self):
         return '<AddressAdaptor {0}>'.format(self.email)
 
-    def _get_info(self):
-        if not self._info:
-            response, content = self._connection.call(self._url)
-            self._info = content
-
     @property
     def url(self):
-        self._get_info()
-        return self._info['self_link']
+        return self._get('self_link')
 
     @property
     def display_name(self):
@@ -156,45 +265,48 @@ class AddressAdaptor(BaseAdaptor):
         Will only be available for addresses
         associated with users.
         """
-        self._get_info()
-        return self._info.get('display_name')
+        return self._get('display_name', None)
 
     @property
     def registered_on(self):
-        self._get_info()
-        return self._info.get('registered_on')
+        return self._get('registered_on', None)
 
     @property
     def verified_on(self):
-        self._get_info()
-        return self._info.get('verified_on')
+        return self._get('verified_on', None)
 
     @property
     def email(self):
-        self._get_info()
-        return self._info.get('email')
+        return self._get('email', None)
 
     def verify(self):
         self._connection.call('addresses/{0}/verify'
-                              .format(self._info['email']), method='POST')
-        self._info = None
+                              .format(self._get('email')), method='POST')
+        self._set_info(None)
 
     def unverify(self):
         self._connection.call('addresses/{0}/unverify'
-                              .format(self._info['email']), method='POST')
-        self._info = None
+                              .format(self._get('email')), method='POST')
+        self._set_info(None)
 
 
 class UserAdaptor(BaseAdaptor):
-    def __init__(self, connection, url):
-        self.connection = connection
+    __slots__ = ('_addresses', '_subscriptions', '_subscription_list_ids',
+                 '_preferences', '_cleartext_password', '_display_name')
+    fields = ('self_link', 'user_id', 'display_name', 'password', 'created_on')
+    iter_fields = ('display_name',)
+
+    def __init__(self, connection, url, data=None):
+        self._connection = connection
         self._url = url
-        self._info = {}
+        self._set_info(data)
         self._addresses = None
         self._subscriptions = None
         self._subscription_list_ids = None
         self._preferences = None
         self._cleartext_password = None
+        # Set locally until saved, without fetching the user first.
+        self._display_name = _MISSING
 
     @property
     def reverse_lookup_field(self):
@@ -204,33 +316,40 @@ class UserAdaptor(BaseAdaptor):
         return '<UserAdaptor "{0}" ({1})>'.format(
             self.display_name, self.user_id)
 
-    def _get_info(self):
-        if not self._info:
-            response, content = self.connection.call(self._url)
-            self._info = content
+    @property
+    def connection(self):
+        return self._connection
+
+    @connection.setter
+    def connection(self, value):
+        self._connection = value
 
     @property
     def url(self):
-        self._get_info()
-        return self._info['self_link']
+        return self._get('self_link')
 
-    #@property
-    #def addresses(self):
-    #    return Addresses(self.connection, self.user_id)
+    @property
+    def addresses(self):
+        """The email addresses of the user."""
+        if self._addresses is None:
+            path = 'users/{0}/addresses'.format(self.user_id)
+            self._addresses = [entry['email']
+                               for entry in iterate_entries(self.connection, path)]
+        return self._addresses
 
     @property
     def display_name(self):
-        self._get_info()
-        return self._info.get('display_name', None)
+        if self._display_name is not _MISSING:
+            return self._display_name
+        return self._get('display_name', None)
 
     @display_name.setter
     def display_name(self, value):
-        self._info['display_name'] = value
+        self._display_name = value
 
     @property
     def password(self):
-        self._get_info()
-        return self._info.get('password', None)
+        return self._get('password', None)
 
     @password.setter
     def password(self, value):
@@ -238,33 +357,20 @@ class UserAdaptor(BaseAdaptor):
 
     @property
     def user_id(self):
-        self._get_info()
-        return self._info['user_id']
+        return self._get('user_id')
 
     @property
     def created_on(self):
-        self._get_info()
-        return self._info['created_on']
+        return self._get('created_on')
 
     @property
     def self_link(self):
-        self._get_info()
-        return self._info['self_link']
+        return self._get('self_link')
 
     @property
     def subscriptions(self):
         if self._subscriptions is None:
-            subscriptions = []
-            for address in self.addresses:
-                response, content = self.connection.call('members/find',
-                    data={'subscriber': address})
-                try:
-                    for entry in content['entries']:
-                        subscriptions.append(MembershipAdaptor(self.connection,
-                            entry['self_link']))
-                except KeyError:
-                    pass
-            self._subscriptions = subscriptions
+            self._subscriptions = find_subscriptions(self.connection, self.addresses)
         return self._subscriptions
 
     @property
@@ -285,15 +391,16 @@ class UserAdaptor(BaseAdaptor):
 
     def save(self, data={}):
         if data:
-            del data['email']
+            data.pop('email', None)
         if not data:
             data = {'display_name': self.display_name}
         if self._cleartext_password is not None:
             data['cleartext_password'] = self._cleartext_password
-        self.cleartext_password = None
+        self._cleartext_password = None
         response, content = self.connection.call(self._url,
                                                   data, method='PATCH')
-        self._info = None
+        self._display_name = _MISSING
+        self._set_info(None)
 
     def delete(self):
         response, content = self.connection.call(self._url, method='DELETE')
@@ -310,11 +417,15 @@ PREFERENCE_FIELDS = (
 
 
 class PreferencesAdaptor(BaseAdaptor):
-    def __init__(self, connection, url):
+    __slots__ = ('_preferences', 'delivery_mode')
+
+    def __init__(self, connection, url, data=None):
         self._connection = connection
         self._url = url
         self._preferences = None
         self.delivery_mode = None
+        if data is not None:
+            self._set_preferences(data)
         self._get_preferences()
 
     @property
@@ -327,10 +438,14 @@ class PreferencesAdaptor(BaseAdaptor):
 
     def _get_preferences(self):
         if self._preferences is None:
+            record_lazy_load(self)
             response, content = self._connection.call(self._url)
-            self._preferences = content
-            for key in PREFERENCE_FIELDS:
-                self._preferences[key] = content.get(key)
+            self._set_preferences(content)
+
+    def _set_preferences(self, content):
+        self._preferences = content
+        for key in PREFERENCE_FIELDS:
+            self._preferences[key] = content.get(key)
 
     def __setitem__(self, key, value):
         self._preferences[key] = value
@@ -363,25 +478,16 @@ class PreferencesAdaptor(BaseAdaptor):
 
 
 class ListAdaptor(BaseAdaptor):
-    def __init__(self, connection, url, data=None):
-        self._connection = connection
-        self._url = url
-        self._info = None
-        if data is not None:
-            self._info = data
+    fields = ('self_link', 'fqdn_listname', 'mail_host', 'list_id', 'list_name',
+              'display_name')
+    iter_fields = ('list_name', 'mail_host', 'fqdn_listname', 'display_name', 'domain')
 
     def __repr__(self):
         return '<ListAdaptor "{0}">'.format(self.fqdn_listname)
 
-    def _get_info(self):
-        if self._info is None:
-            response, content = self._connection.call(self._url)
-            self._info = content
-
     @property
     def url(self):
-        self._get_info()
-        return self._info['self_link']
+        return self._get('self_link')
 
 
     @property
@@ -404,39 +510,40 @@ class ListAdaptor(BaseAdaptor):
 
     @property
     def fqdn_listname(self):
-        self._get_info()
-        return self._info['fqdn_listname']
+        return self._get('fqdn_listname')
 
     @property
     def mail_host(self):
-        self._get_info()
-        return self._info['mail_host']
+        return self._get('mail_host')
 
     @property
     def list_id(self):
-        self._get_info()
-        return self._info['list_id']
+        return self._get('list_id')
 
     @property
     def list_name(self):
-        self._get_info()
-        return self._info['list_name']
+        return self._get('list_name')
 
     @property
     def display_name(self):
-        self._get_info()
-        return self._info.get('display_name')
+        return self._get('display_name', None)
+
+    @property
+    def domain(self):
+        return DomainAdaptor(self._connection, 'domains/{0}'.format(self.mail_host))
 
     @property
     def members(self):
         url = 'lists/{0}/roster/member'.format(self.fqdn_listname)
-        response, content = self._connection.call(url)
-        if 'entries' not in content:
-            return []
-        return [MembershipAdaptor(self._connection, entry['self_link'])
-                for entry in sorted(content['entries'],
+        return [MembershipAdaptor(self._connection, entry['self_link'], data=entry)
+                for entry in sorted(iterate_entries(self._connection, url),
                                     key=itemgetter('address'))]
 
+    def iter_members(self):
+        """Yield the members, in the order of the Core, a page at a time."""
+        url = 'lists/{0}/roster/member'.format(self.fqdn_listname)
+        return iterate_collection(self._connection, url, MembershipAdaptor)
+
     def get_member_page(self, count=50, page=1):
         url = 'lists/{0}/roster/member'.format(self.fqdn_listname)
         return _Page(self._connection, url, MembershipAdaptor, count, page)
@@ -545,21 +652,30 @@ class ListAdaptor(BaseAdaptor):
         """
         return self.moderate_message(request_id, 'accept')
 
+    def find_member(self, address, role='member'):
+        """Look a membership up with `members/find`.
+
+        :param address: The email address of the member for this list.
+        :param role: The role of the membership.
+        :return: A member proxy object, or None.
+        """
+        response, content = self._connection.call('members/find', data={
+            'list_id': self.list_id, 'subscriber': address, 'role': role})
+        entries = content.get('entries', []) if isinstance(content, dict) else []
+        for entry in entries:
+            return MembershipAdaptor(self._connection, entry['self_link'], data=entry)
+
     def get_member(self, address):
         """Get a membership.
 
         :param address: The email address of the member for this list.
         :return: A member proxy object.
         """
-        # In order to get the member object we need to
-        # iterate over the existing member list
-        for member in self.members:
-            if member.address == address:
-                return member
-                break
-        else:
+        member = self.find_member(address)
+        if member is None:
             raise ValueError('%s is not a member address of %s' %
                              (address, self.fqdn_listname))
+        return member
 
     def subscribe(self, address, display_name=None):
         """Subscribe an email address to a mailing list.
@@ -583,16 +699,8 @@ class ListAdaptor(BaseAdaptor):
 
         :param address: The address to unsubscribe.
         """
-        # In order to get the member object we need to
-        # iterate over the existing member list
-
-        for member in self.members:
-            if member.address == address:
-                self._connection.call(member.self_link, method='DELETE')
-                break
-        else:
-            raise ValueError('%s is not a member address of %s' %
-                             (address, self.fqdn_listname))
+        member = self.get_member(address)
+        self._connection.call(member.self_link, method='DELETE')
 
     def delete(self):
         response, content = self._connection.call(
@@ -609,10 +717,12 @@ LIST_READ_ONLY_ATTRS = ('bounces_address', 'created_at', 'digest_last_sent_at',
                         'volume', 'web_host',)
 
 class SettingsAdaptor(BaseAdaptor):
-    def __init__(self, connection, url):
+    __slots__ = ('_info',)
+
+    def __init__(self, connection, url, data=None):
         self._connection = connection
         self._url = url
-        self._info = {}
+        self._info = data or {}
         self._get_info()
 
     def __repr__(self):
@@ -620,6 +730,7 @@ class SettingsAdaptor(BaseAdaptor):
 
     def _get_info(self):
         if not self._info:
+            record_lazy_load(self)
             response, content = self._connection.call(self._url)
             self._info = content
 
@@ -667,27 +778,24 @@ class MembershipAdaptor(BaseAdaptor):
     A Membership is represented as Members, Moderators or Owners
     in the Core's Roster.
     """
-    iter_fields = ['list_id', 'partial_url', 'role', 'user', 'preferences']
+    __slots__ = ('_preferences',)
+    fields = ('self_link', 'list_id', 'address', 'role', 'user')
+    iter_fields = ('list_id', 'partial_url', 'role', 'user', 'preferences')
+    lazy_fields = ('preferences',)
 
-    def __init__(self, connection, url):
+    def __init__(self, connection, url, data=None):
         self._connection = connection
         self._url = url
-        self._info = {}
+        self._set_info(data)
         self._preferences = None
 
     def __repr__(self):
         return '<MembershipAdaptor "{0}" on "{1}">'.format(
             self.address, self.list_id)
 
-    def _get_info(self):
-        if not self._info:
-            response, content = self._connection.call(self._url)
-            self._info = content
-
     @property
     def url(self):
-        self._get_info()
-        return self._info['self_link']
+        return self._get('self_link')
 
     @property
     def partial_url(self):
@@ -696,28 +804,23 @@ class MembershipAdaptor(BaseAdaptor):
 
     @property
     def list_id(self):
-        self._get_info()
-        return self._info['list_id']
+        return self._get('list_id')
 
     @property
     def address(self):
-        self._get_info()
-        return self._info['address']
+        return self._get('address')
 
     @property
     def self_link(self):
-        self._get_info()
-        return self._info['self_link']
+        return self._get('self_link')
 
     @property
     def role(self):
-        self._get_info()
-        return self._info['role']
+        return self._get('role')
 
     @property
     def user(self):
-        self._get_info()
-        return UserAdaptor(self._connection, self._info['user'])
+        return UserAdaptor(self._connection, self._get('user'))
 
     @property
     def preferences(self):
@@ -747,3 +850,64 @@ class ModeratorAdaptor(MembershipAdaptor):
     def __repr__(self):
         return '<ModeratorAdaptor "{0}" on "{1}">'.format(
             self.address, self.list_id)
+
+
+class _Page(object):
+    """
+    One page of a Core collection, as adaptors.
+
+    :param connection: The connection to the Core.
+    :param path: The path of the collection.
+    :param model: The adaptor class of its entries.
+    :param count: Number of entries per page.
+    :param page: Number of the page, from 1.
+    """
+
+    def __init__(self, connection, path, model, count=50, page=1):
+        self._connection = connection
+        self._path = path
+        self._model = model
+        self._count = count
+        self._page = page
+        response, content = connection.call(paged_path(path, count, page))
+        if not isinstance(content, dict):
+            content = {}
+        self.total_size = content.get('total_size', 0)
+        self._entries = [model(connection, entry['self_link'], data=entry)
+                         for entry in content.get('entries', [])]
+
+    def __repr__(self):
+        return '<Page {0} ({1})>'.format(self._page, self._model.__name__)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __getitem__(self, key):
+        return self._entries[key]
+
+    @property
+    def nr(self):
+        return self._page
+
+    @property
+    def has_previous(self):
+        return self._page > 1
+
+    @property
+    def has_next(self):
+        return self._count * self._page < self.total_size
+
+    @property
+    def previous(self):
+        if self.has_previous:
+            return _Page(self._connection, self._path, self._model, self._count,
+                         self._page - 1)
+
+    @property
+    def next(self):
+        if self.has_next:
+            return _Page(self._connection, self._path, self._model, self._count,
+                         self._page + 1)
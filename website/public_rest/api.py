@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import logging
+import time
 from operator import itemgetter
 from urlparse import urljoin, urlsplit
 
@@ -8,6 +9,12 @@ from django.core.exceptions import FieldError
 from django.db.models.loading import get_model
 
 from public_rest.adaptors import *
+from public_rest.breaker import endpoint_family, get_breaker
+from public_rest.cache import get_cache
+from public_rest import fanout, instrumentation, metrics
+from public_rest.pool import get_pool
+from public_rest.singleflight import get_group
+from public_rest.utils import core_path_template, core_relative_path
 
 __version__ = '0.1'
 
@@ -15,10 +22,26 @@ __version__ = '0.1'
 logger = logging.getLogger('api_http')
 
 
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+# Core endpoints that take a POST but do not change anything.
+READ_ONLY_PATHS = ('members/find',)
+
+
 class MailmanConnectionError(Exception):
     """Custom exception to catch Connection errors"""
     pass
 
+class CircuitOpenError(MailmanConnectionError):
+    """The call was refused at once, since the Core is failing.
+
+    `retry_at` is the time (as from `time.time()`) at which the circuit
+    lets calls through again, if known.
+    """
+
+    def __init__(self, message, retry_at=None):
+        super(CircuitOpenError, self).__init__(message)
+        self.retry_at = retry_at
+
 class Connection(object):
     """A connection to the REST client."""
 
@@ -50,8 +73,25 @@ class Connection(object):
         else:
             auth = '{0}:{1}'.format(self.name, self.password)
             self.basic_auth = b64encode(auth)
+        # Keep-alive connections are shared by every Connection
+        # talking to the same base url.
+        self.pool = get_pool(self.base_url)
+        # GET responses are cached, and invalidated by our own writes.
+        self.cache = get_cache(self.base_url)
+        # Concurrent identical GETs share a single request.
+        self.flights = get_group(self.base_url)
+
+    def pool_stats(self):
+        """Hits, waits and new connections of the underlying pool."""
+        return self.pool.stats()
+
+    def singleflight_stats(self):
+        """GETs asked for, and how many of them shared another request."""
+        if self.flights is None:
+            return None
+        return self.flights.stats()
 
-    def call(self, path, data=None, method=None):
+    def call(self, path, data=None, method=None, use_cache=True, cache_post=False):
         """Make a call to the Mailman REST API.
 
         :param path: The url path to the resource.
@@ -61,15 +101,74 @@ class Connection(object):
         :param method: The HTTP method to call.  Defaults to GET when `data`
             is None or POST if `data` is given.
         :type method: str
+        :param use_cache: Whether a GET may be answered from the cache.
+        :type use_cache: bool
+        :param cache_post: Whether a read-only POST, like `members/find`,
+            is cached as well. Only for callers that can live with an
+            answer as old as its TTL: other processes changing the Core
+            do not invalidate it.
+        :type cache_post: bool
         :return: The response content, which will be None, a dictionary, or a
             list depending on the actual JSON type returned.
         :rtype: None, list, dict
         :raises HTTPError: when a non-2xx status code is returned.
         """
+        url, data, method, headers = self.prepare(path, data, method)
+        endpoint = core_path_template(url)
+        answer, cached, cache_result, breaker = self.before_request(url, method, headers,
+                                                                   use_cache, data, cache_post)
+        if answer is not None:
+            return answer
+        started = time.time()
+        status = 'error'
+        shared = False
+        try:
+            logger.debug('url: {0}, base_url: {1}, path: {2}'.format(url, self.base_url, path))
+            cache_key = self.cache_key(url, method, data, cache_post)
+            if cache_key is not None and self.flights is not None:
+                # Unless the request is made here, the response (or the
+                # error) is the one of another caller.
+                made = []
+                def request():
+                    made.append(True)
+                    return self.pool.request(url, method, data, headers)
+                # The validator is part of the key: a 304 is only an
+                # answer for the callers holding that cached entry.
+                key = (cache_key, headers.get('If-None-Match'))
+                try:
+                    response, content = self.flights.do(key, request)
+                finally:
+                    shared = not made
+            else:
+                response, content = self.pool.request(url, method, data, headers)
+            status = response.status
+            answer, revalidated = self.handle_response(url, method, response, content, cached,
+                                                       store=not shared, data=data,
+                                                       cache_post=cache_post)
+            if revalidated:
+                cache_result = 'revalidated'
+            return answer
+        except HTTPError:
+            raise
+        except IOError:
+            metrics.CORE_CONNECTION_ERRORS.inc(endpoint=endpoint)
+            raise MailmanConnectionError('Could not connect to Mailman API')
+        finally:
+            self.after_request(url, method, time.time() - started, status, cache_result,
+                               breaker, shared=shared)
+
+    def prepare(self, path, data=None, method=None):
+        """
+        Return the url, encoded data, method and headers of a call, see
+        `call` for the arguments.
+        """
         headers = {
             'User-Agent': 'GNU Mailman REST client v{0}'.format(__version__),
         }
         if data is not None:
+            # Sorted, so that the same data makes the same cache key.
+            if isinstance(data, dict):
+                data = sorted(data.items())
             data = urlencode(data, doseq=True)
             headers['Content-Type'] = 'application/x-www-form-urlencoded'
         if method is None:
@@ -80,23 +179,129 @@ class Connection(object):
         method = method.upper()
         if self.basic_auth:
             headers['Authorization'] = 'Basic ' + self.basic_auth
-        url = urljoin(self.base_url, path)
-        try:
-            logger.debug('url: {0}, base_url: {1}, path: {2}'.format(url, self.base_url, path))
-            response, content = Http().request(url, method, data, headers)
-            # If we did not get a 2xx status code, make this look like a
-            # urllib2 exception, for backward compatibility.
-            if response.status // 100 != 2:
-                raise HTTPError(url, response.status, content, response, None)
-            if len(content) == 0:
-                return response, None
-            # XXX Work around for http://bugs.python.org/issue10038
-            content = unicode(content)
-            return response, json.loads(content)
-        except HTTPError:
-            raise
-        except IOError:
-            raise MailmanConnectionError('Could not connect to Mailman API')
+        return urljoin(self.base_url, path), data, method, headers
+
+    def cache_key(self, url, method, data=None, cache_post=False):
+        """
+        The key of the cached answer to a call, or None if it can not be
+        cached. GETs are keyed by their url. Read-only POSTs such as
+        `members/find` are only cached with `cache_post`, keyed by their
+        url and encoded data.
+        """
+        if method == 'GET':
+            return url
+        if method == 'POST' and cache_post and not self.is_write(url, method):
+            return '{0}?{1}'.format(url, data or '')
+        return None
+
+    def before_request(self, url, method, headers, use_cache=True, data=None,
+                       cache_post=False):
+        """
+        Look the call up in the cache and in its circuit breaker.
+
+        :return: `(answer, cached, cache_result, breaker)`, where `answer`
+            is the `(response, content)` to return without a request, if
+            any. `If-None-Match` is added to `headers` for a stale entry.
+        :raises CircuitOpenError: when the circuit is open, and there is
+            no cached answer.
+        """
+        endpoint = core_path_template(url)
+        cached = None
+        cache_result = None
+        key = self.cache_key(url, method, data, cache_post)
+        if key is not None and self.cache is not None and use_cache:
+            cache_result = 'miss'
+            cached = self.cache.get(key)
+            if cached is not None:
+                if cached.is_fresh:
+                    metrics.CORE_CACHE.inc(result='hit')
+                    instrumentation.record_core_call(method, url, 0.0, cached=True)
+                    answer = cached.response, self._decode(cached.content)
+                    return answer, cached, cache_result, None
+                if cached.etag and method == 'GET':
+                    headers['If-None-Match'] = cached.etag
+        breaker = get_breaker(self.base_url, endpoint_family(url))
+        if breaker is not None and not breaker.allow():
+            if cached is not None:
+                # A stale answer beats none while the Core is out.
+                metrics.CORE_CACHE.inc(result='stale')
+                return (cached.response, self._decode(cached.content)), cached, None, None
+            metrics.CORE_CIRCUIT_OPEN.inc(endpoint=endpoint)
+            raise CircuitOpenError('Mailman API is failing, not calling {0}'.format(endpoint),
+                                   retry_at=breaker.recovers_at())
+        return None, cached, cache_result, breaker
+
+    def handle_response(self, url, method, response, content, cached=None, store=True,
+                        data=None, cache_post=False):
+        """
+        Decode the response to a request, caching it if `store` is True.
+
+        :return: `((response, content), revalidated)`.
+        :raises HTTPError: when a non-2xx status code is returned.
+        """
+        if response.status == 304 and cached is not None:
+            self.cache.revalidated(cached)
+            return (cached.response, self._decode(cached.content)), True
+        # If we did not get a 2xx status code, make this look like a
+        # urllib2 exception, for backward compatibility.
+        if response.status // 100 != 2:
+            raise HTTPError(url, response.status, content, response, None)
+        rv = self._decode(content)
+        key = self.cache_key(url, method, data, cache_post)
+        if key is not None and self.cache is not None and store:
+            etag = rv.get('http_etag') if isinstance(rv, dict) else None
+            self.cache.set(key, response, content, etag=etag)
+        return (response, rv), False
+
+    def after_request(self, url, method, duration, status, cache_result=None, breaker=None,
+                      shared=False):
+        """Record the outcome of a request, made here unless `shared`."""
+        endpoint = core_path_template(url)
+        instrumentation.record_core_call(method, url, duration)
+        if cache_result is not None:
+            metrics.CORE_CACHE.inc(result=cache_result)
+        if shared:
+            # The outcome of the request is counted by the caller
+            # that made it.
+            metrics.CORE_COALESCED.inc(endpoint=endpoint)
+        else:
+            metrics.CORE_CALL_DURATION.observe(duration, method=method, endpoint=endpoint)
+            metrics.CORE_CALLS.inc(method=method, endpoint=endpoint, status=status)
+        if breaker is not None and not shared:
+            if status == 'error' or status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        if self.is_write(url, method):
+            if self.cache is not None:
+                self.cache.invalidate(url)
+            if self.flights is not None:
+                self.flights.invalidate()
+
+    def call_many(self, paths, data=None, method=None, use_cache=True):
+        """Make the calls to `paths` in parallel.
+
+        :param paths: The url paths of the resources.
+        :type paths: list
+        :param data: Data sent with each call, see `call`.
+        :return: The `(response, content)` of each call, in order.
+        :rtype: list
+        :raises HTTPError: when a call gets a non-2xx status code.
+        """
+        return fanout.run_parallel(
+            [lambda path=path: self.call(path, data=data, method=method, use_cache=use_cache)
+             for path in paths])
+
+    def is_write(self, url, method):
+        return (method in WRITE_METHODS and
+                core_relative_path(url) not in READ_ONLY_PATHS)
+
+    def _decode(self, content):
+        if len(content) == 0:
+            return None
+        # XXX Work around for http://bugs.python.org/issue10038
+        content = unicode(content)
+        return json.loads(content)
 
 
 class CoreInterface(object):
@@ -117,18 +322,19 @@ class CoreInterface(object):
 
     @property
     def users(self):
-        response, content = self.connection.call('users')
-        if 'entries' not in content:
-            return []
-        return [UserAdaptor(self.connection, entry['self_link'])
-                for entry in sorted(content['entries'],
+        return [UserAdaptor(self.connection, entry['self_link'], data=entry)
+                for entry in sorted(iterate_entries(self.connection, 'users'),
                                     key=itemgetter('self_link'))]
 
+    def iter_users(self):
+        """Yield the users, in the order of the Core, a page at a time."""
+        return iterate_collection(self.connection, 'users', UserAdaptor)
+
     def get_user(self, email=None):
         if email is not None:
             response, content = self.connection.call(
                 'users/{0}'.format(email))
-            return UserAdaptor(self.connection, content['self_link'])
+            return UserAdaptor(self.connection, content['self_link'], data=content)
 
     def create_user(self, email, password, display_name=''):
         response, content = self.connection.call(
@@ -138,27 +344,28 @@ class CoreInterface(object):
 
     @property
     def lists(self):
-        response, content = self.connection.call('lists')
-        if 'entries' not in content:
-            return []
-        return [ListAdaptor(self.connection, entry['self_link'])
-                for entry in content['entries']]
+        return list(self.iter_lists())
+
+    def iter_lists(self):
+        """Yield the mailing lists, a page at a time."""
+        return iterate_collection(self.connection, 'lists', ListAdaptor)
 
     @property
     def domains(self):
-        response, content = self.connection.call('domains')
-        if 'entries' not in content:
-            return []
-        return [DomainAdaptor(self.connection, entry['self_link'])
-                        for entry in sorted(content['entries'],
+        return [DomainAdaptor(self.connection, entry['self_link'], data=entry)
+                        for entry in sorted(iterate_entries(self.connection, 'domains'),
                                     key=itemgetter('url_host'))]
 
+    def iter_domains(self):
+        """Yield the domains, in the order of the Core, a page at a time."""
+        return iterate_collection(self.connection, 'domains', DomainAdaptor)
+
     def get_domain(self, mail_host=None, web_host=None):
         """Get domain by its mail_host or its web_host."""
         if mail_host is not None:
             response, content = self.connection.call(
                 'domains/{0}'.format(mail_host))
-            return DomainAdaptor(self.connection, content['self_link'])
+            return DomainAdaptor(self.connection, content['self_link'], data=content)
         elif web_host is not None:
             for domain in self.domains:
                 # note: `base_url` property will be renamed to `web_host`
@@ -173,20 +380,20 @@ class CoreInterface(object):
         if address is not None:
             response, content = self.connection.call(
                     'addresses/{0}'.format(address))
-            return AddressAdaptor(self.connection, content['self_link'])
+            return AddressAdaptor(self.connection, content['self_link'], data=content)
 
 
     def get_listsettings(self, fqdn_listname):
         if fqdn_listname is not None:
             endpoint = 'lists/{0}/config'.format(fqdn_listname)
             response, content = self.connection.call(endpoint)
-            return SettingsAdaptor(self.connection, endpoint)
+            return SettingsAdaptor(self.connection, endpoint, data=content)
 
     def get_mailinglist(self, fqdn_listname):
         if fqdn_listname is not None:
             response, content = self.connection.call(
                 'lists/{fqdn_listname}'.format(fqdn_listname=fqdn_listname))
-            return ListAdaptor(self.connection, content['self_link'])
+            return ListAdaptor(self.connection, content['self_link'], data=content)
 
     def get_membership(self, address, list_id):
         """Return a given membership subscription on a list."""
@@ -197,7 +404,7 @@ class CoreInterface(object):
                     'members/find', data={'subscriber': address, 'list_id': list_id})
             if content['total_size'] == 1:
                 for entry in content['entries']:
-                    return MembershipAdaptor(self.connection, entry['self_link'])
+                    return MembershipAdaptor(self.connection, entry['self_link'], data=entry)
 
     def get_memberships_by_address(self, address):
         """
@@ -207,7 +414,7 @@ class CoreInterface(object):
             response, content = self.connection.call(
                     'members/find', data={'subscriber': address})
             if content['total_size'] > 0:
-                return [MembershipAdaptor(self.connection, entry['self_link'])
+                return [MembershipAdaptor(self.connection, entry['self_link'], data=entry)
                         for entry in content['entries']]
             else:
                 return []
@@ -219,24 +426,24 @@ class CoreInterface(object):
         if fqdn_listname is not None:
             s = 'lists/{0}'.format(fqdn_listname)
 
-            res, member_content = self.connection.call('{0}/roster/member'.format(s))
-            res, mod_content = self.connection.call('{0}/roster/moderator'.format(s))
-            res, owner_content = self.connection.call('{0}/roster/owner'.format(s))
+            (res, member_content), (res, mod_content), (res, owner_content) = \
+                self.connection.call_many(['{0}/roster/{1}'.format(s, role)
+                                           for role in ('member', 'moderator', 'owner')])
 
             if member_content['total_size'] > 0:
-                members = [MembershipAdaptor(self.connection, entry['self_link'])
+                members = [MembershipAdaptor(self.connection, entry['self_link'], data=entry)
                         for entry in member_content['entries']]
             else:
                 members = []
 
             if mod_content['total_size'] > 0:
-                mods = [MembershipAdaptor(self.connection, entry['self_link'])
+                mods = [MembershipAdaptor(self.connection, entry['self_link'], data=entry)
                         for entry in mod_content['entries']]
             else:
                 mods = []
 
             if owner_content['total_size'] > 0:
-                owners = [MembershipAdaptor(self.connection, entry['self_link'])
+                owners = [MembershipAdaptor(self.connection, entry['self_link'], data=entry)
                         for entry in owner_content['entries']]
             else:
                 owners = []
@@ -275,8 +482,8 @@ class CoreInterface(object):
         """
         Get all objects and return an adaptor list.
         """
-        response, content = self.connection.call(urlsplit(url).path)
-        if 'entries' not in content:
+        entries = list(iterate_entries(self.connection, urlsplit(url).path))
+        if not entries:
             return []
         if object_type == 'domain':
             sort_key = itemgetter('url_host')
@@ -285,9 +492,8 @@ class CoreInterface(object):
         else:
             sort_key = None
         model = self.get_model_from_object(object_type)
-        return [model.adaptor(self.connection, entry['self_link'])
-                        for entry in sorted(content['entries'],
-                                    key=sort_key)]
+        return [model.adaptor(self.connection, entry['self_link'], data=entry)
+                        for entry in sorted(entries, key=sort_key)]
 
     def get_api_endpoint(self, object_type, **kwargs):
         """
@@ -371,6 +577,11 @@ class CoreInterface(object):
             response, content = self.connection.call(partial_url, data=data, method='PATCH')
         return adaptor
 
+    def delete_object(self, partial_url):
+        """`DELETE` a remote object."""
+        response, content = self.connection.call(partial_url, method='DELETE')
+        return response
+
     def create_model_from_adaptor(self, model, adaptor):
         """
         Given an adaptor instance, create a model instance,
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Authorization context of a request.
+
+Every permission check used to query the memberships of the requesting
+user again, one role at a time. An `AuthorizationContext` loads the
+`(list id, role)` pairs of a user with a single query, and is memoized
+on the request so that all the policies of that request share it.
+
+With `MAILMAN_AUTHZ_CACHE_TIMEOUT` set to a number of seconds, the pairs
+are also kept in the Django cache across requests. Saving or deleting a
+Membership invalidates the entry of its user.
+"""
+
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.loading import get_model
+from django.db.models.query import QuerySet
+
+logger = logging.getLogger(__name__)
+
+STAFF_ROLES = ('owner', 'moderator')
+
+CACHE_KEY = 'public_rest:authz:{0}'
+
+
+def cache_timeout():
+    return getattr(settings, 'MAILMAN_AUTHZ_CACHE_TIMEOUT', 0)
+
+
+def invalidate(user_id):
+    """Forget the cached memberships of a user."""
+    if user_id is not None and cache_timeout():
+        cache.delete(CACHE_KEY.format(user_id))
+
+
+def invalidate_memberships(memberships):
+    """
+    Forget the cached memberships of every user, or owner of an
+    address, holding one of `memberships`.
+    """
+    if not cache_timeout():
+        return
+    user_ids = set(membership.user_id for membership in memberships)
+    address_ids = set(membership.address_id for membership in memberships)
+    address_ids.discard(None)
+    if address_ids:
+        emails = QuerySet(model=get_model('public_rest', 'Email'))
+        user_ids.update(emails.filter(pk__in=address_ids)
+                              .values_list('user_id', flat=True))
+    cache.delete_many([CACHE_KEY.format(pk) for pk in user_ids if pk is not None])
+
+
+def load_roles(user):
+    """
+    The `(list id, role)` pairs of the memberships of `user`.
+    """
+    if user is None or not user.is_authenticated():
+        return frozenset()
+    timeout = cache_timeout()
+    key = CACHE_KEY.format(user.pk)
+    if timeout:
+        roles = cache.get(key)
+        if roles is not None:
+            return roles
+    # A plain QuerySet: users without any membership are common and must
+    # not make the remote queryset ask the Core.
+    memberships = QuerySet(model=get_model('public_rest', 'Membership'))
+    roles = frozenset(memberships.filter(user=user).values_list('mlist_id', 'role'))
+    if timeout:
+        cache.set(key, roles, timeout)
+    return roles
+
+
+class AuthorizationContext(object):
+    """The roles a user holds, on which lists."""
+
+    def __init__(self, user):
+        self.user = user
+        self.roles = load_roles(user)
+        self.by_role = {}
+        for mlist_id, role in self.roles:
+            self.by_role.setdefault(role, set()).add(mlist_id)
+
+    @property
+    def is_superuser(self):
+        return bool(getattr(self.user, 'is_superuser', False))
+
+    def has_role(self, role, mlist=None):
+        """
+        Whether the user holds `role` on `mlist`, or on any list when
+        `mlist` is None.
+        """
+        if mlist is None:
+            return bool(self.by_role.get(role))
+        return (getattr(mlist, 'pk', mlist), role) in self.roles
+
+    def list_ids(self, *roles):
+        """Ids of the lists on which the user holds one of `roles`."""
+        rv = set()
+        for role in roles:
+            rv.update(self.by_role.get(role, ()))
+        return rv
+
+    def staff_list_ids(self):
+        return self.list_ids(*STAFF_ROLES)
+
+    def is_list_staff(self, mlist):
+        return any(self.has_role(role, mlist) for role in STAFF_ROLES)
+
+
+def get_context(request, user=None):
+    """
+    The authorization context of `user`, by default the requesting
+    user, memoized on `request`.
+    """
+    if user is None:
+        user = request.user
+    # DRF wraps the Django request; memoize on the one both share.
+    request = getattr(request, '_request', request)
+    contexts = request.__dict__.setdefault('_authz_contexts', {})
+    key = getattr(user, 'pk', None)
+    if key not in contexts:
+        contexts[key] = AuthorizationContext(user)
+    return contexts[key]
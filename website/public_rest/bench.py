@@ -0,0 +1,755 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the REST API against a fake Mailman Core.
+
+`FakeCore` is a small WSGI application answering the parts of the Core
+REST API this app talks to (`domains`, `lists`, `members`,
+`members/find`, `users`, `addresses`, list `config` and `preferences`)
+from memory, after an optional delay standing in for the network and
+the Core itself. `FakeCoreServer` serves it on a local port, so that
+requests go through the real `api.Connection`, pool and cache.
+
+A `Benchmark` mirrors the fake dataset into the local database, then
+runs each `Scenario` a number of times through the Django test client,
+and measures the latency, the Core calls and the database queries of
+every request. The `bench` management command runs it on a throwaway
+test database and writes the results as JSON, to compare runs.
+
+`measure_adaptors` measures the adaptors themselves: the time it takes
+to build many of them, and the memory each one holds.
+"""
+
+import itertools
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+import django
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connection, reset_queries
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from public_rest.api import Connection
+from public_rest.interface import ci
+
+logger = logging.getLogger(__name__)
+
+API_ROOT = '/3.0/'
+
+PREFERENCE_DEFAULTS = dict(acknowledge_posts=False, delivery_mode='regular',
+                           delivery_status='enabled', hide_address=True,
+                           preferred_language='en', receive_list_copy=True,
+                           receive_own_postings=True)
+
+
+class CoreError(Exception):
+
+    def __init__(self, status, reason):
+        super(CoreError, self).__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class FakeCore(object):
+    """
+    An in-memory stand-in for the Mailman Core REST API, as a WSGI
+    application.
+
+    :param latency: Seconds every request is delayed by.
+    """
+    STATUS = {200: '200 OK', 201: '201 Created', 204: '204 No Content',
+              400: '400 Bad Request', 404: '404 Not Found', 405: '405 Method Not Allowed',
+              409: '409 Conflict'}
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        # Links are absolute, like the Core's; set once the port is known.
+        self.base_url = 'http://localhost:8001'
+        self.lock = threading.RLock()
+        self.domains = OrderedDict()
+        self.lists = OrderedDict()
+        self.configs = {}
+        self.users = OrderedDict()
+        self.addresses = OrderedDict()
+        self.members = OrderedDict()
+        # (list_id, address, role) of every member
+        self.subscribed = set()
+        self.preferences = {}
+        self.calls = []
+        self._ids = itertools.count(1)
+
+    def link(self, path):
+        return '{0}{1}{2}'.format(self.base_url, API_ROOT, path)
+
+    def call_count(self):
+        with self.lock:
+            return len(self.calls)
+
+    # Dataset
+
+    def add_domain(self, mail_host, description=u'', contact_address=None):
+        with self.lock:
+            if mail_host in self.domains:
+                raise CoreError(409, 'Duplicate email host: {0}'.format(mail_host))
+            self.domains[mail_host] = dict(
+                mail_host=mail_host, base_url=u'http://{0}'.format(mail_host),
+                url_host=mail_host, description=description,
+                contact_address=contact_address or u'postmaster@{0}'.format(mail_host))
+            return 'domains/{0}'.format(mail_host)
+
+    def add_list(self, fqdn_listname):
+        with self.lock:
+            if '@' not in fqdn_listname:
+                raise CoreError(400, 'Invalid list posting address')
+            list_name, mail_host = fqdn_listname.split('@', 1)
+            if mail_host not in self.domains:
+                raise CoreError(400, 'Domain does not exist: {0}'.format(mail_host))
+            list_id = u'{0}.{1}'.format(list_name, mail_host)
+            if list_id in self.lists:
+                raise CoreError(400, 'Mailing list exists')
+            self.lists[list_id] = dict(fqdn_listname=fqdn_listname, list_name=list_name,
+                                       mail_host=mail_host, list_id=list_id,
+                                       display_name=list_name.capitalize())
+            self.configs[list_id] = dict(
+                fqdn_listname=fqdn_listname, list_name=list_name, mail_host=mail_host,
+                list_id=list_id, display_name=list_name.capitalize(), description=u'',
+                admin_immed_notify=True, autoresponse_owner_text=u'',
+                posting_address=fqdn_listname,
+                created_at=timezone.now().isoformat())
+            return 'lists/{0}'.format(list_id)
+
+    def add_user(self, email=None, display_name=u'', password=None):
+        with self.lock:
+            if email and self.addresses.get(email, {}).get('user_id'):
+                raise CoreError(400, 'User already exists: {0}'.format(email))
+            user_id = uuid.uuid4().int
+            self.users[user_id] = dict(user_id=user_id, display_name=display_name,
+                                       created_on=timezone.now().isoformat(),
+                                       password=password and '$fake$' or None)
+            if email:
+                self.add_address(email, user_id=user_id)
+            return 'users/{0}'.format(user_id)
+
+    def add_address(self, email, user_id=None, verified=True):
+        with self.lock:
+            address = self.addresses.setdefault(email, dict(
+                email=email, registered_on=timezone.now().isoformat(),
+                verified_on=None, user_id=None))
+            if verified and address['verified_on'] is None:
+                address['verified_on'] = timezone.now().isoformat()
+            if user_id is not None:
+                address['user_id'] = user_id
+            return 'addresses/{0}'.format(email)
+
+    def add_member(self, list_id, email, role='member'):
+        with self.lock:
+            list_id = list_id.replace('@', '.')
+            if list_id not in self.lists:
+                raise CoreError(400, 'No such list')
+            if (list_id, email, role) in self.subscribed:
+                raise CoreError(409, 'Member already subscribed')
+            if self.addresses.get(email, {}).get('user_id') is None:
+                self.add_user(email=email)
+            member_id = next(self._ids)
+            self.members[member_id] = dict(member_id=member_id, list_id=list_id,
+                                           address=email, role=role)
+            self.subscribed.add((list_id, email, role))
+            return 'members/{0}'.format(member_id)
+
+    def remove_member(self, member_id):
+        member = self.members.pop(member_id)
+        self.subscribed.discard((member['list_id'], member['address'], member['role']))
+
+    def populate(self, lists=5, members=100, mail_host='bench.example.com'):
+        """
+        Create a domain with `lists` lists, and `members` users each
+        subscribed to every list.
+        """
+        self.add_domain(mail_host, description=u'Benchmarks')
+        list_ids = []
+        for n in range(lists):
+            list_ids.append(self.add_list(u'list{0}@{1}'.format(n, mail_host)).split('/')[1])
+        for n in range(members):
+            email = u'subscriber{0}@example.org'.format(n)
+            self.add_user(email=email, display_name=u'Subscriber {0}'.format(n))
+            for list_id in list_ids:
+                self.add_member(list_id, email)
+
+    # Representations
+
+    def render_domain(self, domain):
+        rv = dict(domain, self_link=self.link('domains/{0}'.format(domain['mail_host'])))
+        rv['http_etag'] = etag(domain)
+        return rv
+
+    def render_list(self, mlist):
+        rv = dict(mlist, self_link=self.link('lists/{0}'.format(mlist['list_id'])))
+        rv['member_count'] = sum(1 for member in self.members.values()
+                                 if member['list_id'] == mlist['list_id'] and
+                                 member['role'] == 'member')
+        rv['http_etag'] = etag(rv)
+        return rv
+
+    def render_user(self, user):
+        rv = dict(user, self_link=self.link('users/{0}'.format(user['user_id'])))
+        rv['http_etag'] = etag(user)
+        return rv
+
+    def render_address(self, address):
+        rv = dict(email=address['email'], registered_on=address['registered_on'],
+                  verified_on=address['verified_on'],
+                  self_link=self.link('addresses/{0}'.format(address['email'])))
+        if address['user_id'] is not None:
+            rv['user'] = self.link('users/{0}'.format(address['user_id']))
+            rv['display_name'] = self.users[address['user_id']]['display_name']
+        rv['http_etag'] = etag(rv)
+        return rv
+
+    def render_member(self, member):
+        user_id = self.addresses[member['address']]['user_id']
+        rv = dict(address=member['address'], list_id=member['list_id'],
+                  role=member['role'], delivery_mode='regular',
+                  user=self.link('users/{0}'.format(user_id)),
+                  self_link=self.link('members/{0}'.format(member['member_id'])))
+        rv['http_etag'] = etag(rv)
+        return rv
+
+    def render_preferences(self, path):
+        rv = dict(self.preferences.get(path) or PREFERENCE_DEFAULTS,
+                  self_link=self.link(path))
+        rv['http_etag'] = etag(rv)
+        return rv
+
+    def collection(self, entries, query):
+        rv = dict(start=0, total_size=len(entries))
+        try:
+            count = int(query['count'][0])
+            page = int(query.get('page', ['1'])[0])
+        except (KeyError, ValueError):
+            pass
+        else:
+            rv['start'] = (page - 1) * count
+            entries = entries[rv['start']:rv['start'] + count]
+        if entries:
+            rv['entries'] = entries
+        rv['http_etag'] = etag(rv)
+        return rv
+
+    # Lookups
+
+    def get_list(self, key):
+        key = key.replace('@', '.')
+        if key not in self.lists:
+            raise CoreError(404, 'No such list')
+        return self.lists[key]
+
+    def get_user(self, key):
+        if '@' in key:
+            user_id = self.addresses.get(key, {}).get('user_id')
+        else:
+            try:
+                user_id = int(key)
+            except ValueError:
+                user_id = None
+        if user_id not in self.users:
+            raise CoreError(404, 'No such user')
+        return self.users[user_id]
+
+    def get_member(self, member_id):
+        try:
+            return self.members[int(member_id)]
+        except (KeyError, ValueError):
+            raise CoreError(404, 'No such member')
+
+    def find_members(self, query):
+        subscriber = query.get('subscriber', [None])[0]
+        list_id = query.get('list_id', [None])[0]
+        role = query.get('role', [None])[0]
+        if list_id:
+            list_id = list_id.replace('@', '.')
+        return [member for member in self.members.values()
+                if (subscriber is None or member['address'] == subscriber) and
+                (list_id is None or member['list_id'] == list_id) and
+                (role is None or member['role'] == role)]
+
+    # WSGI
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO', '')
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        if method in ('POST', 'PUT', 'PATCH'):
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            data = dict((key, values[-1]) for key, values in
+                        parse_qs(environ['wsgi.input'].read(length)).items())
+        else:
+            data = {}
+        with self.lock:
+            self.calls.append((method, path))
+        if self.latency:
+            time.sleep(self.latency)
+        headers = [('Content-Type', 'application/json')]
+        if not path.startswith(API_ROOT):
+            status, body = 404, dict(title='Not Found')
+        else:
+            segments = [s for s in path[len(API_ROOT):].split('/') if s]
+            try:
+                with self.lock:
+                    status, body = self.dispatch(method, segments, query, data)
+            except CoreError as e:
+                status, body = e.status, dict(title=e.reason)
+        if status == 201:
+            headers.append(('Location', self.link(body)))
+            body = None
+        content = '' if body is None else json.dumps(body)
+        headers.append(('Content-Length', str(len(content))))
+        start_response(self.STATUS[status], headers)
+        return [content]
+
+    def dispatch(self, method, segments, query, data):
+        """Return the `(status, body)` of a request; 201 bodies are paths."""
+        if not segments:
+            raise CoreError(404, 'Not Found')
+        resource, rest = segments[0], segments[1:]
+        handler = getattr(self, 'handle_' + resource, None)
+        if handler is None:
+            raise CoreError(404, 'Not Found')
+        return handler(method, rest, query, data)
+
+    def handle_system(self, method, rest, query, data):
+        return 200, dict(mailman_version='GNU Mailman 3.0 (fake)', api_version='3.0',
+                         self_link=self.link('system'))
+
+    def handle_domains(self, method, rest, query, data):
+        if not rest:
+            if method == 'POST':
+                if not data.get('mail_host'):
+                    raise CoreError(400, 'Missing mail_host')
+                return 201, self.add_domain(data['mail_host'], data.get('description', u''),
+                                            data.get('contact_address'))
+            return 200, self.collection([self.render_domain(domain)
+                                         for domain in self.domains.values()], query)
+        if rest[0] not in self.domains:
+            raise CoreError(404, 'No such domain')
+        domain = self.domains[rest[0]]
+        if rest[1:] == ['lists']:
+            return 200, self.collection([self.render_list(mlist) for mlist in self.lists.values()
+                                         if mlist['mail_host'] == rest[0]], query)
+        if method == 'DELETE':
+            del self.domains[rest[0]]
+            return 204, None
+        return 200, self.render_domain(domain)
+
+    def handle_lists(self, method, rest, query, data):
+        if not rest:
+            if method == 'POST':
+                return 201, self.add_list(data.get('fqdn_listname', u''))
+            return 200, self.collection([self.render_list(mlist)
+                                         for mlist in self.lists.values()], query)
+        mlist = self.get_list(rest[0])
+        list_id = mlist['list_id']
+        if len(rest) == 1:
+            if method == 'DELETE':
+                del self.lists[list_id]
+                for member_id, member in self.members.items():
+                    if member['list_id'] == list_id:
+                        self.remove_member(member_id)
+                return 204, None
+            return 200, self.render_list(mlist)
+        if rest[1] == 'config':
+            config = self.configs[list_id]
+            if method in ('PATCH', 'PUT'):
+                config.update(data)
+                return 204, None
+            rv = dict(config, self_link=self.link('lists/{0}/config'.format(list_id)))
+            rv['http_etag'] = etag(rv)
+            return 200, rv
+        if rest[1] == 'roster' and len(rest) == 3:
+            return 200, self.collection(
+                [self.render_member(member) for member in
+                 self.find_members(dict(list_id=[list_id], role=[rest[2]]))], query)
+        if rest[1] in ('owner', 'moderator', 'member') and len(rest) == 3:
+            found = self.find_members(dict(list_id=[list_id], role=[rest[1]],
+                                           subscriber=[rest[2]]))
+            if not found:
+                raise CoreError(404, 'No such member')
+            if method == 'DELETE':
+                self.remove_member(found[0]['member_id'])
+                return 204, None
+            return 200, self.render_member(found[0])
+        raise CoreError(404, 'Not Found')
+
+    def handle_members(self, method, rest, query, data):
+        if not rest:
+            if method == 'POST':
+                if not data.get('list_id') or not data.get('subscriber'):
+                    raise CoreError(400, 'Missing parameters')
+                return 201, self.add_member(data['list_id'], data['subscriber'],
+                                            data.get('role') or 'member')
+            return 200, self.collection([self.render_member(member)
+                                         for member in self.members.values()], query)
+        if rest[0] == 'find':
+            # A POST, but nothing changes.
+            params = dict((key, [value]) for key, value in data.items())
+            params.update(query)
+            return 200, self.collection([self.render_member(member) for member in
+                                         self.find_members(params)], {})
+        member = self.get_member(rest[0])
+        if rest[1:] == ['preferences']:
+            return self.handle_preferences(method, 'members/{0}/preferences'.format(rest[0]), data)
+        if method == 'DELETE':
+            self.remove_member(member['member_id'])
+            return 204, None
+        if method == 'PATCH':
+            return 204, None
+        return 200, self.render_member(member)
+
+    def handle_users(self, method, rest, query, data):
+        if not rest:
+            if method == 'POST':
+                return 201, self.add_user(email=data.get('email'),
+                                          display_name=data.get('display_name', u''),
+                                          password=data.get('password'))
+            return 200, self.collection([self.render_user(user)
+                                         for user in self.users.values()], query)
+        user = self.get_user(rest[0])
+        if rest[1:] == ['preferences']:
+            return self.handle_preferences(method, 'users/{0}/preferences'.format(user['user_id']),
+                                           data)
+        if rest[1:] == ['addresses']:
+            return 200, self.collection([self.render_address(address)
+                                         for address in self.addresses.values()
+                                         if address['user_id'] == user['user_id']], query)
+        if method == 'DELETE':
+            del self.users[user['user_id']]
+            return 204, None
+        if method in ('PATCH', 'PUT'):
+            if data.get('display_name'):
+                user['display_name'] = data['display_name']
+            if data.get('email'):
+                self.add_address(data['email'], user_id=user['user_id'])
+            return 204, None
+        return 200, self.render_user(user)
+
+    def handle_addresses(self, method, rest, query, data):
+        if not rest:
+            return 200, self.collection([self.render_address(address)
+                                         for address in self.addresses.values()], query)
+        if rest[0] not in self.addresses:
+            raise CoreError(404, 'No such address')
+        address = self.addresses[rest[0]]
+        if rest[1:] == ['preferences']:
+            return self.handle_preferences(method, 'addresses/{0}/preferences'.format(rest[0]),
+                                           data)
+        if rest[1:] in (['verify'], ['unverify']):
+            address['verified_on'] = rest[1] == 'verify' and timezone.now().isoformat() or None
+            return 204, None
+        return 200, self.render_address(address)
+
+    def handle_preferences(self, method, path, data):
+        if method in ('PUT', 'PATCH'):
+            preferences = self.preferences.setdefault(path, dict(PREFERENCE_DEFAULTS))
+            for key in PREFERENCE_DEFAULTS:
+                if key in data:
+                    preferences[key] = data[key]
+            return 204, None
+        return 200, self.render_preferences(path)
+
+
+def etag(data):
+    return '"{0:x}"'.format(hash(json.dumps(data, sort_keys=True, default=unicode)) & 0xffffffff)
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # Room for the connections of a fan-out, opened all at once.
+    request_queue_size = 128
+
+
+class FakeCoreServer(object):
+    """Serves a `FakeCore` on a free local port, in a background thread."""
+
+    def __init__(self, core, host='127.0.0.1', port=0):
+        self.core = core
+        self.server = make_server(host, port, core, server_class=ThreadingWSGIServer,
+                                  handler_class=QuietHandler)
+        self.url = 'http://{0}:{1}'.format(*self.server.server_address)
+        core.base_url = self.url
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Scenarios
+
+class Scenario(object):
+    """
+    A kind of request to measure. `request` makes the `i`th one with
+    `bench.client` and returns the response.
+    """
+    name = None
+    expected_status = (200,)
+
+    def setup(self, bench):
+        pass
+
+    def request(self, bench, i):
+        raise NotImplementedError
+
+
+class CreateList(Scenario):
+    name = 'create_list'
+    expected_status = (201,)
+
+    def request(self, bench, i):
+        return bench.client.post('/api/lists/', data={'list_name': 'created{0}'.format(i),
+                                                      'mail_host': bench.mail_host})
+
+
+class BulkSubscribe(Scenario):
+    name = 'bulk_subscribe'
+
+    def request(self, bench, i):
+        addresses = ['bulk{0}-{1}@example.org'.format(i, n) for n in range(bench.bulk_size)]
+        return bench.client.post('/api/lists/{0}/members/bulk/'.format(bench.mlist.pk),
+                                 data=json.dumps(addresses), content_type='application/json')
+
+
+class RosterListing(Scenario):
+    name = 'roster'
+
+    def request(self, bench, i):
+        return bench.client.get('/api/lists/{0}/members/?page_size={1}'.format(
+            bench.mlist.pk, bench.page_size))
+
+
+class SettingsPatch(Scenario):
+    name = 'settings_patch'
+    expected_status = (204,)
+
+    def request(self, bench, i):
+        return bench.client.patch('/api/lists/{0}/settings/'.format(bench.mlist.pk),
+                                  data={'description': 'Benchmark {0}'.format(i)})
+
+
+class UserDetail(Scenario):
+    name = 'user_detail'
+
+    def setup(self, bench):
+        from public_rest.models import User
+        self.user_ids = list(User.objects.exclude(pk=bench.admin.pk)
+                                         .values_list('pk', flat=True)[:50]) or [bench.admin.pk]
+
+    def request(self, bench, i):
+        return bench.client.get('/api/users/{0}/'.format(self.user_ids[i % len(self.user_ids)]))
+
+
+SCENARIOS = OrderedDict((scenario.name, scenario) for scenario in
+                        (CreateList, BulkSubscribe, RosterListing, SettingsPatch, UserDetail))
+
+
+def percentile(values, p):
+    """The `p`th percentile of sorted `values`, by nearest rank."""
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def summarize(latencies, core_calls, queries, errors):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return OrderedDict([
+        ('requests', n),
+        ('errors', errors),
+        ('latency_ms', OrderedDict([
+            ('mean', ms(sum(latencies) / n) if n else None),
+            ('p50', ms(percentile(latencies, 50)) if n else None),
+            ('p90', ms(percentile(latencies, 90)) if n else None),
+            ('p95', ms(percentile(latencies, 95)) if n else None),
+            ('p99', ms(percentile(latencies, 99)) if n else None),
+            ('max', ms(latencies[-1]) if n else None),
+        ])),
+        ('core_calls_per_request', round(float(sum(core_calls)) / n, 2) if n else None),
+        ('core_calls_max', max(core_calls) if n else None),
+        ('queries_per_request', round(float(sum(queries)) / n, 2) if n else None),
+        ('queries_max', max(queries) if n else None),
+    ])
+
+
+class Benchmark(object):
+    """
+    Runs scenarios against a `FakeCore`. The database has to be a
+    throwaway one: the fake dataset is mirrored into it.
+
+    :param core: The FakeCore, already populated.
+    :param iterations: Measured requests per scenario.
+    :param warmup: Requests made before measuring, per scenario.
+    :param bulk_size: Addresses per bulk subscription.
+    :param page_size: Members per roster page.
+    """
+    admin_name = 'Bench Admin'
+    admin_password = 'bench'
+
+    def __init__(self, core, iterations=50, warmup=5, bulk_size=50, page_size=50):
+        self.core = core
+        self.iterations = iterations
+        self.warmup = warmup
+        self.bulk_size = bulk_size
+        self.page_size = page_size
+        self.server = None
+        self.client = None
+        self.dataset = None
+
+    def __enter__(self):
+        self.server = FakeCoreServer(self.core).start()
+        self._settings = override_settings(MAILMAN_API_URL=self.server.url)
+        self._settings.enable()
+        self._connection = ci.connection
+        ci.connection = Connection(base_url=self.server.url + API_ROOT)
+        return self
+
+    def __exit__(self, *exc_info):
+        ci.connection = self._connection
+        self._settings.disable()
+        self.server.stop()
+
+    def setup(self):
+        """Mirror the Core dataset locally and log in an administrator."""
+        from public_rest.models import MailingList, User
+        from public_rest.reconcile import Reconciler
+        self.dataset = OrderedDict([('lists', len(self.core.lists)),
+                                    ('users', len(self.core.users)),
+                                    ('memberships', len(self.core.members))])
+        Reconciler().reconcile()
+        self.mail_host = self.core.domains.keys()[0]
+        self.mlist = MailingList.objects.get(fqdn_listname=self.core.lists.values()[0]['fqdn_listname'])
+        self.admin = User.objects.create_superuser(display_name=self.admin_name,
+                                                   email='bench-admin@example.org',
+                                                   password=self.admin_password)
+        self.client = APIClient()
+        self.client.login(username=self.admin_name, password=self.admin_password)
+
+    def run(self, names=None):
+        results = OrderedDict()
+        for name in names or SCENARIOS.keys():
+            scenario = SCENARIOS[name]()
+            scenario.setup(self)
+            logger.info("Running the {0} benchmark".format(name))
+            results[name] = self.measure(scenario)
+        return results
+
+    def measure(self, scenario):
+        for i in range(self.warmup):
+            scenario.request(self, -i - 1)
+        latencies, core_calls, queries = [], [], []
+        errors = 0
+        # The test client resets the query log on every request.
+        request_started.disconnect(reset_queries)
+        debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            for i in range(self.iterations):
+                reset_queries()
+                calls = self.core.call_count()
+                started = time.time()
+                response = scenario.request(self, i)
+                latencies.append(time.time() - started)
+                core_calls.append(self.core.call_count() - calls)
+                queries.append(len(connection.queries))
+                if response.status_code not in scenario.expected_status:
+                    logger.warning("{0} answered {1}: {2}".format(
+                        scenario.name, response.status_code, response.content[:200]))
+                    errors += 1
+        finally:
+            connection.use_debug_cursor = debug_cursor
+            request_started.connect(reset_queries)
+        return summarize(latencies, core_calls, queries, errors)
+
+    def metadata(self):
+        return OrderedDict([
+            ('timestamp', timezone.now().isoformat()),
+            ('python', platform.python_version()),
+            ('django', django.get_version()),
+            ('database', connection.vendor),
+            ('sync_mode', getattr(settings, 'MAILMAN_SYNC_MODE', 'immediate')),
+            ('core_latency_ms', self.core.latency * 1000),
+            ('iterations', self.iterations),
+            ('warmup', self.warmup),
+            ('bulk_size', self.bulk_size),
+            ('page_size', self.page_size),
+            ('dataset', self.dataset),
+        ])
+
+
+def run_benchmarks(names=None, lists=5, members=100, latency=0.0, **kwargs):
+    """
+    Populate a fake Core, run the scenarios called `names` (all of them
+    by default) and return the results along with their settings.
+    """
+    core = FakeCore(latency=latency)
+    with Benchmark(core, **kwargs) as bench:
+        core.populate(lists=lists, members=members)
+        bench.setup()
+        results = bench.run(names)
+        return OrderedDict([('meta', bench.metadata()), ('scenarios', results)])
+
+
+def measure_adaptors(count=100000):
+    """
+    Build `count` membership adaptors from roster entries, as a roster
+    listing does, and measure the time it takes and the memory each one
+    holds. The strings of the values are not counted: the entries share
+    them with the adaptors, whatever their layout.
+    """
+    from public_rest.adaptors import MembershipAdaptor
+    core = FakeCore()
+    core.populate(lists=1, members=1)
+    entry = core.render_member(core.members.values()[0])
+    entries = [dict(entry, address=u'subscriber{0}@example.org'.format(n))
+               for n in range(count)]
+    started = time.time()
+    adaptors = [MembershipAdaptor(None, entry['self_link'], data=entry)
+                for entry in entries]
+    seconds = time.time() - started
+    adaptor = adaptors[0]
+    size = sys.getsizeof(adaptor) + sys.getsizeof(adaptor._values)
+    return OrderedDict([
+        ('adaptors', count),
+        ('build_ms', round(seconds * 1000, 3)),
+        ('bytes_per_adaptor', size),
+        ('bytes_per_entry', sys.getsizeof(entries[0])),
+    ])
+
+
+def write_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Circuit breakers for the calls to the Mailman Core.
+
+When the Core is down or overloaded, every call waits for the socket
+timeout, and a single API request can make many calls. A
+`CircuitBreaker` counts the consecutive failures of one family of
+endpoints (`lists`, `members`, `users`, ...). Once there are
+`MAILMAN_BREAKER_FAILURE_THRESHOLD` of them the circuit opens, and
+calls to that family fail at once, without touching the network.
+After `MAILMAN_BREAKER_RECOVERY_TIMEOUT` seconds the circuit is half
+open: up to `MAILMAN_BREAKER_HALF_OPEN_PROBES` calls are let through,
+and the first outcome closes the circuit again or reopens it.
+
+`api.Connection` raises `CircuitOpenError` for calls refused by an open
+circuit. The caller decides the fallback. For example, stale cached
+responses are served, reads fall back to the local mirror, and saves
+go to the sync outbox.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from public_rest.utils import core_relative_path
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def endpoint_family(url):
+    """
+    The family of a Core URL, which is the collection it belongs to:
+        >>> endpoint_family('http://localhost:8001/3.0/lists/foo.example.com/config')
+        'lists'
+    """
+    return core_relative_path(url).split('/')[0]
+
+
+class CircuitBreaker(object):
+    """
+    The state of the circuit for one endpoint family.
+
+    :param name: What the circuit protects, for the logs.
+    :param failure_threshold: Consecutive failures that open the circuit.
+    :param recovery_timeout: Seconds after which an open circuit lets
+        probes through.
+    :param half_open_probes: Calls let through at a time while half open.
+    """
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30, half_open_probes=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go through now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.recovery_timeout:
+                    return False
+                self.state = HALF_OPEN
+                self.probes = 0
+                logger.info("Circuit {0} is half open".format(self.name))
+            if self.probes >= self.half_open_probes:
+                return False
+            self.probes += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("Circuit {0} is closed".format(self.name))
+            self.state = CLOSED
+            self.failures = 0
+            self.probes = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning("Circuit {0} is open after {1} failures".format(
+                        self.name, self.failures))
+                self.state = OPEN
+                self.opened_at = time.time()
+                self.probes = 0
+
+    def is_open(self):
+        """Whether calls are refused right now, without taking a probe."""
+        with self._lock:
+            if self.state == OPEN:
+                return time.time() - self.opened_at < self.recovery_timeout
+            return self.state == HALF_OPEN and self.probes >= self.half_open_probes
+
+    def recovers_at(self):
+        """When an open circuit lets probes through, as from `time.time()`."""
+        with self._lock:
+            if self.state == OPEN:
+                return self.opened_at + self.recovery_timeout
+            return time.time()
+
+    def reset(self):
+        self.record_success()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(base_url, family):
+    """
+    Return the shared breaker of an endpoint family of a Core, or None
+    when disabled with `MAILMAN_BREAKER_ENABLED = False`.
+    """
+    if not getattr(settings, 'MAILMAN_BREAKER_ENABLED', True):
+        return None
+    key = (base_url, family)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                '{0} {1}'.format(base_url, family),
+                failure_threshold=getattr(settings, 'MAILMAN_BREAKER_FAILURE_THRESHOLD', 5),
+                recovery_timeout=getattr(settings, 'MAILMAN_BREAKER_RECOVERY_TIMEOUT', 30),
+                half_open_probes=getattr(settings, 'MAILMAN_BREAKER_HALF_OPEN_PROBES', 1))
+            _breakers[key] = breaker
+        return breaker
+
+
+def breaker_states():
+    """The state of every breaker, keyed by base URL and family."""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return dict(('{0} {1}'.format(*key), breaker.state) for key, breaker in breakers.items())
+
+
+def reset_breakers():
+    """Close every circuit."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    for breaker in breakers:
+        breaker.reset()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Subscribing and unsubscribing many addresses at once.
+
+`AbstractMailingList.subscribe` handles one address at a time, and may
+save a User, an Email and three preference objects for it, each synced
+to the Core on its own. A `BulkSubscriber` works on chunks of addresses
+instead: the existing users and emails of a chunk are looked up with a
+single query, the missing rows are created with `bulk_create`, and the
+new users and memberships are pushed to the Core (or queued for it)
+once the chunk is committed. Only one chunk is held in memory at a
+time, besides the per-address results.
+
+`create_users` imports many users the same way, as `User.objects.create`
+would create each of them.
+"""
+
+import csv
+import logging
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import connection, transaction
+from django.db.models.query import QuerySet
+
+from public_rest.api import MailmanConnectionError
+from public_rest.interface import ci, suppress_sync
+from public_rest.models import Email, EmailPrefs, Membership, User, UserPrefs
+from public_rest import fanout, sync
+
+logger = logging.getLogger(__name__)
+
+# Result of each address
+SUBSCRIBED = 'subscribed'
+UNSUBSCRIBED = 'unsubscribed'
+EXISTS = 'exists'
+NOT_FOUND = 'not_found'
+INVALID = 'invalid'
+DUPLICATE = 'duplicate'
+CONFLICT = 'conflict'
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def local(model):
+    """A plain QuerySet, which never goes to the Core on a miss."""
+    return QuerySet(model=model)
+
+
+def set_values(model, field_name, values):
+    """
+    Set a field of many rows from a `{pk: value}` dict, with a single
+    UPDATE per batch of rows the database takes parameters for.
+    """
+    field = model._meta.get_field(field_name)
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(field.column)
+    pk_column = connection.ops.quote_name(model._meta.pk.column)
+    items = values.items()
+    # Each row binds three parameters: two in the CASE, one in the IN.
+    batch_size = max(connection.ops.bulk_batch_size([pk_column, column, pk_column], items), 1)
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        params = []
+        for pk, value in batch:
+            params.extend([pk, value])
+        params.extend(pk for pk, value in batch)
+        sql = 'UPDATE {0} SET {1} = CASE {2} {3} END WHERE {2} IN ({4})'.format(
+            table, column, pk_column, ' '.join(['WHEN %s THEN %s'] * len(batch)),
+            ', '.join(['%s'] * len(batch)))
+        connection.cursor().execute(sql, params)
+
+
+def push_created(instances):
+    """
+    Push new objects to the Core, or queue them for it. Returns the
+    number of objects that could not be pushed.
+
+    The Core calls of the objects are made in parallel, on the fan-out
+    pool. The database is only used from the calling thread: it loads
+    the related rows the calls read first, and saves the Core URLs of
+    the objects once they are all linked, with one UPDATE per batch.
+    """
+    if sync.is_queued():
+        sync.enqueue_many(instances, created=True)
+        return 0
+    pushes = []
+    for instance in instances:
+        # Loads (and caches) the related rows `link_backup` reads.
+        instance.prepare_related_data()
+        pushes.append((instance, instance.prepare_backing_data()))
+    outcomes = fanout.run_parallel([partial(_attempt, instance, instance.link_backup, data)
+                                    for instance, data in pushes])
+    linked = [(instance, data, created)
+              for (instance, data), (ok, created) in zip(pushes, outcomes)
+              if ok and created is not None]
+    errors = len(pushes) - len(linked)
+    models = OrderedDict()
+    for instance, data, created in linked:
+        models.setdefault(type(instance), {})[instance.pk] = instance.partial_URL
+        instance.take_snapshot()
+    for model, partial_urls in models.items():
+        set_values(model, 'partial_URL', partial_urls)
+    # What the POST creating an object did not send is PATCHed after.
+    patches = [partial(_attempt, instance, instance.patch_backup, data)
+               for instance, data, created in linked
+               if not (created and instance.posts_backing_data)]
+    errors += sum(1 for ok, result in fanout.run_parallel(patches) if not ok)
+    return errors
+
+
+def _attempt(instance, function, *args):
+    """
+    Call `function` with `args`, returning `(True, result)`, or
+    `(False, None)` if the Core could not be reached.
+    """
+    try:
+        return True, function(*args)
+    except MailmanConnectionError as e:
+        logger.info("Could not back up {0}({1}): {2}".format(
+            instance.object_type, instance.pk, e))
+        return False, None
+
+
+def parse_rows(request):
+    """
+    Yield `(address, display_name)` pairs from a bulk request.
+
+    A `text/csv` body is read line by line, with the address in the
+    first column and an optional display name in the second. Anything
+    else is parsed by DRF and can be a list of addresses, a list of
+    `{"address": ..., "display_name": ...}` objects, or an object holding
+    either list under `addresses`.
+    """
+    if request.content_type.split(';')[0].strip() == 'text/csv':
+        for row in csv.reader(request._request):
+            if not row or row[0].strip().lower() == 'address':
+                continue
+            display_name = row[1].strip() if len(row) > 1 else ''
+            yield row[0].decode('utf-8'), display_name.decode('utf-8') or None
+        return
+    data = request.DATA
+    if isinstance(data, dict):
+        data = data.get('addresses') or []
+    if isinstance(data, basestring):
+        data = [data]
+    for entry in data:
+        if isinstance(entry, dict):
+            yield entry.get('address') or u'', entry.get('display_name') or None
+        else:
+            yield entry, None
+
+
+class BulkSubscriber(object):
+    """
+    Changes the memberships of one role on a mailing list.
+
+    :param mlist: The MailingList.
+    :param role: 'member', 'moderator' or 'owner'.
+    :param chunk_size: Addresses handled per transaction, by default
+        `MAILMAN_BULK_CHUNK_SIZE`.
+    """
+
+    def __init__(self, mlist, role, chunk_size=None):
+        self.mlist = mlist
+        self.role = role
+        self.chunk_size = chunk_size or getattr(settings, 'MAILMAN_BULK_CHUNK_SIZE', 500)
+        self.results = []
+        self.sync_errors = 0
+        self._seen = set()
+
+    def summary(self):
+        counts = {}
+        for result in self.results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        return dict(counts=counts, sync_errors=self.sync_errors, results=self.results)
+
+    def _add_result(self, address, status):
+        self.results.append(dict(address=address, status=status))
+
+    def _clean(self, rows):
+        """Drop invalid and repeated addresses, reporting them."""
+        wanted = OrderedDict()
+        for address, display_name in rows:
+            address = (address or u'').strip()
+            try:
+                validate_email(address)
+            except ValidationError:
+                self._add_result(address, INVALID)
+                continue
+            if address in self._seen:
+                self._add_result(address, DUPLICATE)
+                continue
+            self._seen.add(address)
+            wanted[address] = display_name
+        return wanted
+
+    def subscribe(self, rows):
+        for chunk in chunked(rows, self.chunk_size):
+            wanted = self._clean(chunk)
+            if wanted:
+                with suppress_sync():
+                    with transaction.commit_on_success():
+                        users, memberships = self._subscribe_chunk(wanted)
+                self._push(users, memberships)
+        return self.summary()
+
+    def unsubscribe(self, rows):
+        for chunk in chunked(rows, self.chunk_size):
+            wanted = self._clean(chunk)
+            if wanted:
+                with transaction.commit_on_success():
+                    deleted = self._unsubscribe_chunk(wanted)
+                self._push_deletes(deleted)
+        return self.summary()
+
+    def _subscribe_chunk(self, wanted):
+        """
+        Subscribe the addresses of one chunk, creating the missing users
+        and emails. Returns the new users and the new memberships.
+        """
+        emails = dict((email.address, email)
+                      for email in local(Email).filter(address__in=wanted.keys()))
+
+        # Every address needs a user: either its email has one, or a
+        # new user is created with the address as the display name.
+        homeless = [address for address in wanted
+                    if address not in emails or emails[address].user_id is None]
+        names = dict((address, wanted[address] or address) for address in homeless)
+        taken = set(local(User).filter(display_name__in=names.values())
+                               .values_list('display_name', flat=True))
+        max_length = User._meta.get_field('display_name').max_length
+        for address in homeless:
+            if len(names[address]) > max_length:
+                status = INVALID
+            elif names[address] in taken:
+                status = CONFLICT
+            else:
+                taken.add(names[address])
+                continue
+            self._add_result(address, status)
+            del wanted[address]
+            del names[address]
+
+        missing = [address for address in names if address not in emails]
+        if missing:
+            Email.objects.bulk_create([
+                Email(address=address, preferences=preferences)
+                for address, preferences in zip(missing,
+                                                EmailPrefs.create_many(len(missing)))])
+            emails.update((email.address, email)
+                          for email in local(Email).filter(address__in=missing))
+
+        new_users = []
+        if names:
+            # Nobody knows the random password subscribe() would set,
+            # so an unusable one is as good and much cheaper to make.
+            password = make_password(None)
+            User.objects.bulk_create([
+                User(display_name=names[address], password=password,
+                     preferred_email_id=emails[address].pk, preferences=preferences)
+                for address, preferences in zip(names, UserPrefs.create_many(len(names)))])
+            new_users = list(local(User).filter(display_name__in=names.values()))
+            user_ids = dict((user.display_name, user.pk) for user in new_users)
+            set_values(Email, 'user', dict((emails[address].pk, user_ids[names[address]])
+                                           for address in names))
+            for address in names:
+                emails[address].user_id = user_ids[names[address]]
+
+        email_ids = [emails[address].pk for address in wanted]
+        subscribed = set(local(Membership).filter(mlist=self.mlist, role=self.role,
+                                                  address_id__in=email_ids)
+                                          .values_list('address_id', flat=True))
+        new_memberships = [Membership(mlist=self.mlist, role=self.role,
+                                      user_id=emails[address].user_id,
+                                      address_id=emails[address].pk)
+                           for address in wanted
+                           if emails[address].pk not in subscribed]
+        if new_memberships:
+            Membership.prepare_bulk_insert(new_memberships)
+            Membership.objects.bulk_create(new_memberships)
+            new_memberships = list(local(Membership).filter(
+                mlist=self.mlist, role=self.role,
+                address_id__in=[m.address_id for m in new_memberships]))
+
+        for address in wanted:
+            status = EXISTS if emails[address].pk in subscribed else SUBSCRIBED
+            self._add_result(address, status)
+        return new_users, new_memberships
+
+    def _unsubscribe_chunk(self, wanted):
+        memberships = list(local(Membership).filter(mlist=self.mlist, role=self.role,
+                                                    address__address__in=wanted.keys())
+                                            .select_related('address'))
+        found = set(membership.address.address for membership in memberships)
+        for address in wanted:
+            self._add_result(address, UNSUBSCRIBED if address in found else NOT_FOUND)
+        if memberships:
+            local(Membership).filter(pk__in=[m.pk for m in memberships]).delete()
+        return memberships
+
+    def _push(self, users, memberships):
+        """Push the new users, then their memberships, to the Core."""
+        self.sync_errors += push_created(users)
+        self.sync_errors += push_created(memberships)
+
+    def _push_deletes(self, memberships):
+        for membership in memberships:
+            if not membership.partial_URL:
+                continue
+            try:
+                ci.delete_object(membership.partial_URL)
+            except (MailmanConnectionError, IOError) as e:
+                logger.info("Could not delete {0}: {1}".format(membership.partial_URL, e))
+                self.sync_errors += 1
+
+
+def create_users(rows, chunk_size=None):
+    """
+    Create users from `(display_name, address, password)` rows, each
+    with its preferred email and both their preferences, like
+    `User.objects.create`. A chunk of rows is written with bulk inserts
+    in one transaction, then its users are pushed to the Core (or queued
+    for it). An existing email without a user is taken over.
+
+    Raises `ValueError`, before writing a chunk, if one of its display
+    names or addresses is repeated or already taken; the chunks before
+    it are kept.
+
+    :param rows: Iterable of rows; a password of None is unusable.
+    :param chunk_size: Users per transaction, by default
+        `MAILMAN_BULK_CHUNK_SIZE`.
+    :returns: The new users, and the number that could not be pushed.
+    """
+    chunk_size = chunk_size or getattr(settings, 'MAILMAN_BULK_CHUNK_SIZE', 500)
+    users = []
+    sync_errors = 0
+    for chunk in chunked(rows, chunk_size):
+        with suppress_sync():
+            with transaction.commit_on_success():
+                new_users = _create_users_chunk(chunk)
+        sync_errors += push_created(new_users)
+        users.extend(new_users)
+    return users, sync_errors
+
+
+def _create_users_chunk(rows):
+    names = [display_name for display_name, address, password in rows]
+    addresses = [address for display_name, address, password in rows]
+    if not all(names) or not all(addresses):
+        raise ValueError("Every user needs a display name and an address")
+    if len(set(names)) < len(names) or len(set(addresses)) < len(addresses):
+        raise ValueError("Repeated display names or addresses")
+    taken = list(local(User).filter(display_name__in=names)
+                            .values_list('display_name', flat=True))
+    if taken:
+        raise ValueError("Display names already taken: {0}".format(', '.join(taken)))
+    emails = dict((email.address, email)
+                  for email in local(Email).filter(address__in=addresses))
+    owned = [address for address, email in emails.items() if email.user_id is not None]
+    if owned:
+        raise ValueError("Addresses already taken: {0}".format(', '.join(owned)))
+
+    missing = [address for address in addresses if address not in emails]
+    if missing:
+        Email.objects.bulk_create([
+            Email(address=address, preferences=preferences)
+            for address, preferences in zip(missing, EmailPrefs.create_many(len(missing)))])
+        emails.update((email.address, email)
+                      for email in local(Email).filter(address__in=missing))
+    User.objects.bulk_create([
+        User(display_name=display_name, password=make_password(password),
+             preferred_email_id=emails[address].pk, preferences=preferences)
+        for (display_name, address, password), preferences
+        in zip(rows, UserPrefs.create_many(len(rows)))])
+    users = dict((user.display_name, user)
+                 for user in local(User).filter(display_name__in=names)
+                                        .select_related('preferred_email'))
+    set_values(Email, 'user', dict((emails[address].pk, users[display_name].pk)
+                                   for display_name, address, password in rows))
+    return [users[display_name] for display_name in names]
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local cache of Core GET responses, and of read-only POSTs.
+
+Entries are keyed by the full URL (path and query), plus the form data
+of read-only POSTs like `members/find` (only cached when the caller
+asks for it), and expire after a TTL that
+depends on the kind of resource. Expired entries are kept around so
+that they can be revalidated with `If-None-Match` instead of being
+fetched again. Writes going through `api.Connection.call` invalidate
+whatever they could have changed.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from public_rest.utils import core_relative_path, core_resource_type
+
+logger = logging.getLogger(__name__)
+
+# Seconds a response stays fresh, per resource type. Types missing
+# here are not cached at all.
+DEFAULT_TTLS = {
+    'system': 3600,
+    'domains': 600,
+    'config': 300,
+    'lists': 300,
+    'users': 60,
+    'addresses': 60,
+    'preferences': 60,
+    'members': 30,
+    'roster': 30,
+    # members/find
+    'find': 30,
+}
+
+# A write to one collection can change what other resource types show.
+DEPENDENT_TYPES = {
+    'domains': ('domains',),
+    'lists': ('lists', 'domains', 'find'),
+    'members': ('members', 'roster', 'find'),
+    'users': ('users', 'addresses'),
+    'addresses': ('addresses', 'users'),
+}
+
+
+class CacheEntry(object):
+
+    def __init__(self, url, response, content, etag, ttl):
+        self.url = url
+        self.path = core_relative_path(url)
+        self.response = response
+        self.content = content
+        self.etag = etag
+        self.size = len(url) + len(content or '')
+        self.refresh(ttl)
+
+    def refresh(self, ttl):
+        self.ttl = ttl
+        self.expires = time.time() + ttl
+
+    @property
+    def is_fresh(self):
+        return time.time() < self.expires
+
+
+class ResponseCache(object):
+    """
+    An LRU cache of responses, bounded by number of entries and bytes.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=8 * 1024 * 1024, ttls=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, revalidated=0,
+                           evictions=0, invalidations=0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl_for(self, url):
+        return self.ttls.get(core_resource_type(url), 0)
+
+    def get(self, url):
+        """
+        Return the entry for `url`, fresh or not, or None. Only fresh
+        entries count as hits; stale ones are meant for revalidation.
+        """
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries[url] = entry
+            if entry.is_fresh:
+                self._stats['hits'] += 1
+            else:
+                self._stats['misses'] += 1
+            return entry
+
+    def set(self, url, response, content, etag=None):
+        """Store a response, returning the entry or None if not cacheable."""
+        ttl = self.ttl_for(url)
+        if ttl <= 0:
+            return None
+        etag = response.get('etag') or etag
+        entry = CacheEntry(url, response, content, etag, ttl)
+        if entry.size > self.max_bytes:
+            return None
+        with self._lock:
+            self._discard(url)
+            self._entries[url] = entry
+            self._bytes += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self._stats['evictions'] += 1
+        return entry
+
+    def revalidated(self, entry):
+        """The Core answered 304 Not Modified for a stale entry."""
+        with self._lock:
+            entry.refresh(entry.ttl)
+            self._stats['revalidated'] += 1
+
+    def invalidate(self, url):
+        """
+        Drop every entry a write to `url` could have changed: the
+        resource itself, anything below it, and the resource types
+        depending on its collection.
+        """
+        path = core_relative_path(url)
+        collection = path.split('/')[0]
+        dependent = DEPENDENT_TYPES.get(collection, (collection,))
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if entry.path == path or entry.path.startswith(path + '/')
+                     or core_resource_type(entry.path) in dependent]
+            for key in stale:
+                self._discard(key)
+            self._stats['invalidations'] += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _discard(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def stats(self):
+        with self._lock:
+            rv = dict(self._stats)
+            rv.update(entries=len(self._entries), bytes=self._bytes)
+        return rv
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(base_url):
+    """
+    Return the shared response cache for a Core base URL, or None when
+    caching is disabled with `MAILMAN_CACHE_ENABLED = False`.
+    """
+    if not getattr(settings, 'MAILMAN_CACHE_ENABLED', True):
+        return None
+    with _caches_lock:
+        cache = _caches.get(base_url)
+        if cache is None:
+            cache = ResponseCache(
+                max_entries=getattr(settings, 'MAILMAN_CACHE_MAX_ENTRIES', 1000),
+                max_bytes=getattr(settings, 'MAILMAN_CACHE_MAX_BYTES', 8 * 1024 * 1024),
+                ttls=getattr(settings, 'MAILMAN_CACHE_TTLS', None))
+            _caches[base_url] = cache
+        return cache
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming exports of rosters and users.
+
+Rows are read with `utils.iterate_values`, a chunk at a time, and
+written out as CSV or NDJSON as they come, without going through the
+DRF serializers. The response is streamed, so neither the server nor
+the client has to hold the whole export in memory.
+"""
+
+import csv
+import json
+import logging
+from datetime import datetime
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from public_rest.utils import iterate_values
+
+logger = logging.getLogger(__name__)
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+
+CONTENT_TYPES = {
+    CSV: 'text/csv; charset=utf-8',
+    NDJSON: 'application/x-ndjson; charset=utf-8',
+}
+
+# (column, lookup) pairs of each export
+ROSTER_COLUMNS = (
+    ('address', 'address__address'),
+    ('display_name', 'user__display_name'),
+    ('role', 'role'),
+    ('list', 'mlist__fqdn_listname'),
+)
+
+USER_COLUMNS = (
+    ('display_name', 'display_name'),
+    ('email', 'preferred_email__address'),
+    ('is_superuser', 'is_superuser'),
+    ('created_on', 'created_on'),
+)
+
+
+def _to_text(value):
+    if value is None:
+        return u''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return unicode(value)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def render_csv(columns, rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([name for name, lookup in columns])
+    for row in rows:
+        writer.writerow([_to_text(value).encode('utf-8') for value in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def render_ndjson(columns, rows):
+    names = [name for name, lookup in columns]
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), default=_json_default) + '\n'
+
+
+def buffered(lines, size=64 * 1024):
+    """Group small lines into blocks of about `size` bytes."""
+    block = []
+    length = 0
+    for line in lines:
+        block.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(block)
+            block = []
+            length = 0
+    if block:
+        yield ''.join(block)
+
+
+def export_response(queryset, columns, output, filename):
+    """
+    A streaming response exporting the `columns` of `queryset`, or
+    None if `output` is not a known format.
+    """
+    if output not in CONTENT_TYPES:
+        return None
+    chunk_size = getattr(settings, 'MAILMAN_EXPORT_CHUNK_SIZE', 1000)
+    rows = iterate_values(queryset, [lookup for name, lookup in columns],
+                          chunk_size=chunk_size)
+    if output == CSV:
+        lines = render_csv(columns, rows)
+    else:
+        lines = render_ndjson(columns, rows)
+    response = StreamingHttpResponse(buffered(lines), content_type=CONTENT_TYPES[output])
+    response['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(filename, output)
+    return response
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parallel execution of independent Core calls.
+
+Several reads, such as the three rosters of a list or the subscriptions
+of each address of a user, are independent of each other. `run_parallel`
+runs them on a process-wide pool of `MAILMAN_FANOUT_WORKERS` threads,
+with at most `MAILMAN_FANOUT_CONCURRENCY` of them at a time for one
+caller, so they take as long as the slowest instead of the sum. `Prefetch`
+starts a single function in the background, for a result needed later.
+
+The calling thread takes part in the work. It does not wait for a busy
+pool, and a fan-out started from a pool thread cannot deadlock. The
+profile of the calling request is made current in the threads helping
+it, so that their Core calls are counted with the rest of the request.
+"""
+
+import logging
+import os
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from public_rest import instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+def workers():
+    return getattr(settings, 'MAILMAN_FANOUT_WORKERS', 10)
+
+
+def concurrency():
+    return getattr(settings, 'MAILMAN_FANOUT_CONCURRENCY', 4)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The worker threads of this process, started on first use."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        # Threads do not survive a fork: a worker process starts its own.
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(workers())
+            _pool_pid = os.getpid()
+        return _pool
+
+
+class _FanOut(object):
+    """The functions of one `run_parallel` call, and their outcomes."""
+
+    def __init__(self, functions):
+        self.functions = functions
+        self.results = [None] * len(functions)
+        self.error = None
+        self.next = 0
+        self.done = 0
+        self.profile = instrumentation.get_profile()
+        self.condition = threading.Condition()
+
+    def work(self):
+        """Run functions until there is none left to start."""
+        previous = instrumentation.activate(self.profile)
+        try:
+            while True:
+                with self.condition:
+                    if self.next == len(self.functions):
+                        return
+                    index = self.next
+                    self.next += 1
+                try:
+                    self.results[index] = self.functions[index]()
+                except Exception:
+                    with self.condition:
+                        if self.error is None:
+                            self.error = sys.exc_info()
+                with self.condition:
+                    self.done += 1
+                    self.condition.notify_all()
+        finally:
+            instrumentation.activate(previous)
+
+    def wait(self):
+        with self.condition:
+            while self.done < len(self.functions):
+                self.condition.wait()
+
+
+def run_parallel(functions, max_concurrency=None):
+    """
+    Call each of `functions` and return their results, in order.
+
+    Once they are all done, the first exception raised by one of them is
+    raised again.
+
+    :param functions: Callables taking no argument.
+    :param max_concurrency: How many may run at a time, defaults to
+        `MAILMAN_FANOUT_CONCURRENCY`.
+    """
+    functions = list(functions)
+    if max_concurrency is None:
+        max_concurrency = concurrency()
+    helpers = min(max_concurrency, len(functions)) - 1
+    if helpers <= 0:
+        return [function() for function in functions]
+    fanout = _FanOut(functions)
+    pool = get_pool()
+    for n in range(helpers):
+        pool.apply_async(fanout.work)
+    fanout.work()
+    fanout.wait()
+    if fanout.error is not None:
+        raise fanout.error[0], fanout.error[1], fanout.error[2]
+    return fanout.results
+
+
+class Prefetch(object):
+    """
+    A function started in the background, whose result is asked for
+    later with `result`. If no thread of the pool has started it by
+    then, the caller runs it itself instead of waiting for one.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.profile = instrumentation.get_profile()
+        self._started = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        get_pool().apply_async(self.run)
+
+    def run(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        previous = instrumentation.activate(self.profile)
+        try:
+            self._result = self.function()
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            instrumentation.activate(previous)
+            self._done.set()
+
+    def result(self):
+        """The result of the function, or its exception raised again."""
+        self.run()
+        self._done.wait()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
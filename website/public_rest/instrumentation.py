@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per request profiling of Core calls, database queries and serialization.
+
+`InstrumentationMiddleware` starts a `RequestProfile` for a sample of
+the requests (`MAILMAN_INSTRUMENTATION_SAMPLE_RATE`, 0 by default).
+While it is active, `api.Connection.call` records every Core call with
+its path template, the adaptors record the lazy loads of their data,
+and serializers record the time spent in `.data`. The database queries
+are taken from the debug cursor, which is turned on for sampled
+requests only.
+
+The profile of a request is sent back in a `Server-Timing` header, and
+logged as one JSON line by the `public_rest.instrumentation` logger.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+from public_rest.utils import core_path_template
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+# Number of path templates listed in the Server-Timing header.
+SERVER_TIMING_TEMPLATES = 5
+
+
+def sample_rate():
+    return getattr(settings, 'MAILMAN_INSTRUMENTATION_SAMPLE_RATE', 0)
+
+
+class RequestProfile(object):
+    """What one request spent its time on."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.duration = None
+        # Core calls may come from other threads of the same request.
+        self.lock = threading.Lock()
+        self.core_calls = 0
+        self.core_time = 0.0
+        self.cache_hits = 0
+        self.templates = defaultdict(lambda: [0, 0.0])
+        self.urls = defaultdict(int)
+        self.lazy_loads = defaultdict(int)
+        self.sections = defaultdict(float)
+        self._depth = defaultdict(int)
+        self.queries = 0
+        self.query_time = 0.0
+        self._query_marks = {}
+        self._debug_cursors = {}
+
+    def record_core_call(self, method, url, duration, cached=False):
+        with self.lock:
+            self.core_calls += 1
+            self.core_time += duration
+            if cached:
+                self.cache_hits += 1
+            template = self.templates['{0} {1}'.format(method, core_path_template(url))]
+            template[0] += 1
+            template[1] += duration
+            if method == 'GET':
+                self.urls[url] += 1
+
+    def record_lazy_load(self, adaptor):
+        with self.lock:
+            self.lazy_loads[adaptor.__class__.__name__] += 1
+
+    @contextmanager
+    def timed(self, section):
+        # Nested sections, like a serializer used by another one, are
+        # only counted once.
+        self._depth[section] += 1
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._depth[section] -= 1
+            if not self._depth[section]:
+                self.sections[section] += time.time() - started
+
+    def duplicates(self):
+        """URLs fetched more than once, with the number of fetches."""
+        return dict((url, n) for url, n in self.urls.items() if n > 1)
+
+    def watch_queries(self):
+        for connection in connections.all():
+            self._debug_cursors[connection.alias] = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            self._query_marks[connection.alias] = len(connection.queries)
+
+    def collect_queries(self):
+        for connection in connections.all():
+            if connection.alias not in self._query_marks:
+                continue
+            queries = connection.queries[self._query_marks[connection.alias]:]
+            self.queries += len(queries)
+            self.query_time += sum(float(query.get('time') or 0) for query in queries)
+            connection.use_debug_cursor = self._debug_cursors[connection.alias]
+
+    def finish(self):
+        self.collect_queries()
+        self.duration = time.time() - self.started
+
+    def as_dict(self):
+        ms = lambda seconds: round(seconds * 1000, 3)
+        return {
+            'duration_ms': ms(self.duration or 0),
+            'core': {
+                'calls': self.core_calls,
+                'time_ms': ms(self.core_time),
+                'cache_hits': self.cache_hits,
+                'templates': dict((template, {'count': count, 'time_ms': ms(total)})
+                                  for template, (count, total) in self.templates.items()),
+                'duplicates': self.duplicates(),
+                'lazy_loads': dict(self.lazy_loads),
+            },
+            'db': {'queries': self.queries, 'time_ms': ms(self.query_time)},
+            'serialize_ms': ms(self.sections.get('serialize', 0)),
+        }
+
+    def server_timing(self):
+        """The value of a `Server-Timing` header for this profile."""
+        ms = lambda seconds: '{0:.1f}'.format(seconds * 1000)
+        metrics = [
+            'core;dur={0};desc="{1} calls, {2} cached, {3} duplicate"'.format(
+                ms(self.core_time), self.core_calls, self.cache_hits,
+                sum(n - 1 for n in self.duplicates().values())),
+            'db;dur={0};desc="{1} queries"'.format(ms(self.query_time), self.queries),
+            'serialize;dur={0}'.format(ms(self.sections.get('serialize', 0))),
+        ]
+        slowest = sorted(self.templates.items(), key=lambda item: -item[1][1])
+        for n, (template, (count, total)) in enumerate(slowest[:SERVER_TIMING_TEMPLATES]):
+            metrics.append('core-{0};dur={1};desc="{2} x{3}"'.format(
+                n + 1, ms(total), template, count))
+        metrics.append('total;dur={0}'.format(ms(self.duration or 0)))
+        return ', '.join(metrics)
+
+
+def get_profile():
+    """The profile of the current request, or None if not sampled."""
+    return getattr(_state, 'profile', None)
+
+
+def activate(profile):
+    """Make `profile` the current one of this thread, and return the previous."""
+    previous = get_profile()
+    _state.profile = profile
+    return previous
+
+
+def record_core_call(method, url, duration, cached=False):
+    profile = get_profile()
+    if profile is not None:
+        profile.record_core_call(method, url, duration, cached=cached)
+
+
+def record_lazy_load(adaptor):
+    profile = get_profile()
+    if profile is not None:
+        profile.record_lazy_load(adaptor)
+
+
+@contextmanager
+def timed(section):
+    """Add the time spent in the block to `section` of the current profile."""
+    profile = get_profile()
+    if profile is None:
+        yield
+    else:
+        with profile.timed(section):
+            yield
+
+
+class InstrumentedSerializerMixin(object):
+    """Times the serialization of `.data`."""
+
+    @property
+    def data(self):
+        with timed('serialize'):
+            return super(InstrumentedSerializerMixin, self).data
+
+
+class InstrumentationMiddleware(object):
+    """Profiles a sample of the requests."""
+
+    def process_request(self, request):
+        activate(None)
+        if random.random() >= sample_rate():
+            return None
+        profile = RequestProfile()
+        profile.watch_queries()
+        activate(profile)
+        return None
+
+    def process_response(self, request, response):
+        profile = activate(None)
+        if profile is None:
+            return response
+        profile.finish()
+        response['Server-Timing'] = profile.server_timing()
+        record = profile.as_dict()
+        record.update(method=request.method, path=request.path,
+                      status=response.status_code)
+        logger.info(json.dumps(record, sort_keys=True), extra={'profile': record})
+        return response
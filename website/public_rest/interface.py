@@ -8,17 +8,22 @@ A model can be "locally" or "remotely" backed up.
 
 import logging
 import json
+import threading
+from contextlib import contextmanager
 from urlparse import urljoin, urlsplit
 from urllib import urlencode
 from urllib2 import HTTPError
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet, EmptyQuerySet
 from model_utils.managers import PassThroughManager
 
-from public_rest.api import CoreInterface, Connection, MailmanConnectionError
+from public_rest.adaptors import BaseAdaptor
+from public_rest.api import CoreInterface, Connection, MailmanConnectionError, CircuitOpenError
 from public_rest.utils import get_related_attribute
+from public_rest import metrics, sync
 
 ci = CoreInterface()
 
@@ -30,6 +35,26 @@ LayerBelow = { 'rest':'adaptor',
 # Logging
 logger = logging.getLogger(__name__)
 
+_sync_state = threading.local()
+
+
+@contextmanager
+def suppress_sync():
+    """
+    Save objects locally without pushing them back to the Core.
+
+    Used when the data came from the Core in the first place.
+    """
+    _sync_state.depth = getattr(_sync_state, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _sync_state.depth -= 1
+
+
+def is_sync_suppressed():
+    return getattr(_sync_state, 'depth', 0) > 0
+
 # Abstract Object
 class AbstractObject(models.Model):
     class Meta:
@@ -128,38 +153,90 @@ class RemoteObjectQuerySet(LayeredModelQuerySet):
                     adaptor_list = ci.get_all_from_url(url, object_type=self.model.object_type)
                 except MailmanConnectionError as e:
                     logger.info("Exception - {0}".format(e))
+                    metrics.PULL_THROUGH.inc(object_type=self.model.object_type, result='error')
                     adaptor_list = []
+                else:
+                    metrics.PULL_THROUGH.inc(object_type=self.model.object_type,
+                                             result='found' if adaptor_list else 'empty')
 
             if len(adaptor_list) == 0:
                 return EmptyQuerySet(model=self.model)
             elif len(adaptor_list) > 0:
                 # Create the image records and save them on this level
-                for record in adaptor_list:
-                    logger.debug("Working on {0} record!".format(record))
-                    m = self.model()
-                    m.partial_URL = urlsplit(record.url).path
-                    logger.debug("----------------->>>>")
-                    for field in record:
-                        if not field in self.FILTER_IGNORE_FIELDS:
-                            field_val = getattr(record, field)
-                            logger.debug("field: {0}, {1}".format(field, type(field)))
-                            logger.debug("field_val: {0}, {1}".format(field_val, type(field_val)))
-                            try:
-                                setattr(m, field, field_val)
-                            except ValueError:
-                                related_model = getattr(self.model, field).field.rel.to.objects.model
-                                logger.info("====Related Model: {0}====".format(related_model))
-                                try:
-                                    related_record = ci.create_model_from_adaptor(related_model, field_val)
-                                    setattr(m, field, related_record)
-                                except Exception as e:
-                                    logger.debug("===Exception=== {0}".format(e))
-                    m.save()
-                    logger.debug("Saved record m: {0}".format(m))
+                self.import_records(adaptor_list)
                 return super(RemoteObjectQuerySet, self).filter(*args, **kwargs)
             else:
                 return EmptyQuerySet(model=self.model)
 
+    def import_records(self, adaptor_list):
+        """
+        Mirror records fetched from the Core into the local database.
+
+        All instances are built in memory first. Related records are
+        resolved once per distinct Core URL, and the rows are written
+        inside a transaction: with one bulk insert for models that set
+        `bulk_insert`, or else one `save()` each, which also creates the
+        rows they depend on. The `lazy_fields` of the records, which
+        would take a Core call per record, are left out. Nothing is
+        pushed back to the Core, since that is where the data came from.
+
+        Returns the number of inserted rows.
+        """
+        local = QuerySet(model=self.model)
+        records = [(urlsplit(record.url).path, record) for record in adaptor_list]
+        # Records that are already mirrored are left alone.
+        seen = set(local.filter(partial_URL__in=[url for url, record in records])
+                        .values_list('partial_URL', flat=True))
+        related_cache = {}
+        instances = []
+        with suppress_sync():
+            with transaction.commit_on_success():
+                for partial_url, record in records:
+                    if partial_url in seen:
+                        continue
+                    seen.add(partial_url)
+                    logger.debug("Working on {0} record!".format(record))
+                    m = self.model()
+                    m.partial_URL = partial_url
+                    for field in record:
+                        if field in self.FILTER_IGNORE_FIELDS or field in record.lazy_fields:
+                            continue
+                        field_val = getattr(record, field)
+                        rel = self._get_relation(field)
+                        if rel is not None and isinstance(field_val, BaseAdaptor):
+                            field_val = self._resolve_related(rel.to, field_val, related_cache)
+                        if field_val is None:
+                            continue
+                        setattr(m, field, field_val)
+                    instances.append(m)
+                if self.model.bulk_insert:
+                    self.model.prepare_bulk_insert(instances)
+                    local.bulk_create(instances)
+                else:
+                    for instance in instances:
+                        instance.save()
+        logger.debug("Imported {0} {1} records".format(len(instances), self.model.object_type))
+        return len(instances)
+
+    def _get_relation(self, field):
+        try:
+            return self.model._meta.get_field(field).rel
+        except FieldDoesNotExist:
+            return None
+
+    def _resolve_related(self, related_model, adaptor, cache):
+        """Get or create the local record for a related adaptor, once per URL."""
+        url = getattr(adaptor, '_url', None) or adaptor.url
+        key = (related_model, urlsplit(url).path)
+        if key not in cache:
+            logger.info("====Related Model: {0}====".format(related_model))
+            try:
+                cache[key] = ci.create_model_from_adaptor(related_model, adaptor)
+            except Exception as e:
+                logger.debug("===Exception=== {0}".format(e))
+                cache[key] = None
+        return cache[key]
+
 
 #  Managers
 class BaseQueryManager(PassThroughManager):
@@ -246,6 +323,66 @@ class AbstractRemotelyBackedObject(AbstractObject):
 
     objects = RemoteManager()
 
+    # Whether rows pulled from the Core are written with bulk_create.
+    # Models that set it fill in what their save() would, in
+    # `prepare_bulk_insert`.
+    bulk_insert = False
+
+    # Whether the POST creating the object in the Core sends all of its
+    # backing data, leaving nothing to PATCH once it is created.
+    posts_backing_data = False
+
+    def __init__(self, *args, **kwargs):
+        super(AbstractRemotelyBackedObject, self).__init__(*args, **kwargs)
+        self.take_snapshot()
+
+    def take_snapshot(self):
+        """
+        Remember the current field values, so that a later save
+        only has to send what changed since then to the Core.
+        """
+        # Reading from __dict__ keeps deferred fields from being loaded.
+        self._snapshot = dict((field.attname, self.__dict__.get(field.attname))
+                              for field in self._meta.fields)
+
+    def get_dirty_fields(self):
+        """Local fields (by attname) changed since the last snapshot."""
+        return set(name for name, value in self._snapshot.items()
+                   if self.__dict__.get(name) != value)
+
+    def get_dirty_backing_fields(self):
+        """Remote field names whose local source changed."""
+        dirty = self.get_dirty_fields()
+        rv = []
+        for local_field_name, remote_field_name in self.fields:
+            name = local_field_name.split('.')[0]
+            try:
+                name = self._meta.get_field(name).attname
+            except FieldDoesNotExist:
+                pass
+            if name in dirty:
+                rv.append(remote_field_name)
+        return rv
+
+    def save(self, *args, **kwargs):
+        super(AbstractRemotelyBackedObject, self).save(*args, **kwargs)
+        self.take_snapshot()
+
+    def update(self, **changes):
+        """Change several fields with a single save, and a single sync."""
+        for key, val in changes.items():
+            setattr(self, key, val)
+        self.save()
+
+    @classmethod
+    def prepare_bulk_insert(cls, instances):
+        """
+        Hook called before `instances` are bulk inserted, for models
+        with `bulk_insert` whose `save` would otherwise create dependent
+        rows.
+        """
+        pass
+
     def prepare_related_data(self):
         """Prepare data that would be used for looking
         up objects remotely."""
@@ -262,11 +399,16 @@ class AbstractRemotelyBackedObject(AbstractObject):
             data['email'] = self.preferred_email.address
         return data
 
-    def prepare_backing_data(self):
-        """Prepare data for backing layer"""
+    def prepare_backing_data(self, only=None):
+        """
+        Prepare data for backing layer. `only` restricts it
+        to the given remote field names.
+        """
         # Local fields could have different name at remote
         backing_data = {}
         for local_field_name, remote_field_name in self.fields:
+            if only is not None and remote_field_name not in only:
+                continue
             field_val = get_related_attribute(self, local_field_name)
             if isinstance(field_val, AbstractRemotelyBackedObject):
                 if field_val.partial_URL:
@@ -291,34 +433,54 @@ class AbstractRemotelyBackedObject(AbstractObject):
             return None
         return adaptor
 
+    def create_object(self, data=None):
+        """Push the object on the backer via the REST API."""
+        logger.debug("Creating object...")
+        kwds = self.prepare_related_data()
+        try:
+            return ci.create_object(object_type=self.object_type, data=data, **kwds)
+        except HTTPError as e:
+            logger.info("Could not CREATE object - {0}".format(e))
+            return None
+
     def get_or_create_object(self, data=None):
-        object_model = self.__class__
         res = self.get_object()
         if not res:
-            # Push the object on the backer via the REST API.
             logger.debug("GET failed!")
-            logger.debug("Creating object...")
-            kwds = self.prepare_related_data()
-            try:
-                rv_adaptor = ci.create_object(object_type=self.object_type, data=data, **kwds)
-            except HTTPError as e:
-                logger.info("Could not CREATE object - {0}".format(e))
-                return None
-            else:
-                return rv_adaptor
+            return self.create_object(data=data)
         else:
             return res
 
-    def create_backup(self, backing_data):
+    def link_backup(self, backing_data):
+        """
+        Find the object in the Core, or create it there, and set its
+        `partial_URL` without saving it. Only makes Core calls.
+
+        :return: Whether it was created, or None if it could be neither
+            found nor created.
+        """
         logger.debug("data: {0}".format(backing_data))
-        res = self.get_or_create_object(data=backing_data)
-        if res:
-            logger.debug("result: {0}, {1}".format(res, type(res)))
-            # Create a peer thing and associate the url with it.
-            self.partial_URL = urlsplit(res.url).path
-            self.save()
+        res = self.get_object()
+        created = not res
+        if created:
+            logger.debug("GET failed!")
+            res = self.create_object(data=backing_data)
+        if not res:
+            return None
+        logger.debug("result: {0}, {1}".format(res, type(res)))
+        # Create a peer thing and associate the url with it.
+        self.partial_URL = urlsplit(res.url).path
+        return created
+
+    def create_backup(self, backing_data):
+        created = self.link_backup(backing_data)
+        if created is not None:
+            with suppress_sync():
+                self.save()
             # Update the information at the back with new data.
             # >> Depends on the object_type
+            if not (created and self.posts_backing_data):
+                self.patch_backup(backing_data)
         else:
             if self.object_type not in self.disallow_updates:
                 try:
@@ -344,23 +506,47 @@ class AbstractRemotelyBackedObject(AbstractObject):
             # No partial URL, object is to be completely backed up
             self.create_backup(backing_data)
 
+    def sync_backup(self, created=False, fields=None):
+        """
+        Push the local state of the object to the Core. A new object
+        is sent whole, an existing one only sends `fields`, if given.
+        Raises `MailmanConnectionError` if the Core can't be reached.
+        """
+        # handle object get/create
+        if created:
+            self.create_backup(self.prepare_backing_data())
+        else:
+            self.patch_backup(self.prepare_backing_data(only=fields))
+
     def process_on_save_signal(self, sender, **kwargs):
         """
         After saving the object locally, we sync the
         changes to the remotely backed layer as well.
         """
         logger.info("Inside AbstractRemotelyBackedObject!")
-        if self.backup:
-            backing_data = self.prepare_backing_data()
-            # handle object get/create
+        if is_sync_suppressed():
+            logger.debug("Sync suppressed for {0}".format(self.object_type))
+        elif self.backup:
+            created = kwargs.get('created')
+            fields = None
+            if not created:
+                fields = self.get_dirty_backing_fields()
+                if not fields:
+                    logger.debug("Nothing changed in {0}".format(self.object_type))
+                    return
+            if sync.is_queued():
+                sync.enqueue(self, created=created, fields=fields)
+                return
             try:
-                if kwargs.get('created'):
-                    self.create_backup(backing_data)
-                else:
-                    self.patch_backup(backing_data)
+                self.sync_backup(created=created, fields=fields)
                 super(AbstractRemotelyBackedObject, self).process_on_save_signal(sender, **kwargs)
+            except CircuitOpenError as e:
+                # The Core is out: leave the change to the sync worker.
+                logger.info("Queueing {0}: {1}".format(self.object_type, e))
+                sync.enqueue(self, created=created, fields=fields)
             except MailmanConnectionError as e:
                 logger.info("Could not back up properly: {0}".format(e))
+                metrics.SYNC_FAILURES.inc(object_type=self.object_type)
         else:
             logger.warn("\nBackup Disabled!\n")
 
@@ -369,17 +555,33 @@ class AbstractRemotelyBackedDefault(AbstractRemotelyBackedObject):
     class Meta:
         abstract = True
 
+    def sync_backup(self, created=False, fields=None):
+        if created:
+            # Don't back up anything, we already have defaults.
+            return
+        self.patch_backup(self.prepare_backing_data(only=fields))
+
     def process_on_save_signal(self, sender, **kwargs):
-        if self.backup:
-            backing_data = self.prepare_backing_data()
+        if is_sync_suppressed():
+            logger.debug("Sync suppressed for {0}".format(self.object_type))
+        elif self.backup:
+            if kwargs.get('created'):
+                # Nothing to push, not even through the outbox.
+                return
+            fields = self.get_dirty_backing_fields()
+            if not fields:
+                return
+            if sync.is_queued():
+                sync.enqueue(self, fields=fields)
+                return
             try:
-                if kwargs.get('created'):
-                    # Don't back up anything, we already have defaults.
-                    pass
-                else:
-                    self.patch_backup(backing_data)
+                self.sync_backup(fields=fields)
+            except CircuitOpenError as e:
+                logger.info("Queueing {0}: {1}".format(self.object_type, e))
+                sync.enqueue(self, fields=fields)
             except MailmanConnectionError as e:
                 logger.info("Could not back up properly: {0}".format(e))
+                metrics.SYNC_FAILURES.inc(object_type=self.object_type)
         else:
             logger.warn("\nBackup Disabled!\n")
 
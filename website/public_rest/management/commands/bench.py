@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.simple import DjangoTestSuiteRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from public_rest.bench import SCENARIOS, measure_adaptors, run_benchmarks, write_results
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the REST API against a fake Mailman Core, "
+            "on a throwaway test database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--scenario', action='append', dest='scenarios', default=None,
+                    help='Scenario to run; can be given more than once. '
+                         'One of: {0}.'.format(', '.join(SCENARIOS))),
+        make_option('--iterations', type='int', dest='iterations', default=50,
+                    help='Measured requests per scenario.'),
+        make_option('--warmup', type='int', dest='warmup', default=5,
+                    help='Requests made before measuring, per scenario.'),
+        make_option('--latency', type='float', dest='latency', default=0.0,
+                    help='Milliseconds the fake Core waits before answering.'),
+        make_option('--lists', type='int', dest='lists', default=5,
+                    help='Number of lists in the fake Core.'),
+        make_option('--members', type='int', dest='members', default=100,
+                    help='Number of members of each list.'),
+        make_option('--bulk-size', type='int', dest='bulk_size', default=50,
+                    help='Addresses per bulk subscription.'),
+        make_option('--page-size', type='int', dest='page_size', default=50,
+                    help='Members per roster page.'),
+        make_option('--adaptors', type='int', dest='adaptors', default=100000,
+                    help='Adaptors to build when measuring their footprint; '
+                         '0 to skip it.'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write the JSON results to.'),
+    )
+
+    def handle(self, *args, **options):
+        for name in options['scenarios'] or ():
+            if name not in SCENARIOS:
+                raise CommandError("Unknown scenario: {0}".format(name))
+        runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+        setup_test_environment()
+        old_config = runner.setup_databases()
+        try:
+            results = run_benchmarks(names=options['scenarios'],
+                                     lists=options['lists'],
+                                     members=options['members'],
+                                     latency=options['latency'] / 1000.0,
+                                     iterations=options['iterations'],
+                                     warmup=options['warmup'],
+                                     bulk_size=options['bulk_size'],
+                                     page_size=options['page_size'])
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+        if options['adaptors']:
+            results['adaptors'] = measure_adaptors(options['adaptors'])
+
+        if options['output']:
+            write_results(results, options['output'])
+        else:
+            self.stdout.write(json.dumps(results, indent=2))
+        for name, result in results['scenarios'].items():
+            self.stderr.write("{0:<16} p50 {1[p50]:>9} ms  p99 {1[p99]:>9} ms  "
+                              "{2:>6} core calls  {3:>6} queries  {4} errors".format(
+                                  name, result['latency_ms'], result['core_calls_per_request'],
+                                  result['queries_per_request'], result['errors']))
+        if options['adaptors']:
+            self.stderr.write("{0[adaptors]} adaptors built in {0[build_ms]} ms, "
+                              "{0[bytes_per_adaptor]} bytes each".format(results['adaptors']))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from public_rest.reconcile import Reconciler
+
+
+class Command(BaseCommand):
+    help = "Bring the local mirror in line with the Mailman Core."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report what would change.'),
+        make_option('--restart', action='store_true', dest='restart', default=False,
+                    help='Start over instead of resuming an unfinished run.'),
+        make_option('--collection', action='append', dest='collections', default=None,
+                    help='Collection to reconcile; can be given more than once.'),
+        make_option('--page-size', type='int', dest='page_size', default=None,
+                    help='Number of Core entries fetched per request.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        def report(action, collection, key, fields):
+            if options['dry_run'] or verbosity > 1:
+                line = u'{0} {1} {2}'.format(action, collection, key)
+                if fields:
+                    line += u' ({0})'.format(', '.join(fields))
+                self.stdout.write(line)
+
+        reconciler = Reconciler(dry_run=options['dry_run'],
+                                page_size=options['page_size'],
+                                collections=options['collections'],
+                                report=report)
+        stats = reconciler.reconcile(restart=options['restart'])
+        self.stdout.write(json.dumps(stats, sort_keys=True, indent=2))
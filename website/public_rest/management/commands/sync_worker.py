@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from public_rest.sync import SyncWorker
+
+
+class Command(BaseCommand):
+    help = "Push queued local changes to the Mailman Core."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Drain the due records once and exit.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=None,
+                    help='Number of records looked at per batch.'),
+        make_option('--interval', type='float', dest='interval', default=5.0,
+                    help='Seconds to sleep when there is nothing to sync.'),
+        make_option('--retry-failed', action='store_true', dest='retry_failed',
+                    default=False,
+                    help='Put the failed records back in the queue first.'),
+    )
+
+    def handle(self, *args, **options):
+        worker = SyncWorker(batch_size=options['batch_size'])
+        requeued = worker.requeue_stale()
+        if requeued:
+            self.stdout.write("Requeued {0} stale records".format(requeued))
+        if options['retry_failed']:
+            retried = worker.retry_failed()
+            self.stdout.write("Requeued {0} failed records".format(retried))
+        while True:
+            result = worker.drain()
+            if result['synced'] or result['failed']:
+                self.stdout.write("Synced {synced}, failed {failed}".format(**result))
+            if options['once']:
+                break
+            if not result['synced'] and not result['failed']:
+                time.sleep(options['interval'])
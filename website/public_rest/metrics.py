@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Prometheus style metrics of the REST layer and of the Core client.
+
+Recording a value must stay cheap, since it happens on every request and
+every Core call. Each thread adds to its own shard of the registry, so
+no lock is taken on the way; the shards are only merged when the
+metrics are collected.
+
+Under a multi-process WSGI server every process has its own registry.
+With `MAILMAN_METRICS_DIR` set, each process writes its merged values to
+a file of that directory every `MAILMAN_METRICS_FLUSH_INTERVAL` seconds
+(and when collected), and `/metrics` adds up the files of all of them.
+Counters and histograms are sums, so the total stays correct whichever
+process answers the scrape.
+"""
+
+import bisect
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def metrics_dir():
+    return getattr(settings, 'MAILMAN_METRICS_DIR', None)
+
+
+def flush_interval():
+    return getattr(settings, 'MAILMAN_METRICS_FLUSH_INTERVAL', 5)
+
+
+def escape(value):
+    return unicode(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def key(self, labels):
+        return (self.name, tuple(unicode(labels.get(name, '')) for name in self.labelnames))
+
+    def labels_text(self, values, extra=()):
+        pairs = zip(self.labelnames, values) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(name, escape(value))
+                              for name, value in pairs) + '}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self.registry.shard()
+        key = self.key(labels)
+        shard[key] = shard.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def expose(self, values, lines):
+        for labels, value in sorted(values):
+            lines.append('{0}{1} {2}'.format(self.name, self.labels_text(labels),
+                                             format_value(value)))
+
+
+class Histogram(Metric):
+    """
+    Values are kept per bucket (not cumulated), followed by the sum and
+    the count of the observations.
+    """
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        shard = self.registry.shard()
+        key = self.key(labels)
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0] * (len(self.buckets) + 3)
+        # The last bucket is +Inf.
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+        self.registry.maybe_flush()
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def expose(self, values, lines):
+        for labels, counts in sorted(values):
+            cumulated = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulated += count
+                le = bound if bound == '+Inf' else format_value(bound)
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, self.labels_text(labels, [('le', le)]), cumulated))
+            lines.append('{0}_sum{1} {2}'.format(self.name, self.labels_text(labels),
+                                                 format_value(counts[-2])))
+            lines.append('{0}_count{1} {2}'.format(self.name, self.labels_text(labels),
+                                                   format_value(counts[-1])))
+
+
+class Registry(object):
+    """The metrics of this process, and their per-thread shards."""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Shards are only ever written by their own thread. They outlive
+        # it, so that nothing counted is lost.
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._shards = []
+        self._last_flush = time.time()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Duplicate metric: {0}".format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def shard(self):
+        if self.pid != os.getpid():
+            # A forked worker must not report what its parent counted.
+            with self._lock:
+                if self.pid != os.getpid():
+                    self._reset()
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def values(self):
+        """Merge the shards into a dict of `(name, labels)` to value."""
+        with self._lock:
+            shards = list(self._shards)
+        merged = {}
+        for shard in shards:
+            # items() copies the dict in one go, while its thread may be
+            # adding to it.
+            for key, value in shard.items():
+                if isinstance(value, list):
+                    value = list(value)
+                if key in merged:
+                    value = self.metrics[key[0]].merge(merged[key], value)
+                merged[key] = value
+        return merged
+
+    def path(self, pid=None):
+        return os.path.join(metrics_dir(), 'metrics-{0}.json'.format(pid or os.getpid()))
+
+    def maybe_flush(self):
+        if metrics_dir() and time.time() - self._last_flush >= flush_interval():
+            self.flush()
+
+    def flush(self):
+        """Write the values of this process to its file."""
+        directory = metrics_dir()
+        if not directory:
+            return
+        self._last_flush = time.time()
+        samples = [[name, list(labels), value] for (name, labels), value in self.values().items()]
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(samples, f)
+            os.rename(tmp, self.path())
+        except (IOError, OSError) as e:
+            logger.warning("Could not write metrics to {0}: {1}".format(directory, e))
+
+    def collect(self):
+        """The values of every process, or just this one without a directory."""
+        if not metrics_dir():
+            return self.values()
+        self.flush()
+        merged = {}
+        for path in glob.glob(os.path.join(metrics_dir(), 'metrics-*.json')):
+            try:
+                with open(path) as f:
+                    samples = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                logger.warning("Could not read metrics from {0}: {1}".format(path, e))
+                continue
+            for name, labels, value in samples:
+                if name not in self.metrics:
+                    continue
+                key = (name, tuple(labels))
+                if key in merged:
+                    value = self.metrics[name].merge(merged[key], value)
+                merged[key] = value
+        return merged
+
+    def expose(self):
+        """The metrics in the Prometheus text format."""
+        values = {}
+        for (name, labels), value in self.collect().items():
+            values.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append('# HELP {0} {1}'.format(name, metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+            metric.expose(values.get(name, []), lines)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_DURATION = registry.histogram(
+    'mailman_rest_request_duration_seconds',
+    'Time spent answering API requests, per viewset action.',
+    ('view', 'action', 'method', 'status'))
+CORE_CALL_DURATION = registry.histogram(
+    'mailman_core_call_duration_seconds',
+    'Time spent in calls to the Mailman Core, per endpoint.',
+    ('method', 'endpoint'))
+CORE_CALLS = registry.counter(
+    'mailman_core_calls_total',
+    'Calls to the Mailman Core, per endpoint and response status.',
+    ('method', 'endpoint', 'status'))
+CORE_CONNECTION_ERRORS = registry.counter(
+    'mailman_core_connection_errors_total',
+    'MailmanConnectionError raised because the Core could not be reached.',
+    ('endpoint',))
+CORE_CIRCUIT_OPEN = registry.counter(
+    'mailman_core_circuit_open_total',
+    'Core calls refused because the circuit of their endpoint was open.',
+    ('endpoint',))
+CORE_COALESCED = registry.counter(
+    'mailman_core_coalesced_total',
+    'Core GETs answered by an identical request already in flight.',
+    ('endpoint',))
+CORE_CACHE = registry.counter(
+    'mailman_core_cache_requests_total',
+    'Core GET requests looked up in the response cache, per result.',
+    ('result',))
+PULL_THROUGH = registry.counter(
+    'mailman_pull_through_total',
+    'Local lookups that found nothing and asked the Core, per result.',
+    ('object_type', 'result'))
+SYNC_FAILURES = registry.counter(
+    'mailman_sync_failures_total',
+    'Saves that could not be pushed to the Core.',
+    ('object_type',))
+
+
+class RequestMetricsMixin(object):
+    """Observes the duration of every request to a viewset."""
+
+    def dispatch(self, request, *args, **kwargs):
+        started = time.time()
+        response = super(RequestMetricsMixin, self).dispatch(request, *args, **kwargs)
+        method = request.method.lower()
+        action = getattr(self, 'action_map', {}).get(method, method)
+        REQUEST_DURATION.observe(time.time() - started, view=self.__class__.__name__,
+                                 action=action, method=request.method,
+                                 status=response.status_code)
+        return response
+
+
+def metrics(request):
+    """
+    Expose the metrics, to the addresses of `MAILMAN_METRICS_ALLOWED_IPS`
+    if set.
+    """
+    allowed = getattr(settings, 'MAILMAN_METRICS_ALLOWED_IPS', None)
+    if allowed is not None and request.META.get('REMOTE_ADDR') not in allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.expose(), content_type=CONTENT_TYPE)
@@ -4,7 +4,8 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.hashers import check_password, make_password
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
-from django.db import models
+from django.db import models, transaction
+from django.db.models.query import QuerySet
 from django.http import Http404
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -13,6 +14,7 @@ from public_rest.signals import sig_email
 from public_rest.adaptors import *
 from public_rest.interface import *
 from public_rest.api import *
+from public_rest import authz
 
 from settings import MAILMAN_API_URL, MAILMAN_USER, MAILMAN_PASS
 
@@ -211,38 +213,54 @@ class CoreListMixin(models.Model):
     domain = models.ForeignKey('Domain')
     settings = models.OneToOneField(ListSettings, null=True, related_name='mailinglist')
 
+    def list_addresses(self):
+        """The addresses of the list, derived from its name and host."""
+        return dict(
+            join_address=u'{0}-join@{1}'.format(self.list_name, self.mail_host),
+            bounces_address=u'{0}-bounces@{1}'.format(self.list_name, self.mail_host),
+            leave_address=u'{0}-leave@{1}'.format(self.list_name, self.mail_host),
+            no_reply_address=u'noreply@{0}'.format(self.mail_host),
+            owner_address=u'{0}-owner@{1}'.format(self.list_name, self.mail_host),
+            request_address=u'{0}-request@{1}'.format(self.list_name, self.mail_host))
+
+    def provision_settings(self):
+        """Fill in the settings of a new list, and save them once."""
+        settings = self.settings or ListSettings()
+        for name, address in self.list_addresses().items():
+            if not getattr(settings, name):
+                setattr(settings, name, address)
+        # Postorius is inconsistent in using these via settings or directly
+        settings.fqdn_listname = self.fqdn_listname
+        settings.mail_host = self.mail_host
+        settings.display_name = self.display_name
+        settings.save()
+        return settings
+
     def save(self, *args, **kwargs):
-        """Populate these settings for the current MailingList instance."""
-        if self.pk is None:
-            # Save the list
-            super(CoreListMixin, self).save(*args, **kwargs)
-            # Make sure settings are present
-            if self.settings is None:
-                settings = ListSettings(fqdn_listname=self.fqdn_listname)
-                settings.save()
-                self.settings = settings
+        """
+        A new list is inserted along with its settings, in a single
+        transaction, then pushed to the Core with a single sync.
+        """
+        if self.pk is not None:
             super(CoreListMixin, self).save(*args, **kwargs)
-            # Populate
-            if not self.settings.join_address:
-                self.settings.join_address = u'{0}-join@{1}'.format(self.list_name, self.mail_host)
-            if not self.settings.bounces_address:
-                self.settings.bounces_address = u'{0}-bounces@{1}'.format(self.list_name, self.mail_host)
-            if not self.settings.leave_address:
-                self.settings.leave_address = u'{0}-leave@{1}'.format(self.list_name, self.mail_host)
-            if not self.settings.no_reply_address:
-                self.settings.no_reply_address = u'noreply@{0}'.format(self.mail_host)
-            if not self.settings.owner_address:
-                self.settings.owner_address = u'{0}-owner@{1}'.format(self.list_name, self.mail_host)
-            if not self.fqdn_listname:
-                self.fqdn_listname = u'{0}@{1}'.format(self.list_name, self.mail_host)
-            if not self.settings.request_address:
-                self.settings.request_address = u'{0}-request@{1}'.format(self.list_name, self.mail_host)
-            # Postorius is inconsistent in using these via settings or directly
-            self.settings.fqdn_listname = self.fqdn_listname
-            self.settings.mail_host = self.mail_host
-            self.settings.display_name = self.display_name
-            self.settings.save()
-        super(CoreListMixin, self).save(*args, **kwargs)
+            return
+        if not self.fqdn_listname:
+            self.fqdn_listname = u'{0}@{1}'.format(self.list_name, self.mail_host)
+        with transaction.commit_on_success():
+            with suppress_sync():
+                self.settings = self.provision_settings()
+                super(CoreListMixin, self).save(*args, **kwargs)
+        self.process_on_save_signal(self.__class__, instance=self, created=True)
+
+    def sync_backup(self, created=False, fields=None):
+        """A new list is created in the Core, then given its settings."""
+        super(CoreListMixin, self).sync_backup(created=created, fields=fields)
+        if created and self.partial_URL and self.settings is not None:
+            settings = self.settings
+            settings.partial_URL = u'{0}/config'.format(self.partial_URL)
+            with suppress_sync():
+                settings.save(update_fields=['partial_URL'])
+            settings.patch_backup(settings.prepare_backing_data())
 
 
 class LocalListMixin(models.Model):
@@ -361,10 +379,8 @@ class Domain(BaseModel, AbstractRemotelyBackedObject):
     def create_list(self, list_name, **kwargs):
         """Create a mailing list on this domain"""
         fqdn_listname = u'{0}@{1}'.format(list_name, self.mail_host)
-        ml = MailingList(list_name=list_name, mail_host=self.mail_host,\
-                domain=self, fqdn_listname=fqdn_listname, **kwargs)
-        ml.save()
-        return ml
+        return MailingList.objects.create_list(list_name, self.mail_host, fqdn_listname,
+                                               domain=self, **kwargs)
 
     def __unicode__(self):
         return self.mail_host
@@ -393,7 +409,7 @@ class Email(BaseModel):
         return self.user.display_name
 
     def save(self, *args, **kwargs):
-        if self.pk is None:
+        if self.pk is None and self.preferences_id is None:
             preferences = EmailPrefs()
             preferences.save()
             self.preferences = preferences
@@ -413,13 +429,30 @@ class Email(BaseModel):
 class UserManager(BaseUserManager):
 
     def create(self, display_name, password, email=None):
+        """
+        Create a user along with its preferred email and both their
+        preferences, in a single transaction, then push it to the Core
+        once. An existing email without a user is taken over.
+        """
         if not display_name:
             raise ValueError("No display_name Provided!")
         if not password:
             raise ValueError("No Password Provided!")
-        user = self.model(display_name=display_name)
-        user.create_preferred_email(address=email)
-        user.set_password(password)
+        if not email:
+            raise ValueError("No email Provided!")
+        user = self.model(display_name=display_name, password=make_password(password))
+        with transaction.commit_on_success():
+            with suppress_sync():
+                try:
+                    email = Email.objects.get(address=email, user=None)
+                except Email.DoesNotExist:
+                    email = Email(address=email)
+                    email.save()
+                user.preferred_email = email
+                user.save(using=self._db)
+                Email.objects.filter(pk=email.pk).update(user=user)
+                email.user = user
+        user.process_on_save_signal(self.model, instance=user, created=True)
         return user
 
     def create_superuser(self, display_name, email, password):
@@ -497,7 +530,7 @@ class AbstractUser(BaseModel, AbstractBaseUser, PermissionsMixin):
         return self.display_name
 
     def save(self, *args, **kwargs):
-        if self.pk is None:
+        if self.pk is None and self.preferences_id is None:
             preferences = UserPrefs()
             preferences.save()
             self.preferences = preferences
@@ -512,6 +545,7 @@ class User(AbstractUser, AbstractRemotelyBackedObject):
             ('preferred_email.address', 'email')]
     object_type = 'user'
     adaptor = UserAdaptor
+    posts_backing_data = True
 
 
 class BasePrefs(BaseModel, AbstractRemotelyBackedDefault):
@@ -542,6 +576,23 @@ class BasePrefs(BaseModel, AbstractRemotelyBackedDefault):
         setattr(self, key, val)
         self.save()
 
+    @classmethod
+    def create_many(cls, count):
+        """
+        Insert `count` default preferences with one bulk insert, and
+        return them with their primary keys. bulk_create can't give those
+        back, so the new rows are tagged until they have been read.
+        """
+        if not count:
+            return []
+        tag = u'bulk:{0}:'.format(uuid.uuid4().hex)
+        local = QuerySet(model=cls)
+        local.bulk_create([cls(partial_URL=u'{0}{1}'.format(tag, n)) for n in range(count)])
+        tagged = local.filter(partial_URL__startswith=tag)
+        pks = dict(tagged.values_list('partial_URL', 'pk'))
+        tagged.update(partial_URL=None)
+        return [cls(pk=pks[u'{0}{1}'.format(tag, n)]) for n in range(count)]
+
 
 class UserPrefs(BasePrefs):
     object_type = 'userprefs'
@@ -564,11 +615,93 @@ class MembershipPrefs(BasePrefs):
     lookup_field = 'address'
 
 
+class SyncRecord(models.Model):
+    """
+    An entry of the outbox: a local object that still has to be
+    pushed to the Core by the sync worker.
+    """
+    PENDING = 'pending'
+    SYNCING = 'syncing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+            (PENDING, 'Pending'),
+            (SYNCING, 'Syncing'),
+            (DONE, 'Done'),
+            (FAILED, 'Failed'),
+    )
+
+    model_name = models.CharField(max_length=50)
+    object_type = models.CharField(max_length=30, blank=True)
+    object_pk = models.IntegerField()
+    created = models.BooleanField(default=False)
+    # Comma separated remote field names, blank for all of them.
+    changed_fields = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('id',)
+        index_together = (('model_name', 'object_pk'),)
+
+    def __unicode__(self):
+        return '{0}({1}) {2}'.format(self.model_name, self.object_pk, self.status)
+
+
+class ReconcileRun(models.Model):
+    """
+    A pass of the reconciler over the Core collections. The collection
+    and page it got to are saved after every page, so that an
+    interrupted run can be resumed.
+    """
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+            (RUNNING, 'Running'),
+            (DONE, 'Done'),
+            (FAILED, 'Failed'),
+    )
+
+    dry_run = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=RUNNING, db_index=True)
+    collection = models.CharField(max_length=20, blank=True)
+    page = models.IntegerField(default=1)
+    # JSON counters of the changes, per collection.
+    stats = models.TextField(blank=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return 'Reconcile run {0} {1}'.format(self.pk, self.status)
+
+
+class ReconcileSeen(models.Model):
+    """A local object that a run found in the Core."""
+    run = models.ForeignKey(ReconcileRun)
+    model_name = models.CharField(max_length=50)
+    object_pk = models.IntegerField()
+
+    class Meta:
+        index_together = (('run', 'model_name', 'object_pk'),)
+
+
 class Membership(BaseModel, AbstractRemotelyBackedObject):
     """A Membership is created when a User subscribes to a MailingList"""
 
     object_type = 'membership'
     adaptor = MembershipAdaptor
+    bulk_insert = True
     lookup_field = 'address'              #TODO: This has to be unique, but for memberships, email isn't.
 
     fields = [ ('user.display_name', 'user'),
@@ -588,6 +721,9 @@ class Membership(BaseModel, AbstractRemotelyBackedObject):
 
     class Meta:
         unique_together = (("mlist", "address", "role"),)
+        # Rosters and subscriptions are paginated by id.
+        index_together = (("mlist", "role", "id"),
+                          ("user", "role", "id"),)
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
     mlist = models.ForeignKey(MailingList, null=True)
@@ -617,6 +753,14 @@ class Membership(BaseModel, AbstractRemotelyBackedObject):
     def __unicode__(self):
         return '{0} on {1}'.format(self.address, self.mlist.fqdn_listname)
 
+    @classmethod
+    def prepare_bulk_insert(cls, instances):
+        # bulk_create bypasses save(), which is what creates preferences.
+        missing = [membership for membership in instances if membership.preferences_id is None]
+        for membership, preferences in zip(missing, MembershipPrefs.create_many(len(missing))):
+            membership.preferences = preferences
+        authz.invalidate_memberships(instances)
+
     def save(self, *args, **kwargs):
         if self.pk is None:
             preferences = MembershipPrefs()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Keyset (cursor) pagination for large collections.
+
+Offset pagination counts the whole collection and makes the database
+skip every row before the requested page, and its pages shift while
+members join or leave. A `CursorPaginator` remembers the position of
+the first and last rows it returned and continues from there instead,
+over a unique and indexed ordering, so a deep page costs as much as the
+first one. Cursors are opaque to clients: they only follow the `next`
+and `previous` links of a response.
+"""
+
+import base64
+import json
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models.query import QuerySet, EmptyQuerySet
+from rest_framework.exceptions import ParseError
+from rest_framework.templatetags.rest_framework import replace_query_param
+
+from public_rest.serializers import optimize_queryset
+
+logger = logging.getLogger(__name__)
+
+CURSOR_PARAM = 'cursor'
+PAGE_SIZE_PARAM = 'page_size'
+COUNT_PARAM = 'count'
+
+COUNT_EXACT = 'exact'
+COUNT_ESTIMATE = 'estimate'
+
+
+class InvalidCursor(ParseError):
+    default_detail = 'Invalid cursor'
+
+
+def encode_cursor(position, reverse=False):
+    data = json.dumps({'p': position, 'r': int(reverse)})
+    return base64.urlsafe_b64encode(data)
+
+
+def decode_cursor(cursor, field=None):
+    """
+    Return the `(position, reverse)` pair stored in a cursor. With a
+    model `field`, the position is converted to a value of that field.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        position, reverse = data['p'], bool(data['r'])
+        if not isinstance(position, (basestring, int, long, float)):
+            raise InvalidCursor()
+        if field is not None:
+            position = field.to_python(position)
+        return position, reverse
+    except (TypeError, ValueError, KeyError, AttributeError, UnicodeEncodeError,
+            ValidationError):
+        raise InvalidCursor()
+
+
+def get_page_size(request):
+    """
+    The page size asked for with `?page_size=`, capped at
+    `MAILMAN_MAX_PAGE_SIZE`.
+    """
+    default = getattr(settings, 'MAILMAN_PAGE_SIZE', 10)
+    maximum = getattr(settings, 'MAILMAN_MAX_PAGE_SIZE', 100)
+    try:
+        size = int(request.QUERY_PARAMS.get(PAGE_SIZE_PARAM, default))
+    except (TypeError, ValueError):
+        size = default
+    if size < 1:
+        size = default
+    return min(size, maximum)
+
+
+def estimate_count(queryset):
+    """
+    A cheap estimate of the number of rows in `queryset`.
+
+    PostgreSQL gives the planner's estimate, which does not scan the
+    rows. Other databases have no such estimate and fall back to an
+    exact COUNT.
+    """
+    if isinstance(queryset, EmptyQuerySet):
+        return 0
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN (FORMAT JSON) {0}'.format(sql), params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class CursorPage(object):
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class CursorPaginator(object):
+    """
+    Paginates a queryset by the value of a unique field.
+
+    :param queryset: The rows to paginate.
+    :param page_size: Number of rows on a page.
+    :param ordering: A unique field, prefixed with '-' for a descending
+        order. Its values have to be JSON serializable.
+    """
+
+    def __init__(self, queryset, page_size, ordering='pk'):
+        # Keep the queries local: a remote queryset asks the Core again
+        # whenever a filter matches nothing, such as past the last page.
+        if not isinstance(queryset, EmptyQuerySet):
+            queryset = queryset._clone(klass=QuerySet)
+        self.queryset = queryset
+        self.page_size = page_size
+        self.ordering = ordering
+        self.descending = ordering.startswith('-')
+        self.field = ordering.lstrip('-')
+
+    def _model_field(self):
+        opts = self.queryset.model._meta
+        field = opts.pk if self.field == 'pk' else opts.get_field(self.field)
+        # A foreign key holds a value of the field it points to.
+        if field.rel is not None:
+            field = field.rel.get_related_field()
+        return field
+
+    def _position(self, obj):
+        if self.field == 'pk':
+            return obj.pk
+        return getattr(obj, obj._meta.get_field(self.field).attname)
+
+    def _after(self, position, reverse):
+        # Rows after `position` in the pagination order, or before it
+        # when paging backwards.
+        lookup = 'lt' if self.descending != reverse else 'gt'
+        return self.queryset.filter(**{'{0}__{1}'.format(self.field, lookup): position})
+
+    def page(self, cursor=None):
+        if cursor:
+            position, reverse = decode_cursor(cursor, self._model_field())
+            queryset = self._after(position, reverse)
+        else:
+            position, reverse = None, False
+            queryset = self.queryset
+        if reverse:
+            ordering = self.field if self.descending else '-' + self.field
+        else:
+            ordering = self.ordering
+        rows = list(queryset.order_by(ordering)[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            first, last = self._position(rows[0]), self._position(rows[-1])
+            if reverse:
+                # We came back from the page after this one.
+                next_cursor = encode_cursor(last)
+                if has_more:
+                    previous_cursor = encode_cursor(first, reverse=True)
+            else:
+                if has_more:
+                    next_cursor = encode_cursor(last)
+                if position is not None:
+                    previous_cursor = encode_cursor(first, reverse=True)
+        return CursorPage(rows, next_cursor, previous_cursor)
+
+
+def paginate(request, queryset, serializer_class, ordering='pk', context=None):
+    """
+    Serialize one page of `queryset` for `request`.
+
+    Returns a dict with the `results`, links to the `next` and
+    `previous` pages, and a `count` that is only computed when asked
+    for with `?count=exact` or `?count=estimate`.
+    """
+    queryset = optimize_queryset(queryset, serializer_class)
+    paginator = CursorPaginator(queryset, get_page_size(request), ordering=ordering)
+    page = paginator.page(request.QUERY_PARAMS.get(CURSOR_PARAM))
+
+    url = request.build_absolute_uri()
+    links = {}
+    for name, cursor in (('next', page.next_cursor), ('previous', page.previous_cursor)):
+        links[name] = cursor and replace_query_param(url, CURSOR_PARAM, cursor) or None
+
+    count = None
+    wanted = request.QUERY_PARAMS.get(COUNT_PARAM)
+    if wanted == COUNT_EXACT:
+        count = paginator.queryset.count()
+    elif wanted == COUNT_ESTIMATE:
+        count = estimate_count(paginator.queryset)
+
+    serializer = serializer_class(page.object_list, many=True,
+                                  context=context or {'request': request})
+    return dict(count=count, next=links['next'], previous=links['previous'],
+                results=serializer.data)
@@ -2,9 +2,10 @@
 # -*- coding: utf-8 -*-
 import logging
 from django.core.exceptions import PermissionDenied
-from public_rest.models import Membership
 from rest_framework import permissions
 
+from public_rest import authz
+
 logger = logging.getLogger(__name__)
 
 class BasePermission(permissions.BasePermission):
@@ -35,9 +36,7 @@ class BaseMembershipPermission(BasePermission):
         #TODO: Even in the case of empty memberships, we can grant permission.
         logger.debug("Incoming user: {0}".format(user, type(user)))
         if user and user.is_authenticated():
-            memberships = Membership.objects.filter(user=user, role=role)
-            if memberships and memberships.exists():
-                return True
+            return authz.get_context(request, user).has_role(role)
         return False
 
 
@@ -71,6 +70,14 @@ class IsOwnerOrModeratorPermission(BaseMembershipPermission):
         return is_owner or is_moderator
 
 
+class IsSuperuserOrOwnerOrModeratorPermission(IsOwnerOrModeratorPermission):
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_superuser:
+            return True
+        return super(IsSuperuserOrOwnerOrModeratorPermission, self).has_permission(request, view)
+
+
 class IsOwnerOrReadOnlyPermission(BaseMembershipPermission):
 
     def has_permission(self, request, view):
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pooled keep-alive HTTP connections to the Mailman Core.
+
+`httplib2.Http` keeps its sockets open between requests, but it is not
+thread-safe, so a single instance can not be shared by every request
+thread. A `ConnectionPool` hands out `Http` objects one at a time and
+takes them back afterwards, so sockets get reused instead of paying a
+TCP setup for every call made by `api.Connection`.
+"""
+
+import logging
+import threading
+import time
+
+from httplib2 import Http
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(IOError):
+    """No pooled connection became free in time."""
+    pass
+
+
+class PooledHttp(object):
+    """An `Http` object along with its bookkeeping in the pool."""
+
+    def __init__(self, timeout=None):
+        self.http = Http(timeout=timeout)
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.requests = 0
+
+    def request(self, *args, **kwargs):
+        self.requests += 1
+        self.last_used = time.time()
+        return self.http.request(*args, **kwargs)
+
+    def close(self):
+        for conn in self.http.connections.values():
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.http.connections.clear()
+
+
+class ConnectionPool(object):
+    """
+    A bounded, thread-safe pool of keep-alive connections.
+
+    :param size: Maximum number of connections, idle or in use.
+    :param idle_timeout: Seconds after which an idle connection is closed
+        instead of being reused.
+    :param max_requests: Number of requests after which a connection is
+        retired. `None` or 0 means no limit.
+    :param wait_timeout: Seconds to wait for a free connection when the
+        pool is exhausted. `None` waits forever.
+    :param timeout: Socket timeout for the underlying `Http` objects.
+    """
+
+    def __init__(self, size=10, idle_timeout=60, max_requests=1000,
+                 wait_timeout=None, timeout=None):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.wait_timeout = wait_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = dict(hits=0, waits=0, new_connections=0,
+                           expired=0, discarded=0)
+
+    def __repr__(self):
+        return '<ConnectionPool size={0} idle={1} in_use={2}>'.format(
+            self.size, len(self._idle), self._in_use)
+
+    def _is_stale(self, conn):
+        if self.idle_timeout and time.time() - conn.last_used > self.idle_timeout:
+            return True
+        if self.max_requests and conn.requests >= self.max_requests:
+            return True
+        return False
+
+    def acquire(self):
+        """Take a connection out of the pool, creating one if allowed."""
+        deadline = None
+        if self.wait_timeout is not None:
+            deadline = time.time() + self.wait_timeout
+        with self._cond:
+            waited = False
+            while True:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if self._is_stale(conn):
+                        self._stats['expired'] += 1
+                        conn.close()
+                        continue
+                    self._in_use += 1
+                    self._stats['hits'] += 1
+                    return conn
+                if self._in_use < self.size:
+                    self._in_use += 1
+                    self._stats['new_connections'] += 1
+                    break
+                if not waited:
+                    self._stats['waits'] += 1
+                    waited = True
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeoutError("No free connection in {0!r}".format(self))
+                    self._cond.wait(remaining)
+        # Build the new connection outside of the lock.
+        try:
+            return PooledHttp(timeout=self.timeout)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        """
+        Give a connection back. Broken connections should be released
+        with `discard=True` so they are closed instead of reused.
+        """
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._is_stale(conn):
+                self._stats['discarded'] += 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def request(self, *args, **kwargs):
+        """Run one `Http.request` on a pooled connection."""
+        conn = self.acquire()
+        try:
+            rv = conn.request(*args, **kwargs)
+        except Exception:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+        return rv
+
+    def clear(self):
+        """Close every idle connection."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        """Counters useful for sizing the pool."""
+        with self._cond:
+            rv = dict(self._stats)
+            rv.update(size=self.size, idle=len(self._idle), in_use=self._in_use)
+        return rv
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(base_url):
+    """Return the shared pool for a Core base URL, creating it on first use."""
+    with _pools_lock:
+        pool = _pools.get(base_url)
+        if pool is None:
+            pool = ConnectionPool(
+                size=getattr(settings, 'MAILMAN_POOL_SIZE', 10),
+                idle_timeout=getattr(settings, 'MAILMAN_POOL_IDLE_TIMEOUT', 60),
+                max_requests=getattr(settings, 'MAILMAN_POOL_MAX_REQUESTS', 1000),
+                wait_timeout=getattr(settings, 'MAILMAN_POOL_WAIT_TIMEOUT', None),
+                timeout=getattr(settings, 'MAILMAN_API_TIMEOUT', 10))
+            _pools[base_url] = pool
+            logger.debug("Created connection pool for {0}".format(base_url))
+        return pool
+
+
+def pool_stats():
+    """Statistics of every pool, keyed by base URL."""
+    with _pools_lock:
+        pools = dict(_pools)
+    return dict((url, pool.stats()) for url, pool in pools.items())
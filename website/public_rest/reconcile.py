@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reconciliation of the local mirror with the Core.
+
+`RemoteObjectQuerySet.filter` only pulls records from the Core when
+nothing matches locally, so mirrored rows are never refreshed, and
+rows deleted in the Core stay around. A `Reconciler` walks the Core
+collections page by page instead, and compares every entry with the
+local row having the same key (its `partial_URL`, or the address for
+emails) by hashing the values both would store. Only the differences
+are applied: missing rows are inserted, changed rows are updated, and
+local rows the Core no longer has are deleted (tombstoned) at the end
+of each collection.
+
+Progress is saved in a `ReconcileRun` after every page, so an
+interrupted run resumes where it stopped. A dry run applies nothing
+and only reports what would change.
+"""
+
+import hashlib
+import json
+import logging
+from functools import partial
+from urllib2 import HTTPError
+from urlparse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+from public_rest import fanout
+from public_rest.interface import ci, suppress_sync
+from public_rest.models import (Domain, Email, MailingList, Membership,
+                                ReconcileRun, ReconcileSeen, User)
+from public_rest.utils import iterate_values
+
+logger = logging.getLogger(__name__)
+
+INSERT = 'insert'
+UPDATE = 'update'
+TOMBSTONE = 'tombstone'
+SKIP = 'skip'
+UNCHANGED = 'unchanged'
+
+
+def local(model):
+    return QuerySet(model=model)
+
+
+def content_hash(values):
+    data = json.dumps(values, sort_keys=True, default=unicode)
+    return hashlib.sha1(data).hexdigest()
+
+
+def link_path(url):
+    return urlsplit(url).path if url else None
+
+
+class Collection(object):
+    """
+    How the entries of one Core collection map to a local model.
+
+    Subclasses give the Core `endpoint`, the local `model`, and turn
+    entries into local field values with `values`.
+    """
+    name = None
+    endpoint = None
+    model = None
+    # Local field matching `key(entry)`
+    key_field = 'partial_URL'
+    # Whether local rows missing from the Core are deleted
+    tombstones = True
+    # Whether new rows are written with bulk_create instead of save()
+    bulk = False
+
+    def key(self, entry):
+        return link_path(entry['self_link'])
+
+    def prepare(self, entries):
+        """Load whatever `values` needs for a page, in a few queries."""
+        pass
+
+    def values(self, entry):
+        """
+        The local field values for `entry`, keyed by attribute name, or
+        None if it can't be mirrored (yet).
+        """
+        raise NotImplementedError
+
+    def defaults(self):
+        """Values only set on the rows that are inserted."""
+        return {}
+
+    def local_values(self, instance, names):
+        return dict((name, getattr(instance, name)) for name in names)
+
+    def insert(self, instances):
+        if self.bulk:
+            self.model.prepare_bulk_insert(instances)
+            local(self.model).bulk_create(instances)
+        else:
+            for instance in instances:
+                instance.save()
+
+
+class DomainCollection(Collection):
+    name = 'domains'
+    endpoint = 'domains'
+    model = Domain
+
+    def values(self, entry):
+        return dict(base_url=entry.get('base_url') or u'',
+                    mail_host=entry['mail_host'],
+                    description=entry.get('description') or u'',
+                    contact_address=entry.get('contact_address') or u'')
+
+
+class ListCollection(Collection):
+    name = 'lists'
+    endpoint = 'lists'
+    model = MailingList
+
+    def prepare(self, entries):
+        hosts = set(entry['mail_host'] for entry in entries)
+        self.domains = dict(local(Domain).filter(mail_host__in=hosts)
+                                         .values_list('mail_host', 'pk'))
+
+    def values(self, entry):
+        domain_id = self.domains.get(entry['mail_host'])
+        if domain_id is None:
+            return None
+        return dict(fqdn_listname=entry['fqdn_listname'],
+                    list_name=entry['list_name'],
+                    mail_host=entry['mail_host'],
+                    display_name=entry.get('display_name') or u'',
+                    domain_id=domain_id)
+
+
+class UserCollection(Collection):
+    name = 'users'
+    endpoint = 'users'
+    model = User
+
+    def values(self, entry):
+        # Local users are identified by their display name, and the
+        # Core does not require one.
+        if not entry.get('display_name'):
+            return None
+        return dict(display_name=entry['display_name'])
+
+    def defaults(self):
+        # Users log in through the Core, or reset their password.
+        return dict(password=make_password(None))
+
+
+class AddressCollection(Collection):
+    name = 'addresses'
+    endpoint = 'addresses'
+    model = Email
+    key_field = 'address'
+    # Emails are not remotely backed: one missing from the Core may well
+    # be waiting for its user to be synced.
+    tombstones = False
+
+    def key(self, entry):
+        return entry['email']
+
+    def prepare(self, entries):
+        links = set(link_path(entry.get('user')) for entry in entries)
+        links.discard(None)
+        self.users = dict(local(User).filter(partial_URL__in=links)
+                                     .values_list('partial_URL', 'pk'))
+
+    def values(self, entry):
+        values = dict(address=entry['email'], verified=bool(entry.get('verified_on')))
+        user_id = self.users.get(link_path(entry.get('user')))
+        if user_id is not None:
+            values['user_id'] = user_id
+        return values
+
+
+class MemberCollection(Collection):
+    name = 'members'
+    endpoint = 'members'
+    model = Membership
+    bulk = True
+
+    lists = None
+
+    def prepare(self, entries):
+        if self.lists is None:
+            # Lists were reconciled before, and don't change meanwhile.
+            self.lists = dict((u'{0}.{1}'.format(list_name, mail_host), pk)
+                              for pk, list_name, mail_host in
+                              local(MailingList).values_list('pk', 'list_name', 'mail_host'))
+        self.emails = dict((address, (pk, user_id)) for pk, address, user_id in
+                           local(Email).filter(address__in=[entry['address'] for entry in entries])
+                                       .values_list('pk', 'address', 'user_id'))
+        links = set(link_path(entry.get('user')) for entry in entries)
+        links.discard(None)
+        self.users = dict(local(User).filter(partial_URL__in=links)
+                                     .values_list('partial_URL', 'pk'))
+
+    def values(self, entry):
+        mlist_id = self.lists.get(entry['list_id'])
+        email = self.emails.get(entry['address'])
+        if mlist_id is None or email is None:
+            return None
+        address_id, user_id = email
+        user_id = self.users.get(link_path(entry.get('user')), user_id)
+        if user_id is None:
+            return None
+        return dict(role=entry['role'], mlist_id=mlist_id,
+                    address_id=address_id, user_id=user_id)
+
+
+# In dependency order: a collection only refers to the ones before it.
+COLLECTIONS = (DomainCollection, ListCollection, UserCollection,
+               AddressCollection, MemberCollection)
+
+
+class Reconciler(object):
+    """
+    Brings the local mirror in line with the Core.
+
+    :param dry_run: Only report the changes.
+    :param page_size: Number of Core entries fetched per request.
+    :param collections: Names of the collections to walk, by default
+        all of them.
+    :param report: Called with `(action, collection, key, fields)` for
+        every change, applied or not.
+    """
+
+    def __init__(self, dry_run=False, page_size=None, collections=None, report=None):
+        self.dry_run = dry_run
+        self.page_size = page_size or getattr(settings, 'MAILMAN_RECONCILE_PAGE_SIZE', 500)
+        self.collections = [cls() for cls in COLLECTIONS
+                            if collections is None or cls.name in collections]
+        self.report = report or (lambda *args: None)
+        self.run = None
+        self.stats = {}
+
+    def start(self, restart=False):
+        """
+        Resume the last unfinished run, or start a new one. With
+        `restart`, unfinished runs are given up instead.
+        """
+        runs = ReconcileRun.objects.filter(status=ReconcileRun.RUNNING, dry_run=self.dry_run)
+        if restart:
+            runs.update(status=ReconcileRun.FAILED, updated_at=timezone.now())
+        else:
+            self.run = (list(runs.order_by('-id')[:1]) or [None])[0]
+        if self.run is None:
+            self.run = ReconcileRun.objects.create(dry_run=self.dry_run)
+        self.stats = json.loads(self.run.stats) if self.run.stats else {}
+        return self.run
+
+    def reconcile(self, restart=False):
+        """Walk every collection and return the counters of the changes."""
+        self.start(restart=restart)
+        names = [collection.name for collection in self.collections]
+        first = 0
+        if self.run.collection in names:
+            first = names.index(self.run.collection)
+        # If anything fails, the run stays `running` and the next one
+        # resumes it from the last page saved.
+        for index, collection in enumerate(self.collections[first:]):
+            page = self.run.page if index == 0 and self.run.collection else 1
+            self.reconcile_collection(collection, page)
+        self.run.status = ReconcileRun.DONE
+        self.run.finished_at = timezone.now()
+        self.save_run()
+        ReconcileSeen.objects.filter(run=self.run).delete()
+        return self.stats
+
+    def save_run(self, collection=None, page=None):
+        if collection is not None:
+            self.run.collection = collection
+            self.run.page = page
+        self.run.stats = json.dumps(self.stats)
+        self.run.updated_at = timezone.now()
+        self.run.save()
+
+    def count(self, collection, action, n=1):
+        counters = self.stats.setdefault(collection.name, {})
+        counters[action] = counters.get(action, 0) + n
+
+    def fetch(self, collection, page):
+        path = '{0}?count={1}&page={2}'.format(collection.endpoint, self.page_size, page)
+        response, content = ci.connection.call(path, use_cache=False)
+        return content.get('entries', []) if isinstance(content, dict) else []
+
+    def reconcile_collection(self, collection, page=1):
+        logger.info("Reconciling {0} from page {1}".format(collection.name, page))
+        while True:
+            entries = self.fetch(collection, page)
+            if entries:
+                self.reconcile_page(collection, entries)
+            self.save_run(collection.name, page + 1)
+            if len(entries) < self.page_size:
+                break
+            page += 1
+        if collection.tombstones:
+            self.sweep(collection)
+
+    def reconcile_page(self, collection, entries):
+        model = collection.model
+        keys = [collection.key(entry) for entry in entries]
+        rows = dict((getattr(row, collection.key_field), row) for row in
+                    local(model).filter(**{collection.key_field + '__in': keys}))
+        collection.prepare(entries)
+        field_names = dict((field.attname, field.name) for field in model._meta.fields)
+        seen = []
+        inserts = []
+        pending = set()
+        with suppress_sync():
+            with transaction.commit_on_success():
+                for key, entry in zip(keys, entries):
+                    values = collection.values(entry)
+                    if values is None:
+                        self.count(collection, SKIP)
+                        self.report(SKIP, collection.name, key, None)
+                        continue
+                    row = rows.get(key)
+                    if row is None:
+                        if key in pending:
+                            continue
+                        pending.add(key)
+                        self.count(collection, INSERT)
+                        self.report(INSERT, collection.name, key, sorted(values))
+                        if collection.key_field == 'partial_URL':
+                            values['partial_URL'] = key
+                        values.update(collection.defaults())
+                        inserts.append(model(**values))
+                        continue
+                    seen.append(row.pk)
+                    current = collection.local_values(row, values.keys())
+                    if content_hash(current) == content_hash(values):
+                        self.count(collection, UNCHANGED)
+                        continue
+                    changed = dict((field_names[name], value) for name, value in values.items()
+                                   if current[name] != value)
+                    self.count(collection, UPDATE)
+                    self.report(UPDATE, collection.name, key, sorted(changed))
+                    if not self.dry_run:
+                        # An update() sends no signal, so nothing is pushed back.
+                        local(model).filter(pk=row.pk).update(**changed)
+                if inserts and not self.dry_run:
+                    collection.insert(inserts)
+                    inserted = [getattr(instance, collection.key_field) for instance in inserts]
+                    seen.extend(local(model).filter(**{collection.key_field + '__in': inserted})
+                                            .values_list('pk', flat=True))
+                if collection.tombstones and seen:
+                    ReconcileSeen.objects.bulk_create([
+                        ReconcileSeen(run=self.run, model_name=model._meta.object_name.lower(),
+                                      object_pk=pk) for pk in seen])
+
+    def sweep(self, collection):
+        """
+        Tombstone the mirrored rows of a collection the run did not see.
+        Each one is looked up in the Core first, and only deleted if the
+        Core answers 404, since it may have been created during the run.
+        """
+        model = collection.model
+        seen = (ReconcileSeen.objects.filter(run=self.run,
+                                             model_name=model._meta.object_name.lower())
+                                     .values('object_pk'))
+        candidates = local(model).filter(partial_URL__isnull=False).exclude(pk__in=seen)
+        chunk = []
+        for pk, partial_url in iterate_values(candidates, ['pk', 'partial_URL']):
+            chunk.append((pk, partial_url))
+            if len(chunk) == self.page_size:
+                self.tombstone(collection, chunk)
+                chunk = []
+        if chunk:
+            self.tombstone(collection, chunk)
+
+    def tombstone(self, collection, candidates):
+        """
+        Delete the `(pk, partial_url)` candidates gone from the Core. They
+        are looked up in parallel, on the fan-out pool.
+        """
+        model = collection.model
+        gone = fanout.run_parallel([partial(self.is_gone, partial_url)
+                                    for pk, partial_url in candidates])
+        for (pk, partial_url), is_gone in zip(candidates, gone):
+            if not is_gone:
+                continue
+            self.count(collection, TOMBSTONE)
+            self.report(TOMBSTONE, collection.name, partial_url, None)
+            if not self.dry_run:
+                with suppress_sync():
+                    for instance in local(model).filter(pk=pk):
+                        instance.delete()
+
+    def is_gone(self, partial_url):
+        try:
+            ci.connection.call(partial_url, use_cache=False)
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+            return True
+        return False
@@ -1,26 +1,49 @@
 from rest_framework import pagination
 from rest_framework import serializers
 from public_rest.models import *
+from public_rest.instrumentation import InstrumentedSerializerMixin
+
+
+def optimize_queryset(queryset, serializer_class):
+    """
+    Apply the `select_related` and `prefetch_related` declared in the
+    Meta of `serializer_class`, so that serializing many rows does not
+    query their relations one row at a time.
+    """
+    meta = getattr(serializer_class, 'Meta', None)
+    select_related = getattr(meta, 'select_related', ())
+    prefetch_related = getattr(meta, 'prefetch_related', ())
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    return queryset
+
+
+class HyperlinkedModelSerializer(InstrumentedSerializerMixin,
+                                 serializers.HyperlinkedModelSerializer):
+    """Base of the serializers below, timing their serialization."""
+    pass
 
 
 # Partial or Support Serializers
-class _PartialMembershipSerializer(serializers.HyperlinkedModelSerializer):
+class _PartialMembershipSerializer(HyperlinkedModelSerializer):
     class Meta:
         model = Membership
         fields = ('url', 'address')
 
 
-class _PartialMailingListSerializer(serializers.HyperlinkedModelSerializer):
+class _PartialMailingListSerializer(HyperlinkedModelSerializer):
     class Meta:
         model = MailingList
         fields = ('url', 'fqdn_listname')
 
-class _PartialEmailSerializer(serializers.HyperlinkedModelSerializer):
+class _PartialEmailSerializer(HyperlinkedModelSerializer):
     class Meta:
         model = Email
         fields = ('url', 'address')
 
-class MembershipInputSerializer(serializers.HyperlinkedModelSerializer):
+class MembershipInputSerializer(HyperlinkedModelSerializer):
     """Helper serializer for the benefit of DRF's browserable API"""
     mlist = serializers.RelatedField()
     user = serializers.CharField()
@@ -33,16 +56,17 @@ class MembershipInputSerializer(serializers.HyperlinkedModelSerializer):
 #################################################################
 
 # Primary Model Serializers
-class UserSerializer(serializers.HyperlinkedModelSerializer):
+class UserSerializer(HyperlinkedModelSerializer):
 
     class Meta:
         model = User
         fields = ('url', 'display_name', 'is_superuser',
                 'preferred_email',
                 )
+        select_related = ('preferred_email',)
 
 
-class UserDetailSerializer(serializers.HyperlinkedModelSerializer):
+class UserDetailSerializer(HyperlinkedModelSerializer):
     emails = serializers.RelatedField(many=True)
     membership_set = _PartialMembershipSerializer(many=True)
 
@@ -51,9 +75,11 @@ class UserDetailSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('url', 'display_name', 'is_superuser', 'emails',
                   'preferred_email',
                 )
+        select_related = ('preferred_email',)
+        prefetch_related = ('email_set',)
 
 
-class MembershipListSerializer(serializers.HyperlinkedModelSerializer):
+class MembershipListSerializer(HyperlinkedModelSerializer):
 
     mlist = serializers.RelatedField()
     user = serializers.RelatedField()
@@ -64,9 +90,10 @@ class MembershipListSerializer(serializers.HyperlinkedModelSerializer):
         fields = (
                 #'url',
                 'address', 'role', 'user', 'mlist',)
+        select_related = ('mlist', 'user', 'address')
 
 
-class MembershipDetailSerializer(serializers.HyperlinkedModelSerializer):
+class MembershipDetailSerializer(HyperlinkedModelSerializer):
     mlist = _PartialMailingListSerializer()
     user = serializers.HyperlinkedIdentityField(view_name='user-detail')
     address = _PartialEmailSerializer()
@@ -77,6 +104,7 @@ class MembershipDetailSerializer(serializers.HyperlinkedModelSerializer):
                 #'url',
                 'address', 'role', 'user', 'mlist',
                 )
+        select_related = ('mlist', 'address')
 
 
 class PaginatedMembershipDetailSerializer(pagination.PaginationSerializer):
@@ -85,14 +113,14 @@ class PaginatedMembershipDetailSerializer(pagination.PaginationSerializer):
         object_serializer_class = MembershipListSerializer
 
 
-class ListSettingsSerializer(serializers.HyperlinkedModelSerializer):
+class ListSettingsSerializer(HyperlinkedModelSerializer):
 
     class Meta:
         model = ListSettings
         exclude = ('partial_URL', 'id', 'http_etag', 'acceptablealias')
 
 
-class MailingListSerializer(serializers.HyperlinkedModelSerializer):
+class MailingListSerializer(HyperlinkedModelSerializer):
     """Summary of a Mailing List"""
     #XXX: mail_host should only be writable at creation time.
     # Read-only
@@ -103,7 +131,7 @@ class MailingListSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('url', 'fqdn_listname', 'list_name', 'mail_host')
 
 
-class MailingListDetailSerializer(serializers.HyperlinkedModelSerializer):
+class MailingListDetailSerializer(HyperlinkedModelSerializer):
     """Details of a Mailing List"""
     members = serializers.Field('members')
     owners = serializers.Field('owners')
@@ -126,7 +154,7 @@ class MailingListDetailSerializer(serializers.HyperlinkedModelSerializer):
                   )
 
 
-class DomainSerializer(serializers.HyperlinkedModelSerializer):
+class DomainSerializer(HyperlinkedModelSerializer):
     #mailinglist_listing = serializers.HyperlinkedIdentityField(view_name='mailinglist-list')
 
     class Meta:
@@ -134,7 +162,7 @@ class DomainSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('url', 'base_url', 'mail_host',)
 
 
-class DomainDetailSerializer(serializers.HyperlinkedModelSerializer):
+class DomainDetailSerializer(HyperlinkedModelSerializer):
     mailinglist_set = _PartialMailingListSerializer(many=True,read_only=True)
 
     class Meta:
@@ -143,12 +171,13 @@ class DomainDetailSerializer(serializers.HyperlinkedModelSerializer):
                 'description', 'mailinglist_set')
 
 
-class EmailSerializer(serializers.HyperlinkedModelSerializer):
+class EmailSerializer(HyperlinkedModelSerializer):
     user = serializers.RelatedField()
 
     class Meta:
         model = Email
         fields = ('url', 'address', 'user', 'verified')
+        select_related = ('user',)
 
 
 # Preferences
@@ -161,7 +190,7 @@ PREFERENCE_FIELDS = fields = ('url',
                 'receive_list_copy',
                 'receive_own_postings')
 
-class EmailPreferenceSerializer(serializers.HyperlinkedModelSerializer):
+class EmailPreferenceSerializer(HyperlinkedModelSerializer):
 
     class Meta:
         model = EmailPrefs
@@ -169,7 +198,7 @@ class EmailPreferenceSerializer(serializers.HyperlinkedModelSerializer):
         lookup_field = 'address'
 
 
-class MembershipPreferenceSerializer(serializers.HyperlinkedModelSerializer):
+class MembershipPreferenceSerializer(HyperlinkedModelSerializer):
 
     class Meta:
         model = MembershipPrefs
@@ -177,9 +206,17 @@ class MembershipPreferenceSerializer(serializers.HyperlinkedModelSerializer):
         lookup_field = 'address'
 
 
-class UserPreferenceSerializer(serializers.HyperlinkedModelSerializer):
+class UserPreferenceSerializer(HyperlinkedModelSerializer):
 
     class Meta:
         model = UserPrefs
         fields = PREFERENCE_FIELDS
 
+
+class SyncRecordSerializer(HyperlinkedModelSerializer):
+
+    class Meta:
+        model = SyncRecord
+        fields = ('url', 'object_type', 'object_pk', 'created', 'status',
+                  'attempts', 'next_attempt_at', 'last_error', 'created_at',
+                  'updated_at')
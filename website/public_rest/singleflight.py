@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Coalescing of concurrent identical GETs to the Core (single-flight).
+
+A popular list makes many requests call the same `lists/{id}`, config
+and roster URLs at the same time. A `SingleFlight` group lets the first
+caller of a URL make the request, while the callers that arrive before
+it is done wait for it and get the same response. Only the raw response
+is shared: every caller decodes its own copy of the JSON, so no two
+requests end up mutating the same dict. A caller never joins a request
+started before a write of its process (see `SingleFlight.invalidate`).
+
+With `MAILMAN_SINGLEFLIGHT_LOCK_DIR` set, processes coalesce as well.
+The caller holding the `flock` of a URL makes the request and writes
+the response next to the lock. The callers that were waiting on the
+lock find that response once they get it, and skip the request.
+Responses and lock files older than `MAILMAN_SINGLEFLIGHT_MAX_AGE`
+seconds are removed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from httplib2 import Response
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def lock_dir():
+    return getattr(settings, 'MAILMAN_SINGLEFLIGHT_LOCK_DIR', None)
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs one function at a time per key, sharing its outcome with the
+    callers waiting for the same key.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = dict(calls=0, saved=0)
+        self._generation = 0
+        self.invalidated_at = 0
+
+    def do(self, key, fn):
+        """
+        Return what `fn` returns, unless a call for `key` is in flight,
+        in which case its outcome is returned (or raised) instead.
+        """
+        with self._lock:
+            self._stats['calls'] += 1
+            # Calls made before the last invalidation are not joined.
+            key = (self._generation, key)
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self._stats['saved'] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def invalidate(self):
+        """
+        Keep the calls made from now on from joining the calls in flight,
+        which may have been answered before a write.
+        """
+        with self._lock:
+            self._generation += 1
+            self.invalidated_at = time.time()
+
+    def stats(self):
+        """Calls asked for, and how many of them were saved."""
+        with self._lock:
+            return dict(self._stats)
+
+
+class FileSingleFlight(SingleFlight):
+    """
+    A `SingleFlight` that also coalesces with other processes, through
+    lock files in `directory`. Files older than `max_age` seconds are
+    removed, at most once every `max_age` seconds.
+    """
+
+    def __init__(self, directory, max_age=10):
+        super(FileSingleFlight, self).__init__()
+        self.directory = directory
+        self.max_age = max_age
+        self._swept = 0
+
+    def do(self, key, fn):
+        return super(FileSingleFlight, self).do(key, lambda: self._locked(key, fn))
+
+    def _path(self, key):
+        name = hashlib.sha1(json.dumps(key)).hexdigest()
+        return os.path.join(self.directory, 'flight-{0}'.format(name))
+
+    def _locked(self, key, fn):
+        path = self._path(key)
+        started = time.time()
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                shared = self._read(path, started)
+                if shared is not None:
+                    with self._lock:
+                        self._stats['saved'] += 1
+                    return shared
+                requested = time.time()
+                response, content = fn()
+                self._write(path, response, content, requested)
+                return response, content
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                self._sweep()
+
+    def _read(self, path, since):
+        """
+        The response another process wrote after `since`, if any, and
+        requested after the last invalidation of this one.
+        """
+        try:
+            if os.path.getmtime(path) < since:
+                return None
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if data.get('requested', 0) < self.invalidated_at:
+            return None
+        return Response(data['headers']), data['content'].encode('latin-1')
+
+    def _write(self, path, response, content, requested):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.flight-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(headers=dict(response), content=content.decode('latin-1'),
+                               requested=requested), f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not share a response in {0}: {1}".format(path, e))
+
+    def _sweep(self):
+        """
+        Remove the responses and the lock files older than `max_age`.
+        A response is only of use to the callers waiting while it is
+        made, and may hold anything the Core returns, password hashes
+        included. A lock file is only removed while nobody holds it; a
+        process that opened it just before makes its request on its own.
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._swept < self.max_age:
+                return
+            self._swept = now
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.startswith(('flight-', '.flight-')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) < self.max_age:
+                    continue
+                if name.endswith('.lock'):
+                    self._remove_lock(path)
+                else:
+                    os.unlink(path)
+            except (IOError, OSError):
+                pass
+
+    def _remove_lock(self, path):
+        with open(path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return
+            try:
+                os.unlink(path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def get_group(base_url):
+    """
+    Return the shared single-flight group of a Core base URL, or None
+    when disabled with `MAILMAN_SINGLEFLIGHT_ENABLED = False`.
+    """
+    if not getattr(settings, 'MAILMAN_SINGLEFLIGHT_ENABLED', True):
+        return None
+    directory = lock_dir() if fcntl is not None else None
+    key = (base_url, directory)
+    with _groups_lock:
+        group = _groups.get(key)
+        if group is None:
+            if directory:
+                group = FileSingleFlight(
+                    directory, max_age=getattr(settings, 'MAILMAN_SINGLEFLIGHT_MAX_AGE', 10))
+            else:
+                group = SingleFlight()
+            _groups[key] = group
+        return group
+
+
+def singleflight_stats():
+    """Statistics of every group, keyed by base URL."""
+    with _groups_lock:
+        groups = dict(_groups)
+    return dict((base_url, group.stats()) for (base_url, directory), group in groups.items())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Write-behind syncing of local objects to the Core.
+
+With `MAILMAN_SYNC_MODE = 'queue'`, `process_on_save_signal` no longer
+talks to the Core inside the request. It writes a `SyncRecord` to the
+outbox table instead, in the same transaction as the save itself. The
+`sync_worker` management command runs a `SyncWorker` that drains the
+outbox in batches, retrying failed pushes with an exponential backoff.
+Records for the same object are always pushed in order, which assumes
+a single worker drains the outbox at a time.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Min, Q
+from django.db.models.loading import get_model
+from django.utils import timezone
+
+from public_rest.api import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+IMMEDIATE = 'immediate'
+QUEUE = 'queue'
+
+_state = threading.local()
+
+
+def get_record_model():
+    return get_model('public_rest', 'SyncRecord')
+
+
+@contextmanager
+def inline():
+    """Push saves made in this block straight to the Core."""
+    _state.inline = getattr(_state, 'inline', 0) + 1
+    try:
+        yield
+    finally:
+        _state.inline -= 1
+
+
+def is_queued():
+    """Whether saves should go through the outbox right now."""
+    if getattr(_state, 'inline', 0):
+        return False
+    return getattr(settings, 'MAILMAN_SYNC_MODE', IMMEDIATE) == QUEUE
+
+
+def enqueue(instance, created=False, fields=None):
+    """
+    Record that `instance` has to be pushed to the Core. `fields` are
+    the remote fields that changed; None means all of them.
+    """
+    record = get_record_model().objects.create(
+        model_name=instance._meta.object_name.lower(),
+        object_type=getattr(instance, 'object_type', ''),
+        object_pk=instance.pk,
+        created=bool(created),
+        changed_fields=','.join(fields or []))
+    logger.debug("Queued sync of {0}({1})".format(record.model_name, record.object_pk))
+    return record
+
+
+def enqueue_many(instances, created=False):
+    """Record several objects to be pushed, with a single insert."""
+    model = get_record_model()
+    records = [model(model_name=instance._meta.object_name.lower(),
+                     object_type=getattr(instance, 'object_type', ''),
+                     object_pk=instance.pk,
+                     created=bool(created))
+               for instance in instances]
+    model.objects.bulk_create(records)
+    logger.debug("Queued sync of {0} objects".format(len(records)))
+    return len(records)
+
+
+class SyncWorker(object):
+    """
+    Drains the outbox.
+
+    :param batch_size: Number of due records looked at per batch.
+    :param max_attempts: Attempts after which a record is marked failed.
+    :param retry_delay: Base delay in seconds, doubled on every attempt.
+    :param max_retry_delay: Upper bound for the delay between attempts.
+    """
+
+    def __init__(self, batch_size=None, max_attempts=None,
+                 retry_delay=None, max_retry_delay=None):
+        self.batch_size = batch_size or getattr(settings, 'MAILMAN_SYNC_BATCH_SIZE', 100)
+        self.max_attempts = max_attempts or getattr(settings, 'MAILMAN_SYNC_MAX_ATTEMPTS', 10)
+        self.retry_delay = retry_delay or getattr(settings, 'MAILMAN_SYNC_RETRY_DELAY', 30)
+        self.max_retry_delay = max_retry_delay or getattr(settings, 'MAILMAN_SYNC_MAX_RETRY_DELAY', 3600)
+        self.model = get_record_model()
+
+    def backoff(self, attempts):
+        return min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+
+    def due_groups(self):
+        """
+        Up to `batch_size` objects with pending records that are due,
+        by their oldest record first.
+
+        An object is skipped entirely while one of its records is
+        waiting for a retry, or has failed until `retry_failed` puts it
+        back, so that newer changes never overtake it.
+        """
+        now = timezone.now()
+        records = self.model.objects
+        blocked = set(records.filter(Q(status=self.model.FAILED) |
+                                     Q(status=self.model.PENDING, next_attempt_at__gt=now))
+                             .values_list('model_name', 'object_pk').distinct())
+        # One row per object, so that the many records of an object
+        # don't take the batch of the others.
+        due = (records.filter(status=self.model.PENDING, next_attempt_at__lte=now)
+                      .values('model_name', 'object_pk')
+                      .annotate(first=Min('id'))
+                      .order_by('first'))
+        groups = []
+        for row in due[:self.batch_size + len(blocked)]:
+            key = (row['model_name'], row['object_pk'])
+            if key not in blocked:
+                groups.append(key)
+        return groups[:self.batch_size]
+
+    def claim(self, model_name, object_pk):
+        """Mark every pending record of an object as being synced."""
+        records = list(self.model.objects.filter(status=self.model.PENDING,
+                                                 model_name=model_name,
+                                                 object_pk=object_pk)
+                                         .order_by('id'))
+        self.model.objects.filter(pk__in=[record.pk for record in records]).update(
+            status=self.model.SYNCING, updated_at=timezone.now())
+        return records
+
+    def sync_group(self, model_name, object_pk):
+        """Push one object, coalescing all its pending records."""
+        records = self.claim(model_name, object_pk)
+        if not records:
+            return None
+        ids = [record.pk for record in records]
+        model = get_model('public_rest', model_name)
+        try:
+            instance = model._default_manager.get(pk=object_pk)
+        except model.DoesNotExist:
+            self.model.objects.filter(pk__in=ids).update(
+                status=self.model.DONE, last_error='Object no longer exists',
+                updated_at=timezone.now())
+            return True
+        created = any(record.created for record in records)
+        fields = set()
+        for record in records:
+            if not record.changed_fields:
+                fields = None
+                break
+            fields.update(record.changed_fields.split(','))
+        try:
+            with inline():
+                instance.sync_backup(created=created, fields=fields)
+        except CircuitOpenError as e:
+            # The Core was not even called: not an attempt. Try again
+            # once the circuit lets calls through.
+            logger.info("Not syncing {0}({1}): {2}".format(model_name, object_pk, e))
+            delay = 0
+            if e.retry_at is not None:
+                delay = max(e.retry_at - time.time(), 0)
+            next_attempt_at = timezone.now() + timedelta(seconds=delay)
+            self.model.objects.filter(pk__in=ids).update(
+                status=self.model.PENDING, last_error=unicode(e),
+                next_attempt_at=next_attempt_at, updated_at=timezone.now())
+            return False
+        except Exception as e:
+            attempts = max(record.attempts for record in records) + 1
+            logger.info("Could not sync {0}({1}): {2}".format(model_name, object_pk, e))
+            if attempts >= self.max_attempts:
+                status = self.model.FAILED
+            else:
+                status = self.model.PENDING
+            next_attempt_at = timezone.now() + timedelta(seconds=self.backoff(attempts))
+            self.model.objects.filter(pk__in=ids).update(
+                status=status, attempts=attempts, last_error=unicode(e),
+                next_attempt_at=next_attempt_at, updated_at=timezone.now())
+            return False
+        self.model.objects.filter(pk__in=ids).update(
+            status=self.model.DONE, last_error='', updated_at=timezone.now())
+        return True
+
+    def drain(self):
+        """
+        Sync one batch of due records.
+        Returns a dict with the number of objects synced and failed.
+        """
+        rv = dict(synced=0, failed=0)
+        for model_name, object_pk in self.due_groups():
+            result = self.sync_group(model_name, object_pk)
+            if result is True:
+                rv['synced'] += 1
+            elif result is False:
+                rv['failed'] += 1
+        return rv
+
+    def retry_failed(self, model_name=None, object_pk=None):
+        """
+        Put back the failed records, all of them or those of one model
+        or object, for a new round of attempts.
+        """
+        failed = self.model.objects.filter(status=self.model.FAILED)
+        if model_name is not None:
+            failed = failed.filter(model_name=model_name)
+        if object_pk is not None:
+            failed = failed.filter(object_pk=object_pk)
+        return failed.update(status=self.model.PENDING, attempts=0,
+                             next_attempt_at=timezone.now(), updated_at=timezone.now())
+
+    def requeue_stale(self, older_than=600):
+        """Put back records left `syncing` by a worker that died."""
+        cutoff = timezone.now() - timedelta(seconds=older_than)
+        return self.model.objects.filter(status=self.model.SYNCING,
+                                         updated_at__lt=cutoff).update(
+            status=self.model.PENDING)
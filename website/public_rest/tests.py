@@ -6,7 +6,7 @@ Run these tests with "manage.py test".
 
 from django.contrib.auth import get_user_model
 from django.test import TestCase, TransactionTestCase, LiveServerTestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from django.test.utils import override_settings
 from django.test.utils import setup_test_environment
 from rest_framework.test import APILiveServerTestCase, APIClient
@@ -14,12 +14,34 @@ from rest_framework.test import APILiveServerTestCase, APIClient
 from public_rest.models import *
 
 from django.conf import settings
-from public_rest.api import CoreInterface
-
-from urlparse import urlsplit
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.http import HttpResponse
+from django.db import connections, reset_queries, DEFAULT_DB_ALIAS
+from public_rest.api import CoreInterface, MailmanConnectionError
+from django.db.models.query import QuerySet
+from public_rest import bulk
+from public_rest.bulk import create_users
+from public_rest.cache import ResponseCache
+from public_rest.pagination import CursorPaginator, InvalidCursor
+from public_rest.reconcile import Reconciler
+from public_rest.pool import ConnectionPool, PoolTimeoutError
+from public_rest.sync import SyncWorker
+from public_rest import api as api_module, authz, bench, breaker, instrumentation, metrics
+from public_rest import fanout, singleflight
+from public_rest import interface as interface_module
+from public_rest.utils import core_path_template, core_resource_type, iterate_values
+
+from urllib2 import HTTPError
+from urlparse import urljoin, urlsplit
+import base64
+import httplib2
 import requests
 import json
 import os
+import shutil
+import tempfile
+import threading
 import time
 
 setup_test_environment()
@@ -312,7 +334,46 @@ class ModelTest(TestCase):
         self.assertEqual(mset.welcome_message_uri, 'mailman:///welcome.txt')
 
 
-class DRFTestCase(APILiveServerTestCase):
+# Queries allowed for one page of a collection, whatever its size.
+QUERIES_PER_PAGE = 12
+
+
+class MaxQueriesContext(object):
+    """Fails the test if the block runs more than `maximum` queries."""
+
+    def __init__(self, test_case, maximum, using=DEFAULT_DB_ALIAS):
+        self.test_case = test_case
+        self.maximum = maximum
+        self.connection = connections[using]
+
+    def __enter__(self):
+        self.old_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.start = len(self.connection.queries)
+        # Requests made by the test client would empty the query log.
+        request_started.disconnect(reset_queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.use_debug_cursor = self.old_debug_cursor
+        request_started.connect(reset_queries)
+        if exc_type is not None:
+            return
+        self.queries = self.connection.queries[self.start:]
+        self.test_case.assertTrue(
+            len(self.queries) <= self.maximum,
+            "{0} queries executed, at most {1} expected:\n{2}".format(
+                len(self.queries), self.maximum,
+                '\n'.join(query['sql'] for query in self.queries)))
+
+
+class QueryCountMixin(object):
+
+    def assertMaxQueries(self, maximum, using=DEFAULT_DB_ALIAS):
+        return MaxQueriesContext(self, maximum, using=using)
+
+
+class DRFTestCase(QueryCountMixin, APILiveServerTestCase):
 
     def setUp(self):
         u = get_user_model().objects.create_superuser(display_name='Test Admin',
@@ -469,10 +530,52 @@ class DRFTestCase(APILiveServerTestCase):
         res_json = json.loads(res.content)
         self.assertIsInstance(res_json, dict)
         self.assertTrue(res_json.has_key('count'))
-        self.assertTrue(res_json.has_key('prev'))
+        self.assertTrue(res_json.has_key('previous'))
         self.assertTrue(res_json.has_key('next'))
         self.assertTrue(res_json.has_key('results'))
 
+    def test_cursor_pagination(self):
+        for i in range(3):
+            res = self.client.post('/api/lists/1/members/',
+                                   data={'address': 'member{0}@foobar.com'.format(i)})
+            self.assertEqual(res.status_code, 201)
+
+        res = self.client.get('/api/lists/1/members/?page_size=2&count=exact')
+        res_json = json.loads(res.content)
+        self.assertEqual(res_json['count'], 3)
+        self.assertEqual(res_json['previous'], None)
+        self.assertEqual([m['address']['address'] for m in res_json['results']],
+                         ['member0@foobar.com', 'member1@foobar.com'])
+
+        res = self.client.get(res_json['next'])
+        res_json = json.loads(res.content)
+        self.assertEqual(res_json['next'], None)
+        self.assertEqual([m['address']['address'] for m in res_json['results']],
+                         ['member2@foobar.com'])
+
+        res = self.client.get(res_json['previous'])
+        res_json = json.loads(res.content)
+        self.assertEqual(len(res_json['results']), 2)
+
+        res = self.client.get('/api/lists/1/members/?cursor=garbage')
+        self.assertEqual(res.status_code, 400)
+
+    def test_roster_queries_do_not_grow_with_page_size(self):
+        for i in range(6):
+            res = self.client.post('/api/lists/1/members/',
+                                   data={'address': 'member{0}@foobar.com'.format(i)})
+            self.assertEqual(res.status_code, 201)
+        user_path = urlsplit(json.loads(self.client.get('/api/users/1/').content)['url']).path
+        for path in ('/api/lists/1/members/', '/api/lists/1/memberships/',
+                     '/api/emails/', '/api/users/', '{0}subscriptions/'.format(user_path)):
+            counts = []
+            for page_size in (1, 7):
+                with self.assertMaxQueries(QUERIES_PER_PAGE) as context:
+                    res = self.client.get('{0}?page_size={1}'.format(path, page_size))
+                self.assertEqual(res.status_code, 200)
+                counts.append(len(context.queries))
+            self.assertEqual(counts[0], counts[1], path)
+
 
     def test_make_list_subscription(self):
         """
@@ -706,10 +809,8 @@ class DRFTestCase(APILiveServerTestCase):
         self.assertEqual(res.status_code, 200)
         res_json = json.loads(res.content)
         #logger.error("\nUser Subscriptions:{0}".format(res_json))
-        #XXX: Ideally, this result should be paginated, but we're
-        # skipping that for the real testing now.
-        self.assertIsInstance(res_json, list)
-        sub1 = res_json[0]
+        self.assertIsInstance(res_json['results'], list)
+        sub1 = res_json['results'][0]
         self.assertEqual(sub1['address'], 'boss@asgard.com')
         self.assertEqual(sub1['role'], 'member')
         self.assertEqual(sub1['user'], 'Odin')
@@ -771,7 +872,7 @@ class DRFTestCase(APILiveServerTestCase):
 
         res = self.client.get('{0}subscriptions/'.format(user_path))
         self.assertEqual(res.status_code, 200)
-        res_json = json.loads(res.content)
+        res_json = json.loads(res.content)['results']
         self.assertEqual(len(res_json), 1)
         self.assertEqual(res_json[0]['address'], 'newuser@foo.com')
 
@@ -779,7 +880,7 @@ class DRFTestCase(APILiveServerTestCase):
         self.client.login(username='separate_user', password='password')
         res = self.client.get('{0}subscriptions/'.format(user_path))
         self.assertEqual(res.status_code, 200)
-        res_json = json.loads(res.content)
+        res_json = json.loads(res.content)['results']
         self.assertEqual(len(res_json), 0)
 
         # Regular members just get 403
@@ -931,6 +1032,1350 @@ class DRFTestCase(APILiveServerTestCase):
         pass
 
 
+class ConnectionPoolTest(TestCase):
+
+    def test_connections_are_reused(self):
+        pool = ConnectionPool(size=2)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+        stats = pool.stats()
+        self.assertEqual(stats['new_connections'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['in_use'], 1)
+
+    def test_pool_is_bounded(self):
+        pool = ConnectionPool(size=1, wait_timeout=0.01)
+        conn = pool.acquire()
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire()
+        self.assertEqual(pool.stats()['waits'], 1)
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+
+    def test_connections_are_retired(self):
+        pool = ConnectionPool(size=1, max_requests=1)
+        conn = pool.acquire()
+        conn.requests = 1
+        pool.release(conn)
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertIsNot(pool.acquire(), conn)
+
+    def test_broken_connections_are_discarded(self):
+        pool = ConnectionPool(size=1)
+        conn = pool.acquire()
+        pool.release(conn, discard=True)
+        self.assertEqual(pool.stats()['discarded'], 1)
+        self.assertIsNot(pool.acquire(), conn)
+
+
+class FakeConnection(object):
+    """
+    Stands in for `api.Connection`, answering calls from a dict
+    of canned responses keyed by path and recording every call.
+    """
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.calls = []
+
+    def call(self, path, data=None, method=None, use_cache=True, cache_post=False):
+        if method is None:
+            method = 'GET' if data is None else 'POST'
+        self.calls.append((method.upper(), path))
+        # Pages of a collection are answered from the whole of it.
+        content = self.responses.get(path, self.responses.get(path.split('?')[0]))
+        if callable(content):
+            content = content(path, data, method)
+        return {'status': '200'}, json.loads(json.dumps(content))
+
+
+class AdaptorHydrationTest(TestCase):
+
+    def setUp(self):
+        self.ci = CoreInterface('http://localhost:8001/3.0/')
+
+    def make_entries(self, count):
+        return [dict(self_link='http://localhost:8001/3.0/members/{0}'.format(i),
+                     address='user{0}@example.com'.format(i),
+                     list_id='test.example.com',
+                     role='member',
+                     user='http://localhost:8001/3.0/users/{0}'.format(i))
+                for i in range(count)]
+
+    def test_collection_seeds_adaptors(self):
+        users = [dict(self_link='http://localhost:8001/3.0/users/{0}'.format(i),
+                      user_id=i, display_name='User {0}'.format(i))
+                 for i in range(5)]
+        self.ci.connection = FakeConnection({'users': dict(entries=users)})
+        names = [user.display_name for user in self.ci.users]
+        self.assertEqual(len(names), 5)
+        self.assertEqual(len(self.ci.connection.calls), 1)
+
+    def test_roster_costs_one_request(self):
+        conn = FakeConnection({
+            'lists/test@example.com/roster/member': dict(entries=self.make_entries(50)),
+        })
+        mlist = ListAdaptor(conn, 'lists/test@example.com',
+                            data=dict(fqdn_listname='test@example.com'))
+        addresses = [member.address for member in mlist.members]
+        self.assertEqual(len(addresses), 50)
+        self.assertEqual(len(conn.calls), 1)
+
+    def test_unseeded_adaptor_fetches(self):
+        conn = FakeConnection({'domains/example.com': dict(mail_host='example.com')})
+        domain = DomainAdaptor(conn, 'domains/example.com')
+        self.assertEqual(domain.mail_host, 'example.com')
+        self.assertEqual(conn.calls, [('GET', 'domains/example.com')])
+
+
+class BulkImportTest(TestCase):
+
+    def setUp(self):
+        base = 'http://localhost:8001/3.0/'
+        self.user_url = base + 'users/1'
+        responses = {self.user_url: dict(self_link=self.user_url,
+                                         user_id=1, display_name='Anne')}
+        entries = []
+        for i in range(3):
+            link = base + 'members/{0}'.format(i)
+            entries.append(dict(self_link=link, role='member', user=self.user_url,
+                                address='anne{0}@example.com'.format(i),
+                                list_id='test.example.com'))
+        self.conn = FakeConnection(responses)
+        self.adaptors = [MembershipAdaptor(self.conn, entry['self_link'], data=entry)
+                         for entry in entries]
+
+    def test_import_records(self):
+        count = Membership.objects.get_query_set().import_records(self.adaptors)
+        self.assertEqual(count, 3)
+        memberships = Membership.objects.filter(user__display_name='Anne')
+        self.assertEqual(memberships.count(), 3)
+        for membership in memberships:
+            self.assertIsNotNone(membership.preferences)
+        # The preferences are bulk inserted too, each with its own row.
+        self.assertEqual(len(set(m.preferences_id for m in memberships)), 3)
+        self.assertFalse(QuerySet(model=MembershipPrefs).filter(partial_URL__startswith='bulk:').exists())
+        # The shared user is resolved once, and nothing else is fetched.
+        self.assertEqual(User.objects.filter(display_name='Anne').count(), 1)
+        self.assertEqual(self.conn.calls, [('GET', self.user_url)])
+
+    def test_import_skips_mirrored_records(self):
+        Membership.objects.get_query_set().import_records(self.adaptors)
+        count = Membership.objects.get_query_set().import_records(self.adaptors)
+        self.assertEqual(count, 0)
+        self.assertEqual(Membership.objects.filter(user__display_name='Anne').count(), 3)
+
+    def test_import_users(self):
+        user = UserAdaptor(self.conn, self.user_url,
+                           data=dict(self_link=self.user_url, user_id=1, display_name='Anne'))
+        count = RemoteObjectQuerySet(model=User).import_records([user])
+        self.assertEqual(count, 1)
+        anne = User.objects.get(display_name='Anne')
+        self.assertEqual(anne.partial_URL, '/3.0/users/1')
+        # save() ran, and created the preferences.
+        self.assertIsNotNone(anne.preferences)
+
+    def test_import_lists(self):
+        with suppress_sync():
+            domain = Domain.objects.create(mail_host='example.com',
+                                           partial_URL='/3.0/domains/example.com')
+        domain_url = 'http://localhost:8001/3.0/domains/example.com'
+        self.conn.responses['domains/example.com'] = dict(
+            self_link=domain_url, mail_host='example.com', base_url='http://example.com',
+            description='', contact_address='postmaster@example.com')
+        list_url = 'http://localhost:8001/3.0/lists/test.example.com'
+        mlist = ListAdaptor(self.conn, list_url, data=dict(
+            self_link=list_url, list_name='test', mail_host='example.com',
+            fqdn_listname='test@example.com', list_id='test.example.com',
+            display_name='Test'))
+        count = RemoteObjectQuerySet(model=MailingList).import_records([mlist])
+        self.assertEqual(count, 1)
+        mlist = MailingList.objects.get(fqdn_listname='test@example.com')
+        self.assertEqual(mlist.domain, domain)
+        self.assertEqual(mlist.settings.join_address, 'test-join@example.com')
+
+    def test_suppress_sync(self):
+        self.assertFalse(is_sync_suppressed())
+        with suppress_sync():
+            self.assertTrue(is_sync_suppressed())
+        self.assertFalse(is_sync_suppressed())
+
+
+class FakePool(object):
+    """Stands in for a `ConnectionPool`, replaying canned responses."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, url, method, data, headers):
+        self.requests.append((method, url, dict(headers)))
+        status, body, extra = self.responses.pop(0)
+        headers = {'status': str(status)}
+        headers.update(extra)
+        return httplib2.Response(headers), body
+
+
+class ResponseCacheTest(TestCase):
+
+    def setUp(self):
+        self.conn = Connection('http://localhost:8001/3.0/')
+        self.conn.cache = ResponseCache()
+        self.config = json.dumps(dict(fqdn_listname='test@example.com',
+                                      http_etag='"abc"'))
+
+    def test_path_template(self):
+        url = 'http://localhost:8001/3.0/lists/test.example.com/config'
+        self.assertEqual(core_path_template(url), 'lists/{id}/config')
+        self.assertEqual(core_resource_type(url), 'config')
+        self.assertEqual(core_resource_type('lists/test.example.com/roster/owner'), 'roster')
+
+    def test_reads_are_cached(self):
+        self.conn.pool = FakePool((200, self.config, {}))
+        for i in range(3):
+            response, content = self.conn.call('lists/test@example.com/config')
+            self.assertEqual(content['fqdn_listname'], 'test@example.com')
+        self.assertEqual(len(self.conn.pool.requests), 1)
+        self.assertEqual(self.conn.cache.stats()['hits'], 2)
+
+    def test_stale_entries_are_revalidated(self):
+        self.conn.pool = FakePool((200, self.config, {}), (304, '', {}))
+        self.conn.call('lists/test@example.com/config')
+        self.conn.cache.get(urljoin(self.conn.base_url, 'lists/test@example.com/config')).expires = 0
+        response, content = self.conn.call('lists/test@example.com/config')
+        self.assertEqual(content['fqdn_listname'], 'test@example.com')
+        method, url, headers = self.conn.pool.requests[1]
+        self.assertEqual(headers['If-None-Match'], '"abc"')
+        self.assertEqual(self.conn.cache.stats()['revalidated'], 1)
+
+    def test_writes_invalidate(self):
+        self.conn.pool = FakePool((200, self.config, {}), (204, '', {}),
+                                  (200, self.config, {}))
+        self.conn.call('lists/test@example.com/config')
+        self.conn.call('lists/test@example.com/config', data={'description': 'x'},
+                       method='PATCH')
+        self.conn.call('lists/test@example.com/config')
+        self.assertEqual(len(self.conn.pool.requests), 3)
+
+    def test_find_does_not_invalidate(self):
+        self.conn.pool = FakePool((200, '{}', {}), (200, '{}', {}))
+        self.conn.call('members/1')
+        self.conn.call('members/find', data={'subscriber': 'a@example.com'})
+        self.conn.call('members/1')
+        self.assertEqual(len(self.conn.pool.requests), 2)
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(max_entries=2)
+        for name in ('a', 'b', 'c'):
+            cache.set('domains/{0}'.format(name), httplib2.Response({}), '{}')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('domains/a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+@override_settings(MAILMAN_SYNC_MODE='queue')
+class SyncQueueTest(TestCase):
+
+    def setUp(self):
+        self.domain = Domain.objects.create(mail_host='mail.queue.com')
+        self.record = SyncRecord.objects.get(model_name='domain',
+                                             object_pk=self.domain.pk)
+
+    def fake_core(self):
+        connection = interface_module.ci.connection
+        self.addCleanup(setattr, interface_module.ci, 'connection', connection)
+        interface_module.ci.connection = FakeConnection({
+            'domains/mail.queue.com': dict(mail_host='mail.queue.com',
+                self_link='http://localhost:8001/3.0/domains/mail.queue.com'),
+        })
+
+    def test_saves_are_queued(self):
+        self.assertEqual(self.record.status, SyncRecord.PENDING)
+        self.assertTrue(self.record.created)
+        self.assertIsNone(self.domain.partial_URL)
+
+    def test_worker_syncs_queued_objects(self):
+        self.fake_core()
+        self.domain.description = 'Changed'
+        self.domain.save()
+        result = SyncWorker().drain()
+        self.assertEqual(result, dict(synced=1, failed=0))
+        self.assertEqual(SyncRecord.objects.filter(status=SyncRecord.DONE).count(), 2)
+        domain = Domain.objects.get(pk=self.domain.pk)
+        self.assertEqual(domain.partial_URL, '/3.0/domains/mail.queue.com')
+
+    def test_failures_back_off(self):
+        # The Core is not running: the push fails and is retried later.
+        # (With the circuit closed: a call refused by it is no attempt.)
+        breaker.reset_breakers()
+        result = SyncWorker(retry_delay=60).drain()
+        self.assertEqual(result, dict(synced=0, failed=1))
+        record = SyncRecord.objects.get(pk=self.record.pk)
+        self.assertEqual(record.status, SyncRecord.PENDING)
+        self.assertEqual(record.attempts, 1)
+        self.assertTrue(record.next_attempt_at > timezone.now())
+        # Newer changes of the same object wait for the older ones.
+        self.domain.description = 'Changed'
+        self.domain.save()
+        self.assertEqual(SyncWorker().due_groups(), [])
+
+    def test_failed_records_block_newer_ones(self):
+        self.record.status = SyncRecord.FAILED
+        self.record.save()
+        self.domain.description = 'Changed'
+        self.domain.save()
+        worker = SyncWorker()
+        self.assertEqual(worker.due_groups(), [])
+        self.assertEqual(worker.retry_failed(), 1)
+        self.assertEqual(worker.due_groups(), [('domain', self.domain.pk)])
+        self.assertEqual(SyncRecord.objects.get(pk=self.record.pk).attempts, 0)
+
+    def test_batches_are_per_object(self):
+        for n in range(5):
+            self.domain.description = 'Change {0}'.format(n)
+            self.domain.save()
+        other = Domain.objects.create(mail_host='mail.other.com')
+        self.assertEqual(SyncWorker(batch_size=2).due_groups(),
+                         [('domain', self.domain.pk), ('domain', other.pk)])
+
+    def test_open_circuit_is_not_an_attempt(self):
+        def refuse(instance, created=False, fields=None):
+            raise api_module.CircuitOpenError('open', retry_at=time.time() + 120)
+        self.addCleanup(setattr, Domain, 'sync_backup', Domain.sync_backup)
+        Domain.sync_backup = refuse
+        result = SyncWorker(max_attempts=1, retry_delay=1).drain()
+        self.assertEqual(result, dict(synced=0, failed=1))
+        record = SyncRecord.objects.get(pk=self.record.pk)
+        self.assertEqual((record.status, record.attempts), (SyncRecord.PENDING, 0))
+        # Retried once the circuit lets calls through, not after the backoff.
+        wait = (record.next_attempt_at - timezone.now()).total_seconds()
+        self.assertTrue(110 < wait <= 120, wait)
+
+
+class DirtyFieldTest(TestCase):
+
+    def setUp(self):
+        domain = Domain.objects.create(mail_host='mail.dirty.com')
+        mlist = domain.create_list('test')
+        self.settings = ListSettings.objects.get(pk=mlist.settings.pk)
+        self.synced = []
+        self.settings.sync_backup = lambda **kwargs: self.synced.append(kwargs)
+
+    def test_loaded_object_is_clean(self):
+        self.assertEqual(self.settings.get_dirty_fields(), set())
+        self.assertEqual(self.settings.get_dirty_backing_fields(), [])
+
+    def test_only_changed_fields_are_sent(self):
+        self.settings.advertised = False
+        self.assertEqual(self.settings.get_dirty_backing_fields(), ['advertised'])
+        self.assertEqual(self.settings.prepare_backing_data(only=['advertised']),
+                         {'advertised': False})
+        self.settings.save()
+        self.assertEqual(self.synced, [dict(created=False, fields=['advertised'])])
+        self.assertEqual(self.settings.get_dirty_fields(), set())
+
+    def test_unchanged_save_skips_core(self):
+        self.settings.save()
+        self.assertEqual(self.synced, [])
+
+    def test_update(self):
+        self.settings.update(advertised=False, description='Batched')
+        self.assertEqual(len(self.synced), 1)
+        self.assertEqual(sorted(self.synced[0]['fields']), ['advertised', 'description'])
+        settings = ListSettings.objects.get(pk=self.settings.pk)
+        self.assertEqual(settings.description, 'Batched')
+
+
+class CursorPaginatorTest(TestCase):
+
+    def setUp(self):
+        for i in range(7):
+            SyncRecord.objects.create(model_name='user', object_pk=i)
+        self.queryset = SyncRecord.objects.all()
+
+    def walk(self, paginator):
+        pages = [paginator.page()]
+        while pages[-1].next_cursor:
+            pages.append(paginator.page(pages[-1].next_cursor))
+        return pages
+
+    def test_forward_and_back(self):
+        paginator = CursorPaginator(self.queryset, 3)
+        pages = self.walk(paginator)
+        self.assertEqual([[r.object_pk for r in page] for page in pages],
+                         [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(pages[0].previous_cursor, None)
+        back = paginator.page(pages[2].previous_cursor)
+        self.assertEqual([r.object_pk for r in back], [3, 4, 5])
+        back = paginator.page(back.previous_cursor)
+        self.assertEqual([r.object_pk for r in back], [0, 1, 2])
+        self.assertEqual(back.previous_cursor, None)
+
+    def test_descending(self):
+        pages = self.walk(CursorPaginator(self.queryset, 4, ordering='-id'))
+        self.assertEqual([[r.object_pk for r in page] for page in pages],
+                         [[6, 5, 4, 3], [2, 1, 0]])
+
+    def test_pages_are_stable_under_inserts(self):
+        paginator = CursorPaginator(self.queryset, 3)
+        first = paginator.page()
+        SyncRecord.objects.filter(object_pk=0).delete()
+        SyncRecord.objects.create(model_name='user', object_pk=7)
+        second = paginator.page(first.next_cursor)
+        self.assertEqual([r.object_pk for r in second], [3, 4, 5])
+
+    def test_invalid_cursor(self):
+        self.assertRaises(InvalidCursor, CursorPaginator(self.queryset, 3).page, 'garbage')
+        # Well formed, but not a position of the ordering field.
+        for position in ('abc', None, [1], {'id': 1}):
+            cursor = base64.urlsafe_b64encode(json.dumps({'p': position, 'r': 0}))
+            self.assertRaises(InvalidCursor, CursorPaginator(self.queryset, 3).page, cursor)
+        # Positions are converted to the type of the field.
+        last = list(self.queryset.order_by('pk'))[2].pk
+        cursor = base64.urlsafe_b64encode(json.dumps({'p': str(last), 'r': 0}))
+        self.assertEqual([r.object_pk for r in CursorPaginator(self.queryset, 3).page(cursor)],
+                         [3, 4, 5])
+
+
+class AuthorizationContextTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(display_name='Staff', email='staff@authz.com',
+                                        password='password')
+        domain = Domain.objects.create(mail_host='mail.authz.com')
+        self.mlist = domain.create_list('test')
+        self.other = domain.create_list('other')
+        self.mlist.add_owner('staff@authz.com')
+        self.other.add_member('staff@authz.com')
+
+    def make_request(self):
+        request = RequestFactory().get('/api/')
+        request.user = self.user
+        return request
+
+    def test_roles(self):
+        context = authz.AuthorizationContext(self.user)
+        self.assertTrue(context.is_list_staff(self.mlist))
+        self.assertFalse(context.is_list_staff(self.other))
+        self.assertTrue(context.has_role('member'))
+        self.assertFalse(context.has_role('moderator'))
+        self.assertEqual(context.staff_list_ids(), set([self.mlist.pk]))
+
+    def test_roles_are_those_of_the_user(self):
+        # A membership of the user with an address of somebody else
+        # grants nothing to the owner of the address.
+        other = User.objects.create(display_name='Other', email='other@authz.com',
+                                    password='password')
+        with interface_module.suppress_sync():
+            Membership.objects.create(mlist=self.other, role='owner', user=self.user,
+                                      address=other.preferred_email)
+        self.assertFalse(authz.AuthorizationContext(other).has_role('owner', self.other))
+        self.assertTrue(authz.AuthorizationContext(self.user).has_role('owner', self.other))
+
+    def test_memoized_per_request(self):
+        request = self.make_request()
+        with self.assertNumQueries(1):
+            context = authz.get_context(request)
+            self.assertTrue(authz.get_context(request).has_role('owner'))
+            self.assertTrue(authz.get_context(request, self.user) is context)
+
+    @override_settings(MAILMAN_AUTHZ_CACHE_TIMEOUT=60)
+    def test_cached_across_requests(self):
+        cache.clear()
+        authz.get_context(self.make_request())
+        with self.assertNumQueries(0):
+            authz.get_context(self.make_request())
+        self.other.add_moderator('staff@authz.com')
+        context = authz.get_context(self.make_request())
+        self.assertTrue(context.is_list_staff(self.other))
+
+
+class BulkMembershipTest(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(display_name='Bulk Admin',
+                                                   email='admin@bulk.com',
+                                                   password='password')
+        User.objects.create(display_name='Joe', email='joe@bulk.com', password='password')
+        domain = Domain.objects.create(mail_host='mail.bulk.com')
+        self.mlist = domain.create_list('test')
+        self.url = '/api/lists/{0}/members/bulk/'.format(self.mlist.pk)
+        self.client = APIClient()
+        self.client.login(username='Bulk Admin', password='password')
+
+    def statuses(self, res):
+        self.assertEqual(res.status_code, 200)
+        return dict((r['address'], r['status']) for r in json.loads(res.content)['results'])
+
+    def test_subscribe_json(self):
+        addresses = ['joe@bulk.com', 'new1@bulk.com', 'new2@bulk.com',
+                     'not-an-address', 'new1@bulk.com']
+        res = self.client.post(self.url, data=json.dumps(addresses),
+                               content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+        results = json.loads(res.content)
+        self.assertEqual(sorted((r['address'], r['status']) for r in results['results']),
+                         [('joe@bulk.com', 'subscribed'),
+                          ('new1@bulk.com', 'duplicate'),
+                          ('new1@bulk.com', 'subscribed'),
+                          ('new2@bulk.com', 'subscribed'),
+                          ('not-an-address', 'invalid')])
+        self.assertEqual(results['counts'], {'subscribed': 3, 'duplicate': 1, 'invalid': 1})
+        self.assertEqual(self.mlist.members.count(), 3)
+        new = User.objects.get(display_name='new2@bulk.com')
+        self.assertFalse(new.has_usable_password())
+        self.assertEqual(new.preferred_email.address, 'new2@bulk.com')
+        self.assertEqual(Email.objects.get(address='new2@bulk.com').user, new)
+        membership = Membership.objects.get(address__address='new2@bulk.com')
+        self.assertEqual(membership.user, new)
+        self.assertNotEqual(membership.preferences, None)
+
+        res = self.client.post(self.url, data=json.dumps(['new2@bulk.com']),
+                               content_type='application/json')
+        self.assertEqual(self.statuses(res), {'new2@bulk.com': 'exists'})
+
+    def test_subscribe_csv(self):
+        body = 'address,display_name\ncsv1@bulk.com,CSV One\ncsv2@bulk.com\n'
+        res = self.client.post(self.url, data=body, content_type='text/csv')
+        self.assertEqual(self.statuses(res), {'csv1@bulk.com': 'subscribed',
+                                              'csv2@bulk.com': 'subscribed'})
+        self.assertEqual(Email.objects.get(address='csv1@bulk.com').user.display_name,
+                         'CSV One')
+
+    def test_display_name_conflict(self):
+        res = self.client.post(self.url, content_type='application/json',
+                               data=json.dumps([{'address': 'other@bulk.com',
+                                                 'display_name': 'Joe'}]))
+        self.assertEqual(self.statuses(res), {'other@bulk.com': 'conflict'})
+
+    def test_unsubscribe(self):
+        self.client.post(self.url, data=json.dumps(['a@bulk.com', 'b@bulk.com']),
+                         content_type='application/json')
+        res = self.client.delete(self.url, data=json.dumps(['a@bulk.com', 'c@bulk.com']),
+                                 content_type='application/json')
+        self.assertEqual(self.statuses(res), {'a@bulk.com': 'unsubscribed',
+                                              'c@bulk.com': 'not_found'})
+        self.assertEqual(list(self.mlist.members.values_list('address__address', flat=True)),
+                         ['b@bulk.com'])
+
+    @override_settings(MAILMAN_SYNC_MODE='queue')
+    def test_pushes_are_queued(self):
+        # Saves made by setUp may have been queued while the Core was out.
+        SyncRecord.objects.all().delete()
+        self.client.post(self.url, data=json.dumps(['q1@bulk.com', 'q2@bulk.com']),
+                         content_type='application/json')
+        records = SyncRecord.objects.filter(created=True)
+        self.assertEqual(sorted(records.values_list('model_name', flat=True)),
+                         ['membership', 'membership', 'user', 'user'])
+
+    @override_settings(MAILMAN_SYNC_MODE='queue')
+    def test_full_chunk(self):
+        # More rows than SQLite takes parameters for in one UPDATE, and
+        # a constant number of statements for them.
+        addresses = ['chunk{0}@bulk.com'.format(n) for n in range(400)]
+        subscriber = bulk.BulkSubscriber(self.mlist, 'member')
+        # (SQLite splits the bulk inserts in batches of 999 parameters.)
+        with self.assertNumQueries(46):
+            summary = subscriber.subscribe([(address, None) for address in addresses])
+        self.assertEqual(summary['counts'], {'subscribed': 400})
+        self.assertEqual(QuerySet(model=Email).filter(address__in=addresses,
+                                                      user__isnull=True).count(), 0)
+        self.assertEqual(len(set(QuerySet(model=User).filter(
+            display_name__in=addresses).values_list('preferences', flat=True))), 400)
+
+    def test_requires_list_staff(self):
+        self.client.logout()
+        self.client.login(username='Joe', password='password')
+        res = self.client.post(self.url, data=json.dumps(['x@bulk.com']),
+                               content_type='application/json')
+        self.assertEqual(res.status_code, 403)
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser(display_name='Export Admin', email='admin@export.com',
+                                      password='password')
+        domain = Domain.objects.create(mail_host='mail.export.com')
+        self.mlist = domain.create_list('test')
+        for i in range(5):
+            self.mlist.add_member('member{0}@export.com'.format(i))
+        self.mlist.add_owner('admin@export.com')
+        self.client = APIClient()
+        self.client.login(username='Export Admin', password='password')
+
+    def test_iterate_values_in_chunks(self):
+        queryset = Membership.objects.all()
+        with self.assertNumQueries(4):
+            rows = list(iterate_values(queryset, ['role'], chunk_size=2))
+        self.assertEqual(len(rows), 6)
+
+    def test_roster_csv(self):
+        res = self.client.get('/api/lists/{0}/export/?role=member'.format(self.mlist.pk))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.streaming)
+        lines = ''.join(res.streaming_content).splitlines()
+        self.assertEqual(lines[0], 'address,display_name,role,list')
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[1], 'member0@export.com,member0@export.com,member,test@mail.export.com')
+
+    def test_users_ndjson(self):
+        res = self.client.get('/api/users/export/?output=ndjson')
+        self.assertEqual(res.status_code, 200)
+        users = [json.loads(line) for line in ''.join(res.streaming_content).splitlines()]
+        self.assertEqual(len(users), 6)
+        self.assertEqual(users[0]['display_name'], 'Export Admin')
+        self.assertEqual(users[0]['email'], 'admin@export.com')
+
+    def test_unknown_output(self):
+        res = self.client.get('/api/users/export/?output=xml')
+        self.assertEqual(res.status_code, 400)
+
+    def test_users_export_is_for_admins(self):
+        self.client.logout()
+        self.client.login(username='member0@export.com', password='password')
+        res = self.client.get('/api/users/export/')
+        self.assertEqual(res.status_code, 403)
+
+
+class ReconcileTest(TestCase):
+
+    def setUp(self):
+        with interface_module.suppress_sync():
+            Domain.objects.create(mail_host='example.com', description='Old',
+                                  base_url='http://example.com',
+                                  contact_address='postmaster@example.com',
+                                  partial_URL='/3.0/domains/example.com')
+            Domain.objects.create(mail_host='gone.com',
+                                  partial_URL='/3.0/domains/gone.com')
+
+        def not_found(path, data, method):
+            raise HTTPError(path, 404, 'Not Found', {}, None)
+
+        self.core = FakeConnection({
+            'domains?count=2&page=1': {'entries': [
+                {'self_link': 'http://localhost:8001/3.0/domains/example.com',
+                 'mail_host': 'example.com', 'base_url': 'http://example.com',
+                 'description': 'New', 'contact_address': 'postmaster@example.com'},
+                {'self_link': 'http://localhost:8001/3.0/domains/new.org',
+                 'mail_host': 'new.org', 'base_url': 'http://new.org',
+                 'description': '', 'contact_address': 'postmaster@new.org'}]},
+            '/3.0/domains/gone.com': not_found,
+            'lists?count=2&page=1': {'entries': [
+                {'self_link': 'http://localhost:8001/3.0/lists/test.example.com',
+                 'fqdn_listname': 'test@example.com', 'list_name': 'test',
+                 'mail_host': 'example.com', 'display_name': 'Test',
+                 'list_id': 'test.example.com'}]},
+            'users?count=2&page=1': {'entries': [
+                {'self_link': 'http://localhost:8001/3.0/users/1',
+                 'display_name': 'Anne', 'user_id': 1}]},
+            'addresses?count=2&page=1': {'entries': [
+                {'self_link': 'http://localhost:8001/3.0/addresses/anne@example.com',
+                 'email': 'anne@example.com', 'verified_on': '2014-01-01T00:00:00',
+                 'user': 'http://localhost:8001/3.0/users/1'}]},
+            'members?count=2&page=1': {'entries': [
+                {'self_link': 'http://localhost:8001/3.0/members/1',
+                 'address': 'anne@example.com', 'list_id': 'test.example.com',
+                 'role': 'member', 'user': 'http://localhost:8001/3.0/users/1'}]},
+        })
+        self.fake_core()
+
+    def fake_core(self):
+        old = interface_module.ci.connection
+        interface_module.ci.connection = self.core
+        self.addCleanup(setattr, interface_module.ci, 'connection', old)
+
+    def test_reconcile(self):
+        stats = Reconciler(page_size=2).reconcile()
+        self.assertEqual(stats['domains'], {'update': 1, 'insert': 1, 'tombstone': 1})
+        self.assertEqual(Domain.objects.get(mail_host='example.com').description, 'New')
+        self.assertFalse(QuerySet(model=Domain).filter(mail_host='gone.com').exists())
+        mlist = MailingList.objects.get(fqdn_listname='test@example.com')
+        self.assertEqual(mlist.domain.mail_host, 'example.com')
+        anne = User.objects.get(partial_URL='/3.0/users/1')
+        email = Email.objects.get(address='anne@example.com')
+        self.assertEqual(email.user, anne)
+        self.assertTrue(email.verified)
+        membership = Membership.objects.get(partial_URL='/3.0/members/1')
+        self.assertEqual((membership.mlist, membership.user, membership.address),
+                         (mlist, anne, email))
+        self.assertEqual(ReconcileRun.objects.get().status, ReconcileRun.DONE)
+        self.assertFalse(ReconcileSeen.objects.exists())
+        # Nothing is pushed back to the Core.
+        self.assertEqual([call for call in self.core.calls if call[0] != 'GET'], [])
+
+        stats = Reconciler(page_size=2).reconcile()
+        self.assertEqual(stats['domains'], {'unchanged': 2})
+        self.assertEqual(stats['members'], {'unchanged': 1})
+
+    def test_dry_run(self):
+        changes = []
+        Reconciler(dry_run=True, page_size=2,
+                   report=lambda *args: changes.append(args)).reconcile()
+        self.assertIn(('update', 'domains', '/3.0/domains/example.com', ['description']),
+                      changes)
+        self.assertIn(('tombstone', 'domains', '/3.0/domains/gone.com', None), changes)
+        self.assertEqual(Domain.objects.get(mail_host='example.com').description, 'Old')
+        self.assertTrue(QuerySet(model=Domain).filter(mail_host='gone.com').exists())
+        self.assertFalse(QuerySet(model=Domain).filter(mail_host='new.org').exists())
+
+    def test_resume(self):
+        def down(path, data, method):
+            raise MailmanConnectionError('Could not connect to Mailman API')
+        lists = self.core.responses['lists?count=2&page=1']
+        self.core.responses['lists?count=2&page=1'] = down
+        self.assertRaises(MailmanConnectionError, Reconciler(page_size=2).reconcile)
+        run = ReconcileRun.objects.get()
+        self.assertEqual((run.status, run.collection, run.page), ('running', 'domains', 3))
+
+        self.core.responses['lists?count=2&page=1'] = lists
+        self.core.calls = []
+        Reconciler(page_size=2).reconcile()
+        self.assertFalse(('GET', 'domains?count=2&page=1') in self.core.calls)
+        self.assertTrue(MailingList.objects.filter(fqdn_listname='test@example.com').exists())
+
+
+class BenchTest(TestCase):
+
+    def test_fake_core(self):
+        core = bench.FakeCore()
+        core.populate(lists=2, members=3)
+        status, body = core.dispatch('GET', ['lists', 'list0.bench.example.com', 'roster', 'member'],
+                                     {'count': ['2'], 'page': ['2']}, {})
+        self.assertEqual((status, body['total_size'], len(body['entries'])), (200, 3, 1))
+        status, body = core.dispatch('POST', ['members', 'find'], {},
+                                     {'subscriber': 'subscriber0@example.org'})
+        self.assertEqual(body['total_size'], 2)
+        self.assertRaises(bench.CoreError, core.dispatch, 'GET', ['users', 'nobody@example.org'], {}, {})
+
+    def test_run_benchmarks(self):
+        results = bench.run_benchmarks(lists=2, members=5, iterations=2, warmup=1,
+                                       bulk_size=3, page_size=5)
+        self.assertEqual(results['meta']['dataset'],
+                         {'lists': 2, 'users': 5, 'memberships': 10})
+        self.assertEqual(list(results['scenarios']), list(bench.SCENARIOS))
+        for name, result in results['scenarios'].items():
+            self.assertEqual((name, result['requests'], result['errors']), (name, 2, 0))
+            self.assertTrue(result['latency_ms']['p99'] >= result['latency_ms']['p50'])
+        self.assertEqual(results['scenarios']['roster']['core_calls_per_request'], 0)
+        self.assertTrue(results['scenarios']['create_list']['core_calls_per_request'] > 0)
+        self.assertTrue(results['scenarios']['user_detail']['queries_per_request'] > 0)
+        self.assertEqual(interface_module.ci.connection.base_url, CoreInterface().connection.base_url)
+
+
+class InstrumentationTest(TestCase):
+
+    def profile_request(self, work):
+        middleware = instrumentation.InstrumentationMiddleware()
+        request = RequestFactory().get('/api/lists/')
+        middleware.process_request(request)
+        work()
+        return middleware.process_response(request, HttpResponse())
+
+    def test_server_timing(self):
+        config = 'http://localhost:8001/3.0/lists/a.example.com/config'
+
+        def work():
+            SyncRecord.objects.count()
+            instrumentation.record_core_call('GET', config, 0.002)
+            instrumentation.record_core_call('GET', config, 0.0, cached=True)
+            instrumentation.record_core_call('PATCH', config, 0.003)
+            with instrumentation.timed('serialize'):
+                with instrumentation.timed('serialize'):
+                    time.sleep(0.001)
+            profile = instrumentation.get_profile()
+            self.assertEqual(profile.duplicates(), {config: 2})
+            self.assertEqual(dict(profile.templates)['GET lists/{id}/config'][0], 2)
+
+        with self.settings(MAILMAN_INSTRUMENTATION_SAMPLE_RATE=1.0):
+            response = self.profile_request(work)
+        timing = response['Server-Timing']
+        self.assertIn('core;dur=5.0;desc="3 calls, 1 cached, 1 duplicate"', timing)
+        self.assertIn('desc="GET lists/{id}/config x2"', timing)
+        self.assertRegexpMatches(timing, r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+        self.assertIsNone(instrumentation.get_profile())
+
+        with self.settings(MAILMAN_INSTRUMENTATION_SAMPLE_RATE=0):
+            response = self.profile_request(lambda: None)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_core_calls_and_lazy_loads(self):
+        core = bench.FakeCore()
+        core.populate(lists=1, members=1)
+        server = bench.FakeCoreServer(core).start()
+        self.addCleanup(server.stop)
+        connection = CoreInterface(base_url=server.url + '/3.0/').connection
+        profile = instrumentation.RequestProfile()
+        instrumentation.activate(profile)
+        self.addCleanup(instrumentation.activate, None)
+        mlist = ListAdaptor(connection, 'lists/list0.bench.example.com')
+        self.assertEqual(mlist.fqdn_listname, 'list0@bench.example.com')
+        self.assertEqual(len(mlist.members), 1)
+        self.assertEqual(profile.core_calls, 2)
+        self.assertEqual(sorted(profile.templates),
+                         ['GET lists/{id}', 'GET lists/{id}/roster/member'])
+        self.assertEqual(dict(profile.lazy_loads), {'ListAdaptor': 1})
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.calls = self.registry.counter('calls_total', 'Calls.', ('endpoint',))
+        self.latency = self.registry.histogram('latency_seconds', 'Latency.', ('endpoint',),
+                                               buckets=(0.1, 1))
+
+    def test_thread_shards(self):
+        def work():
+            for n in range(100):
+                self.calls.inc(endpoint='lists')
+        threads = [threading.Thread(target=work) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.calls.inc(2, endpoint='users')
+        for value in (0.05, 0.1, 0.5, 3):
+            self.latency.observe(value, endpoint='lists')
+        self.assertEqual(len(self.registry._shards), 5)
+        text = self.registry.expose()
+        self.assertIn('# TYPE calls_total counter\n', text)
+        self.assertIn('calls_total{endpoint="lists"} 400\n', text)
+        self.assertIn('calls_total{endpoint="users"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{endpoint="lists",le="0.1"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{endpoint="lists",le="1"} 3\n', text)
+        self.assertIn('latency_seconds_bucket{endpoint="lists",le="+Inf"} 4\n', text)
+        self.assertIn('latency_seconds_sum{endpoint="lists"} 3.65\n', text)
+        self.assertIn('latency_seconds_count{endpoint="lists"} 4\n', text)
+
+    def test_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'metrics-1.json'), 'w') as f:
+            json.dump([['calls_total', ['lists'], 3],
+                       ['latency_seconds', ['lists'], [1, 0, 0, 0.05, 1]]], f)
+        with self.settings(MAILMAN_METRICS_DIR=directory):
+            self.calls.inc(endpoint='lists')
+            self.latency.observe(2, endpoint='lists')
+            text = self.registry.expose()
+            self.assertTrue(os.path.exists(self.registry.path()))
+        self.assertIn('calls_total{endpoint="lists"} 4\n', text)
+        self.assertIn('latency_seconds_bucket{endpoint="lists",le="+Inf"} 2\n', text)
+
+    def test_fork_resets_shards(self):
+        self.calls.inc(endpoint='lists')
+        self.registry.pid = -1
+        self.calls.inc(endpoint='users')
+        self.assertEqual(self.registry.values(), {('calls_total', (u'users',)): 1})
+
+    def test_metrics_view(self):
+        get_user_model().objects.create_superuser(display_name='Admin', email='admin@test.com',
+                                                  password='password')
+        client = APIClient()
+        client.login(username='Admin', password='password')
+        client.get('/api/sync/')
+        res = client.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('mailman_rest_request_duration_seconds_count{view="SyncRecordViewSet",'
+                      'action="list",method="GET",status="200"}', res.content)
+        self.assertIn('mailman_core_calls_total{', res.content)
+        with self.settings(MAILMAN_METRICS_ALLOWED_IPS=['10.0.0.1']):
+            self.assertEqual(client.get('/metrics').status_code, 403)
+
+
+class CircuitBreakerTest(TestCase):
+
+    def test_states(self):
+        circuit = breaker.CircuitBreaker('test', failure_threshold=2, recovery_timeout=30)
+        circuit.record_failure()
+        self.assertTrue(circuit.allow())
+        circuit.record_failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+        self.assertFalse(circuit.allow())
+        self.assertTrue(circuit.is_open())
+
+        circuit.opened_at -= 30
+        self.assertTrue(circuit.allow())
+        self.assertEqual(circuit.state, breaker.HALF_OPEN)
+        # Only one probe at a time.
+        self.assertFalse(circuit.allow())
+        circuit.record_failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+
+        circuit.opened_at -= 30
+        self.assertTrue(circuit.allow())
+        circuit.record_success()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+        self.assertEqual(circuit.failures, 0)
+
+    @override_settings(MAILMAN_BREAKER_FAILURE_THRESHOLD=2)
+    def test_connection_fails_fast(self):
+        core = bench.FakeCore()
+        core.populate(lists=1, members=0)
+        server = bench.FakeCoreServer(core).start()
+        connection = CoreInterface(base_url=server.url + '/3.0/').connection
+        self.addCleanup(breaker.reset_breakers)
+        connection.call('lists/list0.bench.example.com')
+        connection.cache.get(urljoin(connection.base_url, 'lists/list0.bench.example.com')).expires = 0
+        server.stop()
+
+        for n in range(2):
+            self.assertRaises(MailmanConnectionError, connection.call, 'lists')
+        calls = len(core.calls)
+        self.assertRaises(api_module.CircuitOpenError, connection.call, 'lists')
+        self.assertRaises(api_module.CircuitOpenError, connection.call, 'lists/foo/config')
+        # A stale cached answer is better than none.
+        response, content = connection.call('lists/list0.bench.example.com')
+        self.assertEqual(content['list_id'], 'list0.bench.example.com')
+        # Other families are not affected.
+        self.assertFalse(breaker.get_breaker(connection.base_url, 'users').is_open())
+        self.assertEqual(len(core.calls), calls)
+
+    def test_saves_are_queued_while_open(self):
+        self.addCleanup(breaker.reset_breakers)
+        circuit = breaker.get_breaker(interface_module.ci.connection.base_url, 'domains')
+        for n in range(circuit.failure_threshold):
+            circuit.record_failure()
+        domain = Domain.objects.create(mail_host='open.example.com')
+        record = SyncRecord.objects.get(model_name='domain')
+        self.assertEqual((record.object_pk, record.created), (domain.pk, True))
+        self.assertEqual(domain.partial_URL, None)
+
+class SingleFlightTest(TestCase):
+
+    def test_concurrent_calls_share_one(self):
+        group = singleflight.SingleFlight()
+        release = threading.Event()
+        calls = []
+        def fetch():
+            calls.append(True)
+            release.wait()
+            return 'response'
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(group.do('key', fetch)))
+                   for n in range(5)]
+        for thread in threads:
+            thread.start()
+        while group.stats()['calls'] < 5:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['response'] * 5)
+        self.assertEqual(group.stats(), dict(calls=5, saved=4))
+        # Nothing in flight anymore: the next call is made.
+        group.do('key', fetch)
+        self.assertEqual(len(calls), 2)
+
+    def test_errors_are_shared(self):
+        group = singleflight.SingleFlight()
+        started = threading.Event()
+        def fail():
+            started.set()
+            time.sleep(0.1)
+            raise IOError('down')
+        errors = []
+        def call():
+            try:
+                group.do('key', fail)
+            except IOError as e:
+                errors.append(e)
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        call()
+        leader.join()
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0] is errors[1])
+
+    def test_connection_coalesces_gets(self):
+        core = bench.FakeCore(latency=0.2)
+        core.populate(lists=1, members=0)
+        server = bench.FakeCoreServer(core).start()
+        self.addCleanup(server.stop)
+        connection = CoreInterface(base_url=server.url + '/3.0/').connection
+        contents = []
+        def get():
+            contents.append(connection.call('lists/list0.bench.example.com', use_cache=False)[1])
+        threads = [threading.Thread(target=get) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(core.calls.count(('GET', '/3.0/lists/list0.bench.example.com')), 1)
+        self.assertEqual(connection.singleflight_stats(), dict(calls=4, saved=3))
+        # Each caller decodes its own copy.
+        self.assertEqual(len(set(id(content) for content in contents)), 4)
+        self.assertEqual(contents[0], contents[3])
+
+    def test_processes_share_through_lock_files(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # Two groups stand for two processes: each takes its own flock.
+        first, second = (singleflight.FileSingleFlight(directory) for n in range(2))
+        started = threading.Event()
+        calls = []
+        def fetch():
+            calls.append(True)
+            started.set()
+            time.sleep(0.2)
+            return httplib2.Response({'status': '200'}), '{"list_id": "foo"}'
+        leader = threading.Thread(target=first.do, args=(('url', None), fetch))
+        leader.start()
+        started.wait()
+        response, content = second.do(('url', None), fetch)
+        leader.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((response.status, content), (200, '{"list_id": "foo"}'))
+        self.assertEqual(second.stats(), dict(calls=1, saved=1))
+        # Responses written before the call are not reused.
+        second.do(('url', None), fetch)
+        self.assertEqual(len(calls), 2)
+
+    def test_calls_in_flight_are_not_joined_after_a_write(self):
+        group = singleflight.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        def fetch_before_write():
+            started.set()
+            release.wait()
+            return 'before'
+        leader = threading.Thread(target=group.do, args=('key', fetch_before_write))
+        leader.start()
+        started.wait()
+        group.invalidate()
+        self.assertEqual(group.do('key', lambda: 'after'), 'after')
+        release.set()
+        leader.join()
+        self.assertEqual(group.stats(), dict(calls=2, saved=0))
+
+    def test_lock_files_are_swept(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        first, second = (singleflight.FileSingleFlight(directory, max_age=60)
+                         for n in range(2))
+        fetch = lambda: (httplib2.Response({'status': '200'}), '{"password": "hash"}')
+        first.do(('old', None), fetch)
+        first.do(('new', None), fetch)
+        self.assertEqual(len(os.listdir(directory)), 4)
+        # A write in the process makes it ignore the responses of others.
+        second.invalidate()
+        self.assertEqual(second._read(first._path(('new', None)), 0), None)
+        for name in os.listdir(directory):
+            if name.startswith(os.path.basename(first._path(('old', None)))):
+                os.utime(os.path.join(directory, name), (0, 0))
+        second.do(('new', None), fetch)
+        self.assertEqual(sorted(os.listdir(directory)),
+                         sorted(os.path.basename(first._path(('new', None))) + suffix
+                                for suffix in ('', '.lock')))
+
+class FanOutTest(TestCase):
+
+    def test_run_parallel(self):
+        lock = threading.Lock()
+        running = [0, 0]
+        def task(n):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return n
+        results = fanout.run_parallel([lambda n=n: task(n) for n in range(6)], max_concurrency=3)
+        self.assertEqual(results, range(6))
+        self.assertEqual(running[1], 3)
+
+    def test_first_error_is_raised_after_all_calls(self):
+        done = []
+        def fail():
+            raise IOError('down')
+        def slow():
+            time.sleep(0.05)
+            done.append(True)
+        self.assertRaises(IOError, fanout.run_parallel, [fail, slow, slow])
+        self.assertEqual(len(done), 2)
+
+    def test_rosters_are_fetched_in_parallel(self):
+        core = bench.FakeCore(latency=0.2)
+        core.populate(lists=1, members=2)
+        server = bench.FakeCoreServer(core).start()
+        self.addCleanup(server.stop)
+        interface = CoreInterface(base_url=server.url + '/3.0/')
+        profile = instrumentation.RequestProfile()
+        previous = instrumentation.activate(profile)
+        try:
+            started = time.time()
+            memberships = interface.get_memberships_by_list('list0.bench.example.com')
+            elapsed = time.time() - started
+        finally:
+            instrumentation.activate(previous)
+        self.assertEqual(len(memberships), 2)
+        # One roster after the other would take 0.6 seconds.
+        self.assertTrue(elapsed < 0.5, elapsed)
+        # Calls made by the helper threads count for the request.
+        self.assertEqual(profile.core_calls, 3)
+
+@override_settings(MAILMAN_CORE_PAGE_SIZE=10)
+class PaginationTest(TestCase):
+
+    def setUp(self):
+        self.core = bench.FakeCore()
+        self.core.populate(lists=1, members=25)
+        server = bench.FakeCoreServer(self.core).start()
+        self.addCleanup(server.stop)
+        self.ci = CoreInterface(base_url=server.url + '/3.0/')
+        self.mlist = ListAdaptor(self.ci.connection, 'lists/list0.bench.example.com')
+        self.mlist.fqdn_listname
+
+    def roster_calls(self):
+        return [path for method, path in self.core.calls if path.endswith('roster/member')]
+
+    def test_collections_are_paged(self):
+        members = self.mlist.members
+        self.assertEqual(len(members), 25)
+        self.assertEqual([m.address for m in members], sorted(m.address for m in members))
+        self.assertEqual(len(self.roster_calls()), 3)
+        self.assertEqual(len(self.ci.users), 25)
+
+    def test_iteration_is_lazy(self):
+        members = self.mlist.iter_members()
+        first = [next(members) for n in range(5)]
+        self.assertEqual(len(first), 5)
+        # The first page, and maybe the next one fetched ahead.
+        self.assertTrue(len(self.roster_calls()) <= 2)
+        self.assertEqual(len(list(members)), 20)
+        self.assertEqual(len(self.roster_calls()), 3)
+
+    def test_member_page(self):
+        page = self.mlist.get_member_page(count=10, page=3)
+        self.assertEqual((len(page), page.total_size), (5, 25))
+        self.assertFalse(page.has_next)
+        self.assertEqual(page.previous.nr, 2)
+        self.assertTrue(page.previous.has_next)
+        self.assertEqual(page[0].list_id, 'list0.bench.example.com')
+
+class MemberLookupTest(TestCase):
+
+    def test_lookups_do_not_scan_the_roster(self):
+        core = bench.FakeCore()
+        core.populate(lists=1, members=30)
+        server = bench.FakeCoreServer(core).start()
+        self.addCleanup(server.stop)
+        connection = CoreInterface(base_url=server.url + '/3.0/').connection
+        mlist = ListAdaptor(connection, 'lists/list0.bench.example.com')
+        mlist.list_id
+        calls = len(core.calls)
+
+        member = mlist.get_member('subscriber29@example.org')
+        self.assertEqual((member.address, member.list_id),
+                         ('subscriber29@example.org', 'list0.bench.example.com'))
+        self.assertRaises(ValueError, mlist.get_member, 'nobody@example.org')
+        mlist.unsubscribe('subscriber29@example.org')
+        self.assertRaises(ValueError, mlist.get_member, 'subscriber29@example.org')
+        # Lookups of a member always ask the Core.
+        self.assertEqual([method for method, path in core.calls[calls:]],
+                         ['POST', 'POST', 'POST', 'DELETE', 'POST'])
+
+class SubscriptionResolverTest(TestCase):
+
+    def test_subscriptions(self):
+        core = bench.FakeCore()
+        core.populate(lists=4, members=0)
+        user_path = core.add_user(email=u'one@example.org')
+        user_id = user_path.split('/')[1]
+        for email in (u'one@example.org', u'two@example.org', u'three@example.org'):
+            core.add_address(email, user_id=int(user_id))
+            for n in range(4):
+                core.add_member('list{0}.bench.example.com'.format(n), email)
+        server = bench.FakeCoreServer(core).start()
+        self.addCleanup(server.stop)
+        connection = CoreInterface(base_url=server.url + '/3.0/').connection
+
+        user = UserAdaptor(connection, user_path)
+        self.assertEqual(len(user.subscriptions), 12)
+        self.assertEqual(sorted(set(user.subscription_list_ids)),
+                         ['list{0}.bench.example.com'.format(n) for n in range(4)])
+        # The user, its addresses and one lookup per address.
+        self.assertEqual(len(core.calls), 5)
+
+        # Lookups are cached, until a membership changes.
+        self.assertEqual(len(UserAdaptor(connection, user_path).subscriptions), 12)
+        self.assertEqual(len(core.calls), 5)
+        connection.call('members', data=dict(list_id='list0.bench.example.com',
+                                             subscriber='four@example.org'))
+        calls = len(core.calls)
+        UserAdaptor(connection, user_path).subscriptions
+        self.assertEqual([path for method, path in core.calls[calls:]].count('/3.0/members/find'), 3)
+
+        # Other lookups are not cached.
+        calls = len(core.calls)
+        for n in range(2):
+            connection.call('members/find', data={'subscriber': 'one@example.org'})
+        self.assertEqual(len(core.calls), calls + 2)
+
+class AdaptorLayoutTest(TestCase):
+
+    def test_slots(self):
+        entry = dict(self_link='http://localhost/3.0/members/1', list_id='test.example.com',
+                     address='one@example.org', role='member', user='http://localhost/3.0/users/1',
+                     delivery_mode='regular', http_etag='"1"')
+        membership = MembershipAdaptor(FakeConnection(), entry['self_link'], data=entry)
+        self.assertFalse(hasattr(membership, '__dict__'))
+        self.assertRaises(AttributeError, setattr, membership, 'extra', 1)
+        # Only the fields of the schema are kept, in its order.
+        self.assertEqual(len(membership._values), len(MembershipAdaptor.fields))
+        self.assertEqual((membership.address, membership.role),
+                         ('one@example.org', 'member'))
+
+    def test_lazy_load(self):
+        connection = FakeConnection({'users/1': dict(self_link='http://localhost/3.0/users/1',
+                                                     user_id=1, created_on='2014-01-01')})
+        user = UserAdaptor(connection, 'users/1')
+        self.assertEqual(connection.calls, [])
+        self.assertEqual(user.user_id, 1)
+        self.assertEqual(user.display_name, None)
+        user.display_name = u'One'
+        self.assertEqual(user.display_name, u'One')
+        self.assertEqual(connection.calls, [('GET', 'users/1')])
+        self.assertRaises(KeyError, user._get, 'password')
+
+    def test_local_changes(self):
+        connection = FakeConnection()
+        user = UserAdaptor(connection, 'users/1')
+        # A rename is kept until saved, without fetching the user.
+        user.display_name = u'Two'
+        self.assertEqual(user.display_name, u'Two')
+        other = FakeConnection()
+        user.connection = other
+        user.save()
+        self.assertEqual(connection.calls, [])
+        self.assertEqual(other.calls, [('PATCH', 'users/1')])
+
+    def test_measure(self):
+        result = bench.measure_adaptors(count=100)
+        self.assertEqual(result['adaptors'], 100)
+        self.assertTrue(result['bytes_per_adaptor'] < result['bytes_per_entry'])
+
+class ListProvisioningTest(TestCase):
+
+    def setUp(self):
+        self.core = bench.FakeCore()
+        self.core.add_domain('mail.provision.com')
+        server = bench.FakeCoreServer(self.core).start()
+        self.addCleanup(server.stop)
+        old = interface_module.ci.connection
+        interface_module.ci.connection = CoreInterface(base_url=server.url + '/3.0/').connection
+        self.addCleanup(setattr, interface_module.ci, 'connection', old)
+        with interface_module.suppress_sync():
+            self.domain = Domain.objects.create(mail_host='mail.provision.com',
+                                                partial_URL='/3.0/domains/mail.provision.com')
+        del self.core.calls[:]
+
+    def test_single_sync(self):
+        with self.assertNumQueries(5):
+            mlist = self.domain.create_list('test')
+        self.assertEqual(self.core.calls, [
+            ('GET', '/3.0/lists/test@mail.provision.com'),
+            ('POST', '/3.0/lists'),
+            ('GET', '/3.0/lists/test.mail.provision.com'),
+            ('GET', '/3.0/lists/test.mail.provision.com/config'),
+            ('PATCH', '/3.0/lists/test.mail.provision.com/config')])
+        settings = ListSettings.objects.get(fqdn_listname='test@mail.provision.com')
+        self.assertEqual(settings.pk, mlist.settings_id)
+        self.assertEqual(settings.bounces_address, 'test-bounces@mail.provision.com')
+        self.assertEqual(settings.partial_URL, '/3.0/lists/test.mail.provision.com/config')
+        self.assertEqual(MailingList.objects.get(pk=mlist.pk).partial_URL,
+                         '/3.0/lists/test.mail.provision.com')
+
+    @override_settings(MAILMAN_SYNC_MODE='queue')
+    def test_queued(self):
+        mlist = self.domain.create_list('test')
+        self.assertEqual([(record.model_name, record.created) for record in SyncRecord.objects.all()],
+                         [('mailinglist', True)])
+        self.assertEqual(self.core.calls, [])
+        self.assertEqual(SyncWorker().drain(), dict(synced=1, failed=0))
+        self.assertIn(('PATCH', '/3.0/lists/test.mail.provision.com/config'), self.core.calls)
+
+class UserProvisioningTest(TestCase):
+
+    def setUp(self):
+        self.core = bench.FakeCore()
+        server = bench.FakeCoreServer(self.core).start()
+        self.addCleanup(server.stop)
+        old = interface_module.ci.connection
+        interface_module.ci.connection = CoreInterface(base_url=server.url + '/3.0/').connection
+        self.addCleanup(setattr, interface_module.ci, 'connection', old)
+
+    def test_create(self):
+        with self.assertNumQueries(8):
+            user = User.objects.create(display_name='Anne', password='secret',
+                                       email='anne@example.org')
+        self.assertEqual([method for method, path in self.core.calls], ['GET', 'POST', 'GET'])
+        user = User.objects.get(pk=user.pk)
+        self.assertTrue(user.check_password('secret'))
+        self.assertEqual(user.preferred_email.user, user)
+        self.assertIsNotNone(user.preferences)
+        self.assertIsNotNone(user.preferred_email.preferences)
+        self.assertTrue(user.partial_URL.startswith('/3.0/users/'))
+
+    def test_create_takes_over_email(self):
+        with interface_module.suppress_sync():
+            email = Email.objects.create(address='anne@example.org')
+        user = User.objects.create(display_name='Anne', password='secret',
+                                   email='anne@example.org')
+        self.assertEqual(user.preferred_email.pk, email.pk)
+        self.assertEqual(Email.objects.get(pk=email.pk).user, user)
+
+    def test_create_requires_email(self):
+        self.assertRaises(ValueError, User.objects.create, display_name='Anne',
+                          password='secret')
+        self.assertFalse(QuerySet(model=Email).filter(address__isnull=True).exists())
+        self.assertFalse(QuerySet(model=User).filter(display_name='Anne').exists())
+
+    def test_create_users(self):
+        rows = [(u'User {0}'.format(n), u'user{0}@example.org'.format(n), 'secret')
+                for n in range(5)]
+        users, sync_errors = create_users(rows, chunk_size=2)
+        self.assertEqual(sync_errors, 0)
+        self.assertEqual([user.display_name for user in users], [row[0] for row in rows])
+        self.assertEqual(len(self.core.users), 5)
+        user = User.objects.get(display_name='User 3')
+        self.assertTrue(user.check_password('secret'))
+        self.assertEqual(user.preferred_email.address, 'user3@example.org')
+        self.assertEqual(user.preferred_email.user, user)
+        self.assertIsNotNone(user.preferences)
+        self.assertTrue(user.partial_URL)
+        self.assertRaises(ValueError, create_users, [(u'User 0', u'other@example.org', None)])
+        self.assertRaises(ValueError, create_users, [(u'Other', u'user0@example.org', None)])
+
+    @override_settings(MAILMAN_SYNC_MODE='queue')
+    def test_create_users_statements(self):
+        # The same statements for any number of users in a chunk.
+        for count in (3, 30):
+            rows = [(u'User {0}-{1}'.format(count, n),
+                     u'user{0}-{1}@example.org'.format(count, n), None)
+                    for n in range(count)]
+            with self.assertNumQueries(14):
+                create_users(rows)
+
+    def test_pushes_are_parallel(self):
+        self.core.latency = 0.1
+        rows = [(u'User {0}'.format(n), u'user{0}@example.org'.format(n), None)
+                for n in range(8)]
+        started = time.time()
+        users, sync_errors = create_users(rows)
+        # A GET and a POST for each user, one after the other, would take
+        # 1.6 seconds.
+        self.assertTrue(time.time() - started < 1.2, time.time() - started)
+        self.assertEqual(sync_errors, 0)
+        self.assertEqual(len(self.core.users), 8)
+        self.assertEqual(QuerySet(model=User).filter(display_name__startswith='User ',
+                                                     partial_URL__isnull=True).count(), 0)
+
+
 '''
 class CoreTest(TestCase):
     base_url = 'http://localhost:8001/3.0'
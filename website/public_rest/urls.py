@@ -1,12 +1,13 @@
 from django.conf.urls import patterns, url, include
 from rest_framework import routers
-from . import views
+from . import metrics, views
 
 router = routers.DefaultRouter()
 router.register(r'users', views.UserViewSet)
 router.register(r'domains', views.DomainViewSet)
 router.register(r'lists', views.MailingListViewSet)
 router.register(r'emails', views.EmailViewSet)
+router.register(r'sync', views.SyncRecordViewSet)
 
 
 detail_dict = { 'get': 'retrieve',
@@ -19,14 +20,24 @@ listsettings_detail = views.ListSettingsViewSet.as_view(detail_dict)
 emailprefs_detail = views.EmailPrefsViewSet.as_view(detail_dict)
 membership_detail = views.MembershipViewSet.as_view(detail_dict)
 membershipprefs_detail = views.MembershipPrefsViewSet.as_view(detail_dict)
+membership_bulk = views.MailingListViewSet.as_view({'post': 'bulk_subscribe',
+                                                    'delete': 'bulk_unsubscribe'},
+                                                   permission_classes=[views.ListBulkMembershipPolicy])
+user_export = views.UserViewSet.as_view({'get': 'export'},
+                                        permission_classes=[views.UserExportPolicy])
 
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browseable API.
 urlpatterns = patterns('',
+    # Before the router, which would take `export` for a user id.
+    url(r'^api/users/export/$', user_export, name='user-export'),
     url(r'^api/', include(router.urls)),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
+    url(r'^metrics/?$', metrics.metrics, name='metrics'),
     url(r'^api/lists/(?P<pk>[^/]+)/settings/$', listsettings_detail, name='listsettings-detail'),
     url(r'^api/lists/(?P<pk>[^/]+)/settings/\.(?P<format>[a-z]+)$', listsettings_detail),
+    url(r'^api/lists/(?P<pk>[^/]+)/(?P<role>members|owners|moderators)/bulk/$',
+        membership_bulk, name='membership-bulk'),
     url(r'^api/lists/(?P<list_id>[^/]+)/(?P<role>members|owners|moderators)/(?P<address>[^/]+)/$',
         membership_detail, name='membership-detail'),
     url(r'^api/lists/(?P<list_id>[^/]+)/(?P<role>members|owners|moderators)/(?P<address>[^/]+)/preferences/$',
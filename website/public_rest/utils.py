@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from functools import wraps
+from urlparse import urlsplit
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
 import logging
@@ -26,15 +27,77 @@ def get_related_attribute(instance, attr_string):
             attribute = getattr(attribute, sub_strings, None)
     return attribute
 
+# Path segments of the Core API that are not object identifiers.
+CORE_PATH_LITERALS = ('3.0', 'addresses', 'config', 'domains', 'find', 'held',
+                      'lists', 'member', 'members', 'moderator', 'owner',
+                      'preferences', 'requests', 'roster', 'system',
+                      'unverify', 'users', 'verify', 'versions')
+
+def core_path_template(url):
+    """
+    Reduce a Core URL to the template of its endpoint, so that calls
+    can be grouped regardless of which object they refer to:
+        >>> core_path_template('http://localhost:8001/3.0/lists/foo.example.com/config')
+        'lists/{id}/config'
+    """
+    path = urlsplit(url).path.strip('/')
+    segments = path.split('/')
+    if '3.0' in segments:
+        segments = segments[segments.index('3.0') + 1:]
+    return '/'.join(segment if segment in CORE_PATH_LITERALS else '{id}'
+                    for segment in segments if segment)
+
+def core_resource_type(url):
+    """
+    The kind of resource a Core URL points at, which is the last
+    literal segment of its template (`roster` for any roster).
+        >>> core_resource_type('lists/foo.example.com/roster/owner')
+        'roster'
+    """
+    segments = [segment for segment in core_path_template(url).split('/')
+                if segment != '{id}']
+    if 'roster' in segments:
+        return 'roster'
+    return segments[-1] if segments else ''
+
+def core_relative_path(url):
+    """The path of a Core URL, relative to the API version root."""
+    path = urlsplit(url).path.strip('/')
+    segments = path.split('/')
+    if '3.0' in segments:
+        segments = segments[segments.index('3.0') + 1:]
+    return '/'.join(segments)
+
+def iterate_values(queryset, fields, chunk_size=1000):
+    """
+    Yield the `values_list(*fields)` of every row of `queryset`, running
+    one query per `chunk_size` rows. Chunks continue after the last
+    primary key seen instead of using an OFFSET, so memory and the cost
+    of each query stay the same however large the queryset is.
+    """
+    from django.db.models.query import QuerySet
+    # A plain QuerySet, so that the last, empty chunk does not make a
+    # remote queryset ask the Core.
+    queryset = queryset._clone(klass=QuerySet).order_by('pk')
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        rows = list(chunk.values_list('pk', *fields)[:chunk_size])
+        for row in rows:
+            yield row[1:]
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+
 def is_list_staff(user, mlist):
-    user_mails = [email for email in user.emails]
-    owner_mails = [mem.address for mem in mlist.owners]
-    mod_mails = [mem.address for mem in mlist.moderators]
-    common = [email for email in user_mails if
-    email in owner_mails or email in mod_mails]
-    if len(common) != 0:
-        return True
-    return False
+    """
+    Whether `user` owns or moderates `mlist`. Views should rather use
+    `authz.get_context(request).is_list_staff`, which is memoized.
+    """
+    from public_rest.authz import AuthorizationContext
+    return AuthorizationContext(user).is_list_staff(mlist)
 
 def make_permission(check_func):
     """
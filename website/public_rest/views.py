@@ -1,30 +1,49 @@
 import logging
 
 from django.contrib.auth.models import Group
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.conf import settings
+from django.db.models.query import QuerySet
 from django.shortcuts import get_object_or_404
 from rest_framework.decorators import link, action
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
 from public_rest.serializers import *
 from public_rest.models import *
 from public_rest.access_policy import *
-from public_rest import utils
+from public_rest import authz
+from public_rest.bulk import BulkSubscriber, parse_rows
+from public_rest.export import export_response, CSV, ROSTER_COLUMNS, USER_COLUMNS
+from public_rest.metrics import RequestMetricsMixin
+from public_rest.pagination import paginate
 
 #logging
 logger = logging.getLogger(__name__)
 
 
-class BaseModelViewSet(ModelViewSet):
+class BaseModelViewSet(RequestMetricsMixin, ModelViewSet):
+
+    def filter_queryset(self, queryset):
+        queryset = super(BaseModelViewSet, self).filter_queryset(queryset)
+        return optimize_queryset(queryset, self.get_serializer_class())
+
     def str2bool(self, s):
         return s.lower() in ['true']
 
     def is_boolean_string(self, s):
         return s.lower() in ['true', 'false']
 
+    def get_changes(self, data):
+        """Field values from PATCH data, with boolean strings converted."""
+        changes = {}
+        for key, val in data.items():
+            if val is not None:
+                if self.is_boolean_string(val):
+                    val = self.str2bool(val)
+                changes[key] = val
+        return changes
+
 
 class UserViewSet(BaseModelViewSet):
     """
@@ -66,26 +85,26 @@ class UserViewSet(BaseModelViewSet):
         memberships = user.membership_set.filter(role='member')
 
         if not request.user.is_superuser:
-            # Check if request.user is a staff member
-            mems = request.user.membership_set.all()
-            mailinglists = set([m.mlist for m in mems])
-            mlist_filter = []
-
-            for mlist in mailinglists:
-                if utils.is_list_staff(request.user, mlist):
-                    mlist_filter.append(mlist)
-
-            memberships = memberships.filter(mlist__in=mlist_filter)
+            # Only the lists request.user is a staff member of
+            staff_lists = list(authz.get_context(request).staff_list_ids())
+            memberships = memberships.filter(mlist__in=staff_lists)
 
         logger.debug("user: {0}".format(user))
-        serializer = MembershipListSerializer(memberships,
-                                            many=True,
-                                            context={'request': request})
-        return Response(serializer.data, status=200)
+        rv = paginate(request, memberships, MembershipListSerializer)
+        return Response(rv, status=200)
+
+    def export(self, request, *args, **kwargs):
+        """Stream every user, as CSV or NDJSON picked with `?output=`."""
+        response = export_response(QuerySet(model=User), USER_COLUMNS,
+                                   request.QUERY_PARAMS.get('output', CSV),
+                                   filename='users')
+        if response is None:
+            return Response('Unknown output format', status=400)
+        return response
 
     def retrieve(self, request, pk=None):
         """User detail view"""
-        queryset = self.queryset
+        queryset = optimize_queryset(self.queryset, UserDetailSerializer)
         user = get_object_or_404(queryset, pk=pk)
         serializer = UserDetailSerializer(user,
                         context={'request': request})
@@ -186,13 +205,7 @@ class EmailPrefsViewSet(BaseModelViewSet):
     def partial_update(self, request, *args, **kwargs):
         obj = self.get_object()
         try:
-            for k, v in request.DATA.items():
-                if v is not None:
-                    if self.is_boolean_string(v):
-                        setattr(obj, k, self.str2bool(v))
-                    else:
-                        setattr(obj, k, v)
-            obj.save()
+            obj.update(**self.get_changes(request.DATA))
         except Exception as e:
             return Response('Failed', status=500)
         else:
@@ -236,7 +249,7 @@ class MembershipViewSet(BaseModelViewSet):
 
     def retrieve(self, request, role=None, list_id=None, address=None):
         role = role[:-1]
-        queryset = self.queryset
+        queryset = optimize_queryset(self.queryset, MembershipDetailSerializer)
         membership = get_object_or_404(queryset,
                                         address__address=address,
                                         role=role,
@@ -292,13 +305,7 @@ class MembershipPrefsViewSet(BaseModelViewSet):
     def partial_update(self, request, *args, **kwargs):
         obj = self.get_object()
         try:
-            for k, v in request.DATA.items():
-                if v is not None:
-                    if self.is_boolean_string(v):
-                        setattr(obj, k, self.str2bool(v))
-                    else:
-                        setattr(obj, k, v)
-            obj.save()
+            obj.update(**self.get_changes(request.DATA))
         except Exception as e:
             return Response('Failed', status=500)
         else:
@@ -369,17 +376,8 @@ class MailingListViewSet(BaseModelViewSet):
 
         if request.method == 'GET':
             qset = getattr(mlist, '{0}s'.format(role))
-            if qset and qset.exists():
-                qset = self.make_paginator(request, qset)
-                serializer = MembershipDetailSerializer(qset,
-                #serializer = PaginatedMembershipDetailSerializer(qset,
-                                                            many=True,
-                                                            context={'request': request})
-                logger.debug("Serializer: {0}".format(serializer))
-                return Response(serializer.data, status=200)
-            else:
-                rv = dict(count=0, next=None, previous=None, results=[])
-                return Response(data=rv, status=200)
+            rv = paginate(request, qset, MembershipDetailSerializer)
+            return Response(data=rv, status=200)
 
         elif request.method == 'POST':
             """
@@ -396,7 +394,7 @@ class MailingListViewSet(BaseModelViewSet):
             default_addr = None
 
             # Check if user is an owner or mod
-            is_list_staff = utils.is_list_staff(user, mlist)
+            is_list_staff = authz.get_context(request).is_list_staff(mlist)
             if not address and not display_name:
                 default_addr = user.preferred_email.address
 
@@ -447,36 +445,70 @@ class MailingListViewSet(BaseModelViewSet):
         kwargs['role'] = 'owner'
         return self._add_membership(request, *args, **kwargs)
 
+    def _bulk_subscriber(self, request, role):
+        """
+        The BulkSubscriber for a role of the list, if the requesting
+        user may change it: staff can handle members and moderators,
+        only owners can handle owners.
+        """
+        mlist = self.get_object()
+        role = role[:-1]
+        if not request.user.is_superuser:
+            context = authz.get_context(request)
+            if not context.has_role('owner', mlist):
+                if role == 'owner' or not context.is_list_staff(mlist):
+                    return None
+        return BulkSubscriber(mlist, role)
+
+    @link(permission_classes=[ListExportPolicy])
+    def export(self, request, *args, **kwargs):
+        """
+        Stream the roster of the list, as CSV or NDJSON picked with
+        `?output=`. `?role=` restricts it to one role.
+        """
+        mlist = self.get_object()
+        if not request.user.is_superuser and not authz.get_context(request).is_list_staff(mlist):
+            return Response('You are not a staff member of this list', status=403)
+        qset = QuerySet(model=Membership).filter(mlist=mlist)
+        role = request.QUERY_PARAMS.get('role')
+        if role:
+            qset = qset.filter(role=role)
+        response = export_response(qset, ROSTER_COLUMNS,
+                                   request.QUERY_PARAMS.get('output', CSV),
+                                   filename=mlist.fqdn_listname)
+        if response is None:
+            return Response('Unknown output format', status=400)
+        return response
+
+    def bulk_subscribe(self, request, role=None, *args, **kwargs):
+        """
+        Subscribe many addresses with the given role at once. Takes a
+        JSON list of addresses, or a CSV file of addresses and optional
+        display names.
+
+        Unless `MAILMAN_SYNC_MODE` is 'queue', the new users and
+        memberships are pushed to the Core before the response, in
+        parallel on the fan-out pool.
+        """
+        subscriber = self._bulk_subscriber(request, role)
+        if subscriber is None:
+            return Response('You are not allowed to change the {0}'.format(role), status=403)
+        return Response(subscriber.subscribe(parse_rows(request)), status=200)
+
+    def bulk_unsubscribe(self, request, role=None, *args, **kwargs):
+        """Unsubscribe many addresses from the given role at once."""
+        subscriber = self._bulk_subscriber(request, role)
+        if subscriber is None:
+            return Response('You are not allowed to change the {0}'.format(role), status=403)
+        return Response(subscriber.unsubscribe(parse_rows(request)), status=200)
+
     @link()
     def memberships(self, request, *args, **kwargs):
         """All memberships"""
         mlist = self.get_object()
         qset = mlist.membership_set.get_query_set()
-        if qset and qset.exists():
-            qset = self.make_paginator(request, qset)
-            serializer = MembershipDetailSerializer(qset,
-            #serializer = PaginatedMembershipDetailSerializer(qset,
-                                                        many=True,
-                                                        context={'request': request})
-            logger.debug("Serializer: {0}".format(serializer))
-            return Response(serializer.data, status=200)
-        else:
-            rv = dict(count=0, next=None, previous=None, results=[])
-            return Response(data=rv, status=200)
-
-    def make_paginator(self, request, qset):
-        paginator = Paginator(qset, 10)
-        page = request.QUERY_PARAMS.get('page')
-        try:
-            qset = paginator.page(page)
-        except PageNotAnInteger:
-            # If page is not an int, deliver the first page
-            qset = paginator.page(1)
-        except EmptyPage:
-            # If page is out of range (eg. 9999)
-            # deliver the last page
-            qset = paginator.page(paginator.num_pages)
-        return qset
+        rv = paginate(request, qset, MembershipDetailSerializer)
+        return Response(data=rv, status=200)
 
 
 class ListSettingsViewSet(BaseModelViewSet):
@@ -497,13 +529,7 @@ class ListSettingsViewSet(BaseModelViewSet):
         obj = self.get_object()
 
         try:
-            for key, val in request.DATA.items():
-                if val is not None:
-                    if self.is_boolean_string(val):
-                        setattr(obj, key, self.str2bool(val))
-                    else:
-                        setattr(obj, key, val)
-            obj.save()
+            obj.update(**self.get_changes(request.DATA))
         except Exception as e:
             logger.debug("Exception:::{0} - {1}".format(e, type(e)))
             return Response('Failed', status=500)
@@ -576,3 +602,21 @@ class DomainViewSet(BaseModelViewSet):
             return Response('Failed', status=500)
         else:
             return Response('Updated', status=204)
+
+
+class SyncRecordViewSet(RequestMetricsMixin, ReadOnlyModelViewSet):
+    """Status of the changes queued for the Core."""
+    queryset = SyncRecord.objects.all()
+    serializer_class = SyncRecordSerializer
+    permission_classes = [SyncStatusPolicy]
+
+    def get_queryset(self):
+        queryset = self.queryset
+        status = self.request.QUERY_PARAMS.get('status', None)
+        object_type = self.request.QUERY_PARAMS.get('object_type', None)
+
+        if status is not None:
+            queryset = queryset.filter(status=status)
+        if object_type is not None:
+            queryset = queryset.filter(object_type=object_type)
+        return queryset